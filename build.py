@@ -10,6 +10,49 @@ import sys
 import platform
 import subprocess
 
+# 启动时间预算：导入主程序模块的耗时中位数上限（毫秒）
+STARTUP_BUDGET_MS = 50
+# 这些模块较重，只应在需要时才导入
+LAZY_MODULES = ["requests", "asyncio"]
+
+def measure_startup_time(runs=5):
+    """在独立进程中多次导入主程序
+    
+    Returns:
+        tuple: (导入耗时中位数（毫秒）, 启动时已被导入的重模块列表)
+    """
+    code = (
+        "import sys, time; t = time.perf_counter(); import cloudflare_speedtest; "
+        "print((time.perf_counter() - t) * 1000); "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    # 第一次运行会生成 .pyc，不计入结果
+    for _ in range(runs + 1):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=script_dir)
+        lines = output.decode("utf-8").splitlines()
+        times.append(float(lines[0]))
+        loaded = [m for m in lines[1].split(",") if m] if len(lines) > 1 else []
+    times = sorted(times[1:])
+    return times[len(times) // 2], loaded
+
+def check_startup_time(budget_ms=STARTUP_BUDGET_MS):
+    """检查启动时间是否在预算内，且重模块没有在启动时导入"""
+    elapsed, loaded = measure_startup_time()
+    print(f"启动耗时: {elapsed:.1f} ms（预算 {budget_ms} ms）")
+    ok = True
+    if elapsed > budget_ms:
+        print("✗ 启动耗时超出预算")
+        ok = False
+    if loaded:
+        print(f"✗ 启动时导入了重模块: {', '.join(loaded)}")
+        ok = False
+    if ok:
+        print("✓ 启动时间检查通过")
+    return ok
+
 def check_pyinstaller():
     """检查 PyInstaller 是否已安装"""
     try:
@@ -87,6 +130,9 @@ def build_executable():
 
 def main():
     """主函数"""
+    if "--check-startup" in sys.argv:
+        return 0 if check_startup_time() else 1
+    
     print("=" * 60)
     print("Cloudflare SpeedTest 可执行文件打包工具")
     print("=" * 60)
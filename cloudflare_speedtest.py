@@ -7,15 +7,46 @@ Cloudflare SpeedTest 跨平台自动化脚本
 """
 
 import os
+import re
 import sys
+import time
+import random
 import platform
+import ipaddress
 import subprocess
-import requests
 import json
 import csv
+import struct
+import importlib.util
+from array import array
 from pathlib import Path
 from datetime import datetime
 
+# 部分 PyInstaller 打包环境缺少 SSL 支持（ssl.py 仍在，缺的是 _ssl 扩展），只检查不导入
+HAS_SSL = importlib.util.find_spec("_ssl") is not None
+
+
+def _ssl_context():
+    """默认的 SSL 上下文，SSL 不可用时返回 None"""
+    if not HAS_SSL:
+        return None
+    import ssl
+    return ssl.create_default_context()
+
+
+class CurlResponse:
+    """curl 或 http.client 请求的响应对象（模拟 requests.Response 的常用属性）"""
+    
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self._json = None
+    
+    def json(self):
+        if self._json is None:
+            self._json = json.loads(self.text) if self.text else {}
+        return self._json
+
 
 # 使用curl的备用HTTP请求函数（解决SSL模块不可用的问题）
 def curl_request(url, method='GET', data=None, headers=None, timeout=30):
@@ -61,18 +92,6 @@ def curl_request(url, method='GET', data=None, headers=None, timeout=30):
             status_code = 0
             response_text = output
         
-        # 创建响应对象模拟
-        class CurlResponse:
-            def __init__(self, status_code, text):
-                self.status_code = status_code
-                self.text = text
-                self._json = None
-            
-            def json(self):
-                if self._json is None:
-                    self._json = json.loads(self.text) if self.text else {}
-                return self._json
-        
         return CurlResponse(status_code, response_text)
     
     except subprocess.TimeoutExpired:
@@ -85,6 +104,281 @@ def curl_request(url, method='GET', data=None, headers=None, timeout=30):
         raise Exception(f"curl请求失败: {e}")
 
 
+class HttpClientPool:
+    """标准库 http.client 实现的 HTTP 客户端（未安装 requests 时使用）
+    
+    每个线程为每个 (协议, 主机:端口) 保留一个持久连接，自动跟随重定向。
+    open() 返回的响应需要读完或交给 release()，连接才能继续复用。
+    """
+    MAX_REDIRECTS = 10
+    
+    def __init__(self):
+        import threading
+        self._local = threading.local()
+    
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+    
+    def _connection(self, key, timeout):
+        import http.client
+        connection = self._connections().get(key)
+        if connection is None:
+            scheme, netloc = key
+            if scheme == 'https':
+                if not HAS_SSL:
+                    raise OSError("SSL 不可用，无法访问 https 地址")
+                connection = http.client.HTTPSConnection(netloc, timeout=timeout, context=_ssl_context())
+            else:
+                connection = http.client.HTTPConnection(netloc, timeout=timeout)
+            self._connections()[key] = connection
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection
+    
+    def _discard(self, key):
+        connection = self._connections().pop(key, None)
+        if connection is not None:
+            connection.close()
+    
+    def open(self, method, url, body=None, headers=None, timeout=30):
+        """发送请求并返回最终响应（响应体尚未读取）
+        
+        Returns:
+            http.client.HTTPResponse
+        """
+        import http.client
+        from urllib.parse import urlsplit, urljoin
+        headers = dict(headers or {})
+        for _ in range(self.MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f"不支持的地址: {url}")
+            key = (parts.scheme, parts.netloc)
+            path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+            
+            for attempt in range(2):
+                connection = self._connection(key, timeout)
+                reused = connection.sock is not None
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    self._discard(key)
+                    # 服务器可能已关闭空闲的持久连接，换新连接重试一次
+                    if not reused or attempt:
+                        raise
+                except Exception:
+                    self._discard(key)
+                    raise
+            response.pool_key = key
+            
+            location = response.getheader('Location')
+            if response.status not in (301, 302, 303, 307, 308) or not location:
+                return response
+            response.read()
+            url = urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+                headers.pop('Content-Type', None)
+        raise Exception(f"重定向次数过多: {url}")
+    
+    def release(self, response):
+        """释放响应：未读完的响应所在的连接无法复用，直接关闭"""
+        if not response.isclosed():
+            self._discard(response.pool_key)
+    
+    def fetch(self, method, url, body=None, headers=None, timeout=30):
+        """发送请求并读取完整响应
+        
+        Returns:
+            tuple: (状态码, 小写键名的响应头 dict, 响应体 bytes)
+        """
+        response = self.open(method, url, body, headers, timeout)
+        try:
+            data = response.read()
+        finally:
+            self.release(response)
+        return response.status, {k.lower(): v for k, v in response.getheaders()}, data
+
+
+class Transport:
+    """HTTP 传输层：首次使用时探测一次本机能力并缓存结果
+    
+    - 安装了 requests 且 SSL 可用时，所有请求通过共享的 requests.Session（连接池）发送；
+    - 未安装 requests 时使用标准库 http.client（同样复用连接，SSL 可用时支持 https）；
+    - SSL 不可用时（如部分 PyInstaller 打包环境）https 请求直接交给 curl，
+      不再每次先失败再切换；http 请求仍使用 requests 或 http.client。
+    wget 只在下载文件的备用方法中使用。
+    """
+    
+    def __init__(self):
+        import shutil
+        self.has_ssl = HAS_SSL
+        # 只检查是否已安装，导入 requests 较慢，留到首次请求时
+        self.has_requests = importlib.util.find_spec('requests') is not None
+        self.has_curl = shutil.which('curl') is not None
+        self.has_wget = shutil.which('wget') is not None
+        self._session = None
+        self._pool = None
+    
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+    
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = HttpClientPool()
+        return self._pool
+    
+    def use_curl(self, url):
+        """该地址是否需要通过 curl 访问"""
+        return not self.has_ssl and url.startswith('https://') and self.has_curl
+    
+    def use_stdlib(self, url):
+        """该地址是否通过标准库 http.client 访问"""
+        return not self.has_requests and not self.use_curl(url)
+    
+    def describe(self):
+        client = "requests" if self.has_requests else "http.client"
+        if self.has_ssl:
+            return client
+        return f"{client}（http）/ curl（https）" if self.has_curl else f"{client}（仅 http）"
+    
+    @property
+    def timeout_errors(self):
+        """当前传输方式下表示请求超时的异常类型"""
+        import socket
+        if self.has_requests:
+            import requests
+            return (requests.exceptions.Timeout, socket.timeout)
+        return (socket.timeout,)
+    
+    @property
+    def network_errors(self):
+        """当前传输方式下表示网络错误的异常类型"""
+        import http.client
+        if self.has_requests:
+            import requests
+            return (requests.exceptions.RequestException, OSError, http.client.HTTPException)
+        return (OSError, http.client.HTTPException)
+    
+    def request(self, method, url, data=None, headers=None, timeout=30):
+        """发送请求，data 以 JSON 格式发送"""
+        if self.use_curl(url):
+            return curl_request(url, method=method, data=data, headers=headers, timeout=timeout)
+        if self.use_stdlib(url):
+            body = json.dumps(data).encode('utf-8') if data is not None else None
+            status, _, content = self.pool.fetch(method, url, body, headers, timeout)
+            return CurlResponse(status, content.decode('utf-8', errors='replace'))
+        return self.session.request(method, url, json=data, headers=headers, timeout=timeout)
+    
+    def head(self, url, timeout=15):
+        """发送 HEAD 请求（跟随重定向）
+        
+        Returns:
+            tuple: (状态码, 小写键名的响应头 dict)
+        """
+        if self.use_stdlib(url):
+            status, headers, _ = self.pool.fetch('HEAD', url, timeout=timeout)
+            return status, headers
+        if not self.use_curl(url):
+            response = self.session.head(url, allow_redirects=True, timeout=timeout)
+            return response.status_code, {k.lower(): v for k, v in response.headers.items()}
+        
+        result = subprocess.run(['curl', '-sIL', '--connect-timeout', str(timeout), url], capture_output=True,
+                                text=True, encoding='utf-8', errors='replace', timeout=timeout * 2)
+        # 只取最后一个响应（跟随重定向后的最终响应）
+        block = re.split(r'\r?\n\r?\n(?=HTTP/)', result.stdout.strip())[-1]
+        lines = block.splitlines()
+        match = re.match(r'HTTP/\S+\s+(\d+)', lines[0]) if lines else None
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return (int(match.group(1)) if match else 0), headers
+    
+    def get(self, url, headers=None, timeout=15):
+        """发送 GET 请求（跟随重定向）
+        
+        Returns:
+            tuple: (状态码, 小写键名的响应头 dict, 响应文本)
+        """
+        if self.use_stdlib(url):
+            status, response_headers, content = self.pool.fetch('GET', url, headers=headers, timeout=timeout)
+            return status, response_headers, content.decode('utf-8', errors='replace')
+        if not self.use_curl(url):
+            response = self.session.get(url, headers=headers, timeout=timeout)
+            return response.status_code, {k.lower(): v for k, v in response.headers.items()}, response.text
+        
+        cmd = ['curl', '-siL', '--connect-timeout', str(timeout)]
+        for key, value in (headers or {}).items():
+            cmd.extend(['-H', f'{key}: {value}'])
+        result = subprocess.run(cmd + [url], capture_output=True, text=True, encoding='utf-8',
+                                errors='replace', timeout=timeout * 2)
+        # 输出为各次响应（含重定向）的响应头，最后是响应体
+        text = result.stdout
+        block = ''
+        while re.match(r'HTTP/\S+\s+\d+', text):
+            parts = re.split(r'\r?\n\r?\n', text, 1)
+            block, text = parts[0], (parts[1] if len(parts) > 1 else '')
+        lines = block.splitlines()
+        match = re.match(r'HTTP/\S+\s+(\d+)', lines[0]) if lines else None
+        headers = {}
+        for line in lines[1:]:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        return (int(match.group(1)) if match else 0), headers, text
+    
+    def download(self, url, filename, timeout=60):
+        """完整下载文件到 filename
+        
+        Returns:
+            bool: 是否成功
+        """
+        if self.use_curl(url):
+            result = subprocess.run(["curl", "-L", "-f", "-o", filename, url], capture_output=True,
+                                    text=True, encoding='utf-8', errors='replace', timeout=timeout)
+            return result.returncode == 0 and os.path.exists(filename)
+        
+        if self.use_stdlib(url):
+            response = self.pool.open('GET', url, timeout=timeout)
+            try:
+                if response.status >= 400:
+                    raise Exception(f"HTTP {response.status}")
+                with open(filename, "wb") as f:
+                    for chunk in iter(lambda: response.read(FILE_DOWNLOAD_CHUNK_MIN), b''):
+                        f.write(chunk)
+            finally:
+                self.pool.release(response)
+            return True
+        
+        with self.session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(filename, "wb") as f:
+                for chunk in response.iter_content(chunk_size=FILE_DOWNLOAD_CHUNK_MIN):
+                    f.write(chunk)
+        return True
+
+
+_transport = None
+
+
+def get_transport():
+    """获取全局传输层（首次调用时探测）"""
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+
 # Cloudflare 数据中心完整机场码映射
 # 数据来源：Cloudflare 官方数据中心列表
 AIRPORT_CODES = {
@@ -229,6 +523,8 @@ CLOUDFLARE_IP_URL = "https://www.cloudflare.com/ips-v4/"
 CLOUDFLARE_IP_FILE = "Cloudflare.txt"
 CLOUDFLARE_IPV6_URL = "https://www.cloudflare.com/ips-v6/"
 CLOUDFLARE_IPV6_FILE = "Cloudflare_ipv6.txt"
+IP_LIST_CHECK_INTERVAL = 6 * 3600  # IP列表重新验证间隔（秒），验证使用条件请求，未变化时只需一次 304
+IP_LIST_CHECK_TIMEOUT = 5  # 重新验证已有IP列表的超时（秒），离线时尽快回退到已有文件
 
 # Cloudflare IPv6 地址段（内置）
 # 数据来源：https://www.cloudflare.com/ips-v6/
@@ -348,6 +644,113 @@ GITHUB_REPO = "XIU2/CloudflareSpeedTest"
 # 配置文件路径
 CONFIG_FILE = ".cloudflare_speedtest_config.json"
 
+# 反代版本测速程序及其缓存（按 版本/系统/架构 缓存，内容按 SHA-256 寻址）
+PROXY_RELEASE_VERSION = "v1.0"
+PROXY_RELEASE_URL = "https://github.com/byJoey/CloudflareSpeedTest/releases/download"
+# 发布信息 API，各资源的 digest 字段为 GitHub 在上传时计算的 SHA-256
+PROXY_RELEASE_API_URL = "https://api.github.com/repos/byJoey/CloudflareSpeedTest/releases/tags"
+BINARY_CACHE_ENV = "CLOUDFLARE_SPEEDTEST_CACHE"  # 自定义缓存目录的环境变量
+BINARY_INDEX_FILE = "index.json"
+BINARY_UNAVAILABLE_HINT = "❌ 测速程序不可用，可使用原生TCPing模式（功能 4）或目标驱动引擎"
+
+# 文件下载：大文件按 HTTP Range 分段并行下载，进度记录在 <文件名>.part.json 中以便续传
+FILE_DOWNLOAD_SEGMENTS = 4  # 同时下载的分段数
+FILE_DOWNLOAD_MIN_SEGMENT = 1024 * 1024  # 每段最小字节数，文件较小时减少分段
+FILE_DOWNLOAD_CHUNK_MIN = 64 * 1024  # 每次读取的初始字节数
+FILE_DOWNLOAD_CHUNK_MAX = 1024 * 1024  # 读取速度快时逐步增大到的上限
+FILE_DOWNLOAD_CHECKPOINT = 4 * 1024 * 1024  # 每下载多少字节保存一次进度
+FILE_DOWNLOAD_TIMEOUT = 60
+
+# 原生测速引擎参数（不依赖 CloudflareST 可执行文件）
+DEFAULT_TEST_PORT = 443
+CLOUDFLARE_HTTPS_PORTS = [443, 2053, 2083, 2087, 2096, 8443]  # Cloudflare 支持的 HTTPS 端口
+NATIVE_TCPING_CONCURRENCY = 1000  # 同时进行的TCP连接数
+NATIVE_TCPING_TIMES = 4  # 每个IP的TCPing次数（与 CloudflareST -t 默认值一致）
+NATIVE_TCPING_TIMEOUT = 1.0  # 单次TCP连接超时（秒）
+NATIVE_HTTPING_CONCURRENCY = 200  # HTTPing 同时在测的IP数
+NATIVE_HTTPING_TIMEOUT = 3.0  # HTTPing 单次请求超时（秒）
+NATIVE_DOWNLOAD_SECONDS = 10  # 单个IP下载测速时长（秒，与 CloudflareST -dt 默认值一致）
+DEFAULT_DOWNLOAD_URL = "https://speed.cloudflare.com/__down?bytes=200000000"
+DOWNLOAD_READ_SIZE = 256 * 1024  # 下载测速每次读取的字节数
+GOAL_WARMUP_CANDIDATES = 20  # 目标驱动模式首次下载前积累的候选数
+MULTI_COLO_WORKERS = 2  # 多地区测速时同时进行的地区数
+SCAN_CHECKPOINT_INTERVAL = 5  # 长时间扫描写入检查点的间隔（秒）
+
+# 测速历史
+HISTORY_DB_FILE = "speedtest_history.db"
+HISTORY_HALF_LIFE = 3 * 24 * 3600  # 历史质量分半衰期（秒）
+HISTORY_WARM_START = 50  # 预热时优先测试的历史最佳IP数
+HISTORY_RETENTION = 30 * 24 * 3600  # 测速历史保留时长（秒），超过后删除原始记录和已衰减到可忽略的质量分
+WARM_START_IP_FILE = "warm_start_ips.txt"  # 补充了历史最佳IP的 CloudflareST 候选文件
+
+# 本地查询服务
+SERVE_HOST = "127.0.0.1"
+SERVE_RELOAD_INTERVAL = 2  # 独立运行时检查 result.csv 是否更新的间隔（秒）
+
+# 无人值守模式默认参数（可被 --config 配置文件和命令行参数覆盖）
+HEADLESS_DEFAULTS = {
+    "ip_version": "ipv4",  # ipv4 / ipv6
+    "ip_file": None,  # 自定义IP文件，默认按 ip_version 选择
+    "mode": "all",  # all: 测试整个IP列表；colo: 只测试 colos 中的地区
+    "colos": [],
+    "engine": "binary",  # binary: CloudflareST；goal: 内置目标驱动引擎；tcping: 内置TCPing（不测速度）
+    "ports": [],  # 内置引擎额外测试的端口，留空使用IP文件中的端口
+    "dn_count": "10",
+    "speed_limit": "1",
+    "time_limit": "1000",
+    "interval": 0,  # 两次运行之间的间隔（秒），0 表示只运行一次
+    "worker_url": None,  # Worker 管理页面 URL，留空时使用已保存的上报配置
+    "upload": False,
+    "upload_count": 10,
+    "clear_upload": False,  # 上报前清空现有优选IP
+    "serve_port": None,  # 启动本地查询服务的端口，留空不启动
+    "ranking": None,  # 上报和查询时的排序方式：pareto / speed，留空使用 RESULT_RANKING
+    "binary_output": False,  # 每轮额外保存二进制结果文件
+}
+
+# 候选IP分层抽样：IPv4 按 /24、IPv6 按 /64 分块
+CANDIDATE_BLOCK_PREFIX_V4 = 24
+CANDIDATE_BLOCK_PREFIX_V6 = 64
+CANDIDATE_MAX_BLOCKS_V6 = 16  # 每个IPv6地址段最多抽取的 /64 数
+CANDIDATE_FILE = "candidates.txt"  # 展开后的候选IP文件
+
+# 地区扫描
+REGION_SCAN_FILE = "region_scan.csv"
+REGION_INDEX_FILE = "region_index.bin"  # 地区扫描结果的二进制索引
+REGION_SCAN_URL = "https://jhb.ovh"
+REGION_SAMPLE_ROUND = 200  # 地区扫描每轮随机抽样探测的地址块数
+REGION_SAMPLE_Z = 1.96  # 地区占比置信区间的 z 值（95%）
+REGION_SAMPLE_MARGIN = 0.05  # 相邻地区区间重叠时，两者占比之差的上界不超过该值即视为排序已稳定
+REGION_DRILL_TARGET = 100  # 选中地区的IP少于该数量时补充扫描
+REGION_DRILL_MAX_PROBES = 2000  # 补充扫描最多探测的地址块数
+REGION_CLUSTER_PREFIX_V4 = 16  # 补充扫描优先探测已命中IP所在的 /16（IPv6 /48）
+REGION_CLUSTER_PREFIX_V6 = 48
+REGION_SCAN_TTL = 24 * 3600  # 地区扫描结果有效期（秒）
+REGION_DRIFT_SAMPLES = 5  # 增量刷新时每个地区抽样复查的IP数
+
+# 地区检测失败时使用的默认地区
+DEFAULT_REGIONS = [
+    ('HKG', '香港 (中国)', 0),
+    ('SIN', '新加坡 (新加坡)', 0),
+    ('NRT', '东京 (日本)', 0),
+    ('ICN', '首尔 (韩国)', 0),
+    ('LAX', '洛杉矶 (美国)', 0),
+    ('FRA', '法兰克福 (德国)', 0),
+    ('LHR', '伦敦 (英国)', 0)
+]
+
+# 测速结果CSV表头（与 CloudflareST 输出格式保持一致）
+RESULT_CSV_HEADERS = ['IP 地址', '端口', '已发送', '已接收', '丢包率', '平均延迟', '下载速度 (MB/s)', '地区码']
+# 地区扫描结果额外记录每行的检测时间（Unix 时间戳）
+REGION_SCAN_HEADERS = RESULT_CSV_HEADERS + ['检测时间']
+
+# 紧凑二进制结果文件（可选，与CSV互相转换）
+RESULT_BINARY_FILE = "result.bin"
+
+# 结果排序：speed 只按下载速度（与 CloudflareST 一致）；pareto 按延迟/丢包率/下载速度的 Pareto 前沿分层，层内按加权分排序
+RESULT_RANKING = "speed"
+RANK_WEIGHTS = {'latency': 1.0, 'loss': 1.0, 'speed': 1.0}  # 层内加权分中各指标的权重
+
 
 def generate_ipv6_file():
     """生成 IPv6 地址列表文件"""
@@ -364,7 +767,11 @@ def generate_ipv6_file():
 
 
 def get_system_info():
-    """获取系统信息"""
+    """获取系统信息
+    
+    Returns:
+        tuple: (os_type, arch_type)，没有对应测速程序的系统或架构为 None（仍可使用原生引擎）
+    """
     system = platform.system().lower()
     machine = platform.machine().lower()
     
@@ -376,10 +783,8 @@ def get_system_info():
     elif system == "windows":
         os_type = "win"
     else:
-        print(f"不支持的操作系统: {system}")
-        if sys.platform == "win32":
-            input("按 Enter 键退出...")
-        sys.exit(1)
+        print(f"⚠️  测速程序不支持该操作系统: {system}")
+        os_type = None
     
     # 标准化架构名称
     if machine in ["x86_64", "amd64", "x64"]:
@@ -389,10 +794,8 @@ def get_system_info():
     elif machine in ["armv7l", "armv6l"]:
         arch_type = "arm"
     else:
-        print(f"不支持的架构: {machine}")
-        if sys.platform == "win32":
-            input("按 Enter 键退出...")
-        sys.exit(1)
+        print(f"⚠️  测速程序不支持该架构: {machine}")
+        arch_type = None
     
     return os_type, arch_type
 
@@ -407,70 +810,271 @@ def get_executable_name(os_type, arch_type):
         return f"CloudflareST_linux_{arch_type}"
 
 
-def download_file(url, filename):
-    """下载文件 - 支持多种下载方法"""
-    print(f"正在下载: {url}")
+def _adaptive_chunks(read):
+    """按自适应大小读取数据：读取很快时加倍块大小，直到 FILE_DOWNLOAD_CHUNK_MAX"""
+    size = FILE_DOWNLOAD_CHUNK_MIN
+    while True:
+        started = time.perf_counter()
+        chunk = read(size)
+        if not chunk:
+            break
+        yield chunk
+        if len(chunk) == size and time.perf_counter() - started < 0.05:
+            size = min(size * 2, FILE_DOWNLOAD_CHUNK_MAX)
+
+
+def _check_range_response(status_code, content_range, start, end):
+    """确认服务器按请求返回了 [start, end] 字节范围（206 且 Content-Range 一致）
     
-    # 方法1: 尝试使用 requests（SSL不可用时静默切换到curl）
-    try:
+    不支持 Range 的服务器（包括重定向后的地址）会从头返回整个文件，写入分段位置会损坏文件。
+    """
+    if status_code != 206:
+        raise Exception(f"服务器不支持分段下载 (HTTP {status_code})")
+    match = re.match(r'\s*bytes\s+(\d+)-(\d+)/', content_range or '')
+    if not match or (int(match.group(1)), int(match.group(2))) != (start, end):
+        raise Exception(f"服务器返回的范围与请求不一致: {content_range!r}（请求 {start}-{end}）")
+
+
+def _iter_range_requests(url, start, end):
+    """使用 requests（未安装时使用 http.client）读取 [start, end] 字节范围"""
+    headers = {'Range': f'bytes={start}-{end}'}
+    transport = get_transport()
+    if not transport.has_requests:
+        response = transport.pool.open('GET', url, headers=headers, timeout=FILE_DOWNLOAD_TIMEOUT)
         try:
-            response = requests.get(url, stream=True, timeout=60)
-            response.raise_for_status()
-            
-            with open(filename, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            print(f"✅ 下载完成: {filename}")
-            return True
-        except ImportError as e:
-            # SSL模块不可用，静默切换到curl下载
-            if "SSL module is not available" in str(e):
-                result = subprocess.run([
-                    "curl", "-L", "-o", filename, url
-                ], capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
-                
-                if result.returncode == 0 and os.path.exists(filename):
-                    print(f"✅ 下载完成: {filename}")
-                    return True
-            else:
-                raise
-    except Exception:
-        # 静默失败，继续尝试其他方法
-        pass
+            _check_range_response(response.status, response.getheader('Content-Range'), start, end)
+            for chunk in _adaptive_chunks(response.read):
+                yield chunk
+        finally:
+            transport.pool.release(response)
+        return
     
-    # 方法2: 尝试使用 wget
+    session = transport.session
+    with session.get(url, headers=headers, stream=True, timeout=FILE_DOWNLOAD_TIMEOUT) as response:
+        _check_range_response(response.status_code, response.headers.get('Content-Range'), start, end)
+        for chunk in _adaptive_chunks(lambda n: response.raw.read(n, decode_content=True)):
+            yield chunk
+
+
+def _read_curl_headers(stream):
+    """从 curl -D - 的输出中读取最终响应（跳过重定向和 1xx）的状态码和响应头"""
+    while True:
+        status_line = stream.readline().decode('latin-1').strip()
+        match = re.match(r'HTTP/\S+\s+(\d+)', status_line)
+        if not match:
+            raise Exception(f"无法解析 curl 输出的响应头: {status_line!r}")
+        headers = {}
+        for line in iter(stream.readline, b''):
+            line = line.decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        status_code = int(match.group(1))
+        if status_code < 200 or 300 <= status_code < 400:
+            continue
+        return status_code, headers
+
+
+def _iter_range_curl(url, start, end):
+    """使用 curl 读取 [start, end] 字节范围（requests 的 SSL 模块不可用时使用）
+    
+    响应头（-D -）先于响应体输出，确认最终响应为 206 且范围一致后才产出数据。
+    """
+    process = subprocess.Popen(['curl', '-sfL', '-D', '-', '--connect-timeout', str(FILE_DOWNLOAD_TIMEOUT),
+                                '-r', f'{start}-{end}', url], stdout=subprocess.PIPE)
     try:
-        result = subprocess.run([
-            "wget", "-O", filename, url
-        ], capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
-        
-        if result.returncode == 0 and os.path.exists(filename):
-            print(f"✅ 下载完成: {filename}")
-            return True
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        # wget 不可用，静默继续
-        pass
+        status_code, headers = _read_curl_headers(process.stdout)
+        _check_range_response(status_code, headers.get('content-range'), start, end)
+        for chunk in _adaptive_chunks(process.stdout.read):
+            yield chunk
+        returncode = process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+    if returncode != 0:
+        raise Exception(f"curl 返回码 {returncode}")
+
+
+def _probe_download(url):
+    """探测文件大小和是否支持 Range
+    
+    Returns:
+        tuple: (文件大小, 是否支持分段下载)，无法探测时返回 (None, False)
+    """
+    try:
+        status_code, headers = get_transport().head(url)
+        ok = status_code == 200
+        size = int(headers.get('content-length') or 0)
+        ranged = (headers.get('accept-ranges') or '').lower() == 'bytes'
+        return (size, ranged) if ok and size else (None, False)
     except Exception:
-        # wget 执行失败，静默继续
+        return None, False
+
+
+def _load_download_state(state_file, url, size):
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('url') == url and state.get('size') == size:
+            return state
+    except (OSError, ValueError):
         pass
+    return None
+
+
+def _save_download_state(state_file, state):
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, state_file)
+
+
+def discard_partial_download(filename):
+    """删除未完成的分段下载文件和进度"""
+    for path in (filename + '.part', filename + '.part.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def download_segmented(url, filename, size, reader=_iter_range_requests, segments=FILE_DOWNLOAD_SEGMENTS):
+    """分段并行下载到预分配的 <filename>.part，完成后重命名为 filename
+    
+    每段的已完成位置定期写入 <filename>.part.json（只记录已刷新到磁盘的字节），
+    中断后再次调用（包括换用其他 reader）会从各段的断点继续。
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    
+    part_file = filename + '.part'
+    state_file = part_file + '.json'
+    state = _load_download_state(state_file, url, size)
+    if state is None or not os.path.exists(part_file) or os.path.getsize(part_file) != size:
+        count = max(1, min(segments, size // FILE_DOWNLOAD_MIN_SEGMENT))
+        step = -(-size // count)
+        state = {
+            'url': url,
+            'size': size,
+            # 每段为 [起始, 结束(含), 已完成位置]
+            'segments': [[start, min(start + step, size) - 1, start] for start in range(0, size, step)],
+        }
+        with open(part_file, 'wb') as f:
+            f.truncate(size)
+        _save_download_state(state_file, state)
+    else:
+        done = sum(pos - start for start, _, pos in state['segments'])
+        print(f"  继续上次的下载（已完成 {done * 100 // size}%）")
+    
+    lock = threading.Lock()
+    
+    def fetch(segment):
+        start, end, pos = segment
+        if pos > end:
+            return
+        with open(part_file, 'r+b') as f:
+            f.seek(pos)
+            unsaved = 0
+            for chunk in reader(url, pos, end):
+                chunk = chunk[:end - pos + 1]
+                f.write(chunk)
+                pos += len(chunk)
+                unsaved += len(chunk)
+                if unsaved >= FILE_DOWNLOAD_CHECKPOINT or pos > end:
+                    f.flush()
+                    with lock:
+                        segment[2] = pos
+                        _save_download_state(state_file, state)
+                    unsaved = 0
+                if pos > end:
+                    break
+        if pos <= end:
+            raise Exception(f"分段 {start}-{end} 未下载完整")
+    
+    pending = [segment for segment in state['segments'] if segment[2] <= segment[1]]
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+        for future in [pool.submit(fetch, segment) for segment in pending]:
+            future.result()
+    
+    os.replace(part_file, filename)
+    os.remove(state_file)
+
+
+def download_file(url, filename):
+    """下载文件 - 支持多种下载方法
+    
+    支持 Range 的服务器上先使用分段并行下载（requests 不可用时改用 curl 读取分段），
+    失败时保留进度供下次续传，并依次尝试其他下载方法。
+    """
+    print(f"正在下载: {url}")
+    
+    # 方法0: 分段并行下载（可续传）
+    transport = get_transport()
+    readers = []
+    if not transport.use_curl(url):
+        readers.append(_iter_range_requests)
+    if transport.has_curl:
+        readers.append(_iter_range_curl)
     
-    # 方法3: 尝试使用 curl
+    size, ranged = _probe_download(url)
+    if ranged and size:
+        for reader in readers:
+            try:
+                download_segmented(url, filename, size, reader)
+                print(f"✅ 下载完成: {filename}")
+                return True
+            except Exception:
+                # 静默失败，换用下一种方式继续未完成的分段
+                continue
+    
+    if _download_file_fallback(url, filename):
+        discard_partial_download(filename)
+        return True
+    return False
+
+
+def _download_file_fallback(url, filename):
+    """依次尝试 requests、wget、curl、PowerShell、urllib 和 HTTP 完整下载"""
+    transport = get_transport()
+    
+    # 方法1: 使用传输层（SSL不可用时直接使用curl）
     try:
-        result = subprocess.run([
-            "curl", "-L", "-o", filename, url
-        ], capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
-        
-        if result.returncode == 0 and os.path.exists(filename):
+        if transport.download(url, filename):
             print(f"✅ 下载完成: {filename}")
             return True
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        # curl 不可用，静默继续
-        pass
     except Exception:
-        # curl 执行失败，静默继续
+        # 静默失败，继续尝试其他方法
         pass
     
+    # 方法2: 尝试使用 wget
+    if transport.has_wget:
+        try:
+            result = subprocess.run([
+                "wget", "-O", filename, url
+            ], capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
+            
+            if result.returncode == 0 and os.path.exists(filename):
+                print(f"✅ 下载完成: {filename}")
+                return True
+        except Exception:
+            # wget 执行失败，静默继续
+            pass
+    
+    # 方法3: 尝试使用 curl（方法1未使用curl时）
+    if transport.has_curl and not transport.use_curl(url):
+        try:
+            result = subprocess.run([
+                "curl", "-L", "-o", filename, url
+            ], capture_output=True, text=True, encoding='utf-8', errors='replace', timeout=60)
+            
+            if result.returncode == 0 and os.path.exists(filename):
+                print(f"✅ 下载完成: {filename}")
+                return True
+        except Exception:
+            # curl 执行失败，静默继续
+            pass
+    
     # 方法3.5: Windows PowerShell 下载
     if sys.platform == "win32":
         try:
@@ -503,28 +1107,9 @@ def download_file(url, filename):
     if url.startswith("https://"):
         http_url = url.replace("https://", "http://")
         try:
-            try:
-                response = requests.get(http_url, stream=True, timeout=60)
-                response.raise_for_status()
-                
-                with open(filename, "wb") as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
+            if transport.download(http_url, filename):
                 print(f"✅ 下载完成: {filename}")
                 return True
-            except ImportError as e:
-                # SSL模块不可用，静默切换到curl下载
-                if "SSL module is not available" in str(e):
-                    result = subprocess.run([
-                        "curl", "-L", "-o", filename, http_url
-                    ], capture_output=True, text=True, timeout=60)
-                    
-                    if result.returncode == 0 and os.path.exists(filename):
-                        print(f"✅ 下载完成: {filename}")
-                        return True
-                else:
-                    raise
         except Exception:
             # HTTP 下载失败，静默继续
             pass
@@ -534,157 +1119,310 @@ def download_file(url, filename):
     return False
 
 
-def download_cloudflare_speedtest(os_type, arch_type):
-    """下载 CloudflareSpeedTest 可执行文件（优先使用反代版本）"""
-    # 优先检查反代版本
-    if os_type == "win":
-        proxy_exec_name = f"CloudflareST_proxy_{os_type}_{arch_type}.exe"
+def get_cache_dir():
+    """获取当前用户的缓存目录（可通过环境变量 CLOUDFLARE_SPEEDTEST_CACHE 指定）"""
+    custom = os.environ.get(BINARY_CACHE_ENV)
+    if custom:
+        return Path(custom)
+    if sys.platform == "win32":
+        base = os.environ.get('LOCALAPPDATA') or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
     else:
-        proxy_exec_name = f"CloudflareST_proxy_{os_type}_{arch_type}"
-    
-    if os.path.exists(proxy_exec_name):
-        print(f"✓ 使用反代版本: {proxy_exec_name}")
-        return proxy_exec_name
-    
-    # 检查是否已下载反代版本
-    print("反代版本不存在，开始下载反代版本...")
-    
-    # 构建下载URL - 使用您的GitHub仓库
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / ".cache"
+    return Path(base) / "cloudflare_speedtest"
+
+
+def get_proxy_exec_name(os_type, arch_type):
+    """获取反代版本可执行文件名"""
+    if os_type == "win":
+        return f"CloudflareST_proxy_{os_type}_{arch_type}.exe"
+    return f"CloudflareST_proxy_{os_type}_{arch_type}"
+
+
+def get_proxy_archive_name(os_type, arch_type):
+    """获取反代版本发布包文件名"""
     if os_type == "win":
         if arch_type == "amd64":
-            archive_name = "CloudflareST_proxy_windows_amd64.zip"
-        else:
-            archive_name = "CloudflareST_proxy_windows_386.zip"
+            return "CloudflareST_proxy_windows_amd64.zip"
+        return "CloudflareST_proxy_windows_386.zip"
     elif os_type == "darwin":
         if arch_type == "amd64":
-            archive_name = "CloudflareST_proxy_darwin_amd64.zip"
-        else:
-            archive_name = "CloudflareST_proxy_darwin_arm64.zip"
+            return "CloudflareST_proxy_darwin_amd64.zip"
+        return "CloudflareST_proxy_darwin_arm64.zip"
     else:  # linux
         if arch_type == "amd64":
-            archive_name = "CloudflareST_proxy_linux_amd64.tar.gz"
+            return "CloudflareST_proxy_linux_amd64.tar.gz"
         elif arch_type == "386":
-            archive_name = "CloudflareST_proxy_linux_386.tar.gz"
-        else:  # arm64
-            archive_name = "CloudflareST_proxy_linux_arm64.tar.gz"
-    
-    download_url = f"https://github.com/byJoey/CloudflareSpeedTest/releases/download/v1.0/{archive_name}"
-    
-    if not download_file(download_url, archive_name):
-        # 备用方案: 尝试 HTTP 下载
-        http_url = download_url.replace("https://", "http://")
-        if not download_file(http_url, archive_name):
-            # 所有自动下载都失败，提供手动下载说明
-            print("\n" + "="*60)
-            print("自动下载失败，请手动下载反代版本:")
-            print(f"下载地址: {download_url}")
-            print(f"解压后文件名应为: CloudflareST_proxy_{os_type}_{arch_type}{'.exe' if os_type == 'win' else ''}")
-            print("="*60)
-            
-            # 检查是否有手动下载的反代版本文件
-            if os_type == "win":
-                proxy_exec_name = f"CloudflareST_proxy_{os_type}_{arch_type}.exe"
-            else:
-                proxy_exec_name = f"CloudflareST_proxy_{os_type}_{arch_type}"
-            
-            if os.path.exists(proxy_exec_name):
-                print(f"找到手动下载的反代版本: {proxy_exec_name}")
-                # 手动下载的文件也需要赋予执行权限
-                if os_type != "win":
-                    os.chmod(proxy_exec_name, 0o755)
-                    print(f"已赋予执行权限: {proxy_exec_name}")
-                return proxy_exec_name
-            else:
-                print("未找到反代版本文件，程序无法继续")
-                if sys.platform == "win32":
-                    input("按 Enter 键退出...")
-                sys.exit(1)
-    else:
-        # 解压文件
-        print(f"正在解压: {archive_name}")
-        try:
-            if archive_name.endswith('.zip'):
-                import zipfile
-                with zipfile.ZipFile(archive_name, 'r') as zip_ref:
-                    zip_ref.extractall('.')
-            elif archive_name.endswith('.tar.gz'):
-                import tarfile
-                with tarfile.open(archive_name, 'r:gz') as tar_ref:
-                    tar_ref.extractall('.')
-            
-            # 查找反代版本可执行文件
-            found_executable = None
-            for root, dirs, files in os.walk('.'):
-                for file in files:
-                    if file.startswith('CloudflareST_proxy_') and not file.endswith(('.zip', '.tar.gz')):
-                        found_executable = os.path.join(root, file)
-                        break
-                if found_executable:
-                    break
-            
-            if found_executable:
-                # 获取最终文件名 - 使用标准格式
-                if os_type == "win":
-                    final_name = f"CloudflareST_proxy_{os_type}_{arch_type}.exe"
-                else:
-                    final_name = f"CloudflareST_proxy_{os_type}_{arch_type}"
-                
-                # 如果文件不在当前目录或文件名不匹配，移动到当前目录并重命名
-                if os.path.abspath(found_executable) != os.path.abspath(final_name):
-                    if os.path.exists(final_name):
-                        os.remove(final_name)
-                    # 确保源文件存在
-                    if os.path.exists(found_executable):
-                        os.rename(found_executable, final_name)
-                    else:
-                        print(f"❌ 源文件不存在: {found_executable}")
-                        if sys.platform == "win32":
-                            input("按 Enter 键退出...")
-                        sys.exit(1)
-                
-                # 设置执行权限
-                if os_type != "win":
-                    os.chmod(final_name, 0o755)
-                
-                print(f"✓ 反代版本设置完成: {final_name}")
-                return final_name
-            else:
-                print("解压后未找到反代版本可执行文件")
-                # 列出解压后的所有文件用于调试
-                print("解压后的文件:")
-                for root, dirs, files in os.walk('.'):
-                    for file in files:
-                        if not file.endswith(('.zip', '.tar.gz', '.txt', '.md')):
-                            print(f"  - {os.path.join(root, file)}")
-                if sys.platform == "win32":
-                    input("按 Enter 键退出...")
-                sys.exit(1)
-            
-            # 清理压缩包
-            os.remove(archive_name)
-            
-        except Exception as e:
-            print(f"解压失败: {e}")
-            if sys.platform == "win32":
-                input("按 Enter 键退出...")
-            sys.exit(1)
-    
-    # 在Unix系统上赋予执行权限
-    if os_type != "win":
-        os.chmod(proxy_exec_name, 0o755)
-        print(f"已赋予执行权限: {proxy_exec_name}")
-    
-    return proxy_exec_name
+            return "CloudflareST_proxy_linux_386.tar.gz"
+        return "CloudflareST_proxy_linux_arm64.tar.gz"
 
 
-def select_ip_version():
-    """选择IP版本（IPv4或IPv6）"""
-    print("\n" + "=" * 60)
-    print(" IP 版本选择")
-    print("=" * 60)
-    print("  1. IPv4 - 测试 IPv4 地址（推荐，兼容性最好）")
-    print("  2. IPv6 - 测试 IPv6 地址（需要本地网络支持IPv6）")
-    print("=" * 60)
+def speedtest_command(exec_name):
+    """构建运行测速程序的命令前缀（Unix 上当前目录下的相对路径需要加 ./）"""
+    if sys.platform == "win32" or os.path.isabs(exec_name):
+        return [exec_name]
+    return [f"./{exec_name}"]
+
+
+def _file_sha256(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch_release_digests(version=PROXY_RELEASE_VERSION):
+    """获取发布页公布的各个发布包的 SHA-256
+    
+    Returns:
+        dict: {发布包文件名: SHA-256 十六进制}，无法获取时返回空 dict
+    """
+    try:
+        status, _, text = get_transport().get(f"{PROXY_RELEASE_API_URL}/{version}",
+                                              headers={'Accept': 'application/vnd.github+json'})
+        if status != 200:
+            return {}
+        assets = json.loads(text).get('assets', [])
+    except Exception:
+        return {}
+    digests = {}
+    for asset in assets:
+        algorithm, _, value = (asset.get('digest') or '').partition(':')
+        if algorithm == 'sha256' and value:
+            digests[asset['name']] = value.lower()
+    return digests
+
+
+def verify_release_archive(archive_path, archive_name):
+    """将下载的发布包与发布页公布的 SHA-256 比对，无法获取公布的 SHA-256 时视为失败
+    
+    Returns:
+        bool: 校验通过时返回 True
+    """
+    expected = fetch_release_digests().get(archive_name)
+    if not expected:
+        print("❌ 无法获取发布页公布的 SHA-256，拒绝安装未经校验的发布包")
+        return False
+    actual = _file_sha256(archive_path)
+    if actual != expected:
+        print(f"❌ 发布包校验失败: SHA-256 为 {actual}，发布页公布的是 {expected}")
+        return False
+    print("✓ 发布包 SHA-256 校验通过")
+    return True
+
+
+def _load_binary_index(cache_dir):
+    try:
+        with open(cache_dir / BINARY_INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_binary_index(cache_dir, index):
+    tmp_file = cache_dir / (BINARY_INDEX_FILE + ".tmp")
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_file, cache_dir / BINARY_INDEX_FILE)
+
+
+def lookup_cached_binary(cache_key, cache_dir=None):
+    """查找缓存中的测速程序
+    
+    文件大小和修改时间与索引一致时直接命中（只需一次 stat）；不一致时重新计算
+    SHA-256，校验失败的缓存会被丢弃。
+    
+    Returns:
+        str: 可执行文件的绝对路径，未命中时返回 None
+    """
+    cache_dir = Path(cache_dir or get_cache_dir())
+    index = _load_binary_index(cache_dir)
+    entry = index.get(cache_key)
+    if not entry:
+        return None
+    
+    path = cache_dir / entry['path']
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    if stat.st_size == entry.get('size') and stat.st_mtime_ns == entry.get('mtime_ns'):
+        return str(path)
+    
+    if stat.st_size == entry.get('size') and _file_sha256(path) == entry['sha256']:
+        entry['mtime_ns'] = stat.st_mtime_ns
+        _save_binary_index(cache_dir, index)
+        return str(path)
+    
+    print(f"⚠️  缓存的测速程序校验失败，将重新下载: {path}")
+    del index[cache_key]
+    _save_binary_index(cache_dir, index)
+    return None
+
+
+def _find_archive_member(archive_path):
+    """在发布包中查找反代版本可执行文件，返回 (文件名, 读取函数)"""
+    def is_executable(name):
+        base = os.path.basename(name)
+        return base.startswith('CloudflareST_proxy_') and not base.endswith(('.zip', '.tar.gz'))
+    
+    if str(archive_path).endswith('.zip'):
+        import zipfile
+        archive = zipfile.ZipFile(archive_path, 'r')
+        for info in archive.infolist():
+            if not info.is_dir() and is_executable(info.filename):
+                return archive, info.filename, lambda: archive.open(info)
+    else:
+        import tarfile
+        archive = tarfile.open(archive_path, 'r:gz')
+        for member in archive:
+            if member.isfile() and is_executable(member.name):
+                return archive, member.name, lambda: archive.extractfile(member)
+    archive.close()
+    return None, None, None
+
+
+def install_binary_from_archive(archive_path, cache_key, exec_name, cache_dir=None):
+    """从发布包中只解压测速程序到缓存（objects/<sha256>/<exec_name>）并登记索引
+    
+    Returns:
+        str: 可执行文件的绝对路径，发布包中没有测速程序时返回 None
+    """
+    import hashlib
+    import shutil
+    
+    cache_dir = Path(cache_dir or get_cache_dir())
+    objects_dir = cache_dir / "objects"
+    objects_dir.mkdir(parents=True, exist_ok=True)
+    
+    archive, member_name, open_member = _find_archive_member(archive_path)
+    if not archive:
+        return None
+    
+    tmp_file = objects_dir / f".{exec_name}.{os.getpid()}.tmp"
+    digest = hashlib.sha256()
+    try:
+        with archive, open_member() as src, open(tmp_file, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        
+        sha256 = digest.hexdigest()
+        target = objects_dir / sha256 / exec_name
+        target.parent.mkdir(exist_ok=True)
+        shutil.move(str(tmp_file), str(target))
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+    
+    if not exec_name.endswith('.exe'):
+        os.chmod(target, 0o755)
+    
+    stat = target.stat()
+    index = _load_binary_index(cache_dir)
+    index[cache_key] = {
+        'path': str(target.relative_to(cache_dir)),
+        'sha256': sha256,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'source': member_name,
+    }
+    _save_binary_index(cache_dir, index)
+    return str(target)
+
+
+# 本进程内已确认可用的测速程序路径（再次调用时无需任何文件操作）
+_resolved_binaries = {}
+
+
+def download_cloudflare_speedtest(os_type, arch_type):
+    """获取 CloudflareSpeedTest 可执行文件（优先使用反代版本）
+    
+    查找顺序：本进程已确认的路径 → 当前目录中手动放置的文件 → 用户缓存目录 → 下载。
+    
+    Returns:
+        str: 可执行文件路径（当前目录中的文件为相对路径，缓存中的为绝对路径）；
+            平台不受支持或下载、解压失败时返回 None
+    """
+    if not os_type or not arch_type:
+        print("当前平台没有可用的测速程序")
+        return None
+    cache_key = f"{PROXY_RELEASE_VERSION}/{os_type}_{arch_type}"
+    if cache_key in _resolved_binaries:
+        return _resolved_binaries[cache_key]
+    
+    proxy_exec_name = get_proxy_exec_name(os_type, arch_type)
+    
+    # 当前目录中已有的反代版本（手动放置或旧版本下载）优先
+    if os.path.exists(proxy_exec_name):
+        print(f"✓ 使用反代版本: {proxy_exec_name}")
+        _resolved_binaries[cache_key] = proxy_exec_name
+        return proxy_exec_name
+    
+    cached = lookup_cached_binary(cache_key)
+    if cached:
+        print(f"✓ 使用缓存的反代版本: {cached}")
+        _resolved_binaries[cache_key] = cached
+        return cached
+    
+    print("反代版本不存在，开始下载反代版本...")
+    
+    archive_name = get_proxy_archive_name(os_type, arch_type)
+    download_url = f"{PROXY_RELEASE_URL}/{PROXY_RELEASE_VERSION}/{archive_name}"
+    downloads_dir = get_cache_dir() / "downloads"
+    downloads_dir.mkdir(parents=True, exist_ok=True)
+    archive_path = str(downloads_dir / archive_name)
+    
+    if not download_file(download_url, archive_path):
+        # 备用方案: 尝试 HTTP 下载（无法防篡改，依靠下面与公布的 SHA-256 比对）
+        http_url = download_url.replace("https://", "http://")
+        if not download_file(http_url, archive_path):
+            # 所有自动下载都失败，提供手动下载说明
+            print("\n" + "="*60)
+            print("自动下载失败，请手动下载反代版本:")
+            print(f"下载地址: {download_url}")
+            print(f"解压后放到当前目录，文件名应为: {proxy_exec_name}")
+            print("="*60)
+            return None
+    
+    # 下载损坏、被篡改或无法校验的发布包不安装
+    if not verify_release_archive(archive_path, archive_name):
+        os.remove(archive_path)
+        print(f"可手动下载 {download_url}，解压后放到当前目录（文件名: {proxy_exec_name}）")
+        return None
+    
+    # 只解压需要的可执行文件到缓存目录
+    print(f"正在解压: {archive_name}")
+    try:
+        final_name = install_binary_from_archive(archive_path, cache_key, proxy_exec_name)
+    except Exception as e:
+        print(f"解压失败: {e}")
+        return None
+    finally:
+        # 清理压缩包
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+    
+    if not final_name:
+        print("解压后未找到反代版本可执行文件")
+        return None
+    
+    print(f"✓ 反代版本设置完成: {final_name}")
+    _resolved_binaries[cache_key] = final_name
+    return final_name
+
+
+def select_ip_version():
+    """选择IP版本（IPv4或IPv6）"""
+    print("\n" + "=" * 60)
+    print(" IP 版本选择")
+    print("=" * 60)
+    print("  1. IPv4 - 测试 IPv4 地址（推荐，兼容性最好）")
+    print("  2. IPv6 - 测试 IPv6 地址（需要本地网络支持IPv6）")
+    print("=" * 60)
     
     while True:
         choice = input("\n请选择 IP 版本 [1/2，默认：1]: ").strip()
@@ -698,37 +1436,412 @@ def select_ip_version():
             print("✗ 请输入 1 或 2")
 
 
+def _ip_list_meta_file(ip_file):
+    """IP列表的验证信息文件（ETag、Last-Modified、上次检查时间）"""
+    return ip_file + ".meta.json"
+
+
+def _load_ip_list_meta(ip_file):
+    try:
+        with open(_ip_list_meta_file(ip_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_ip_list_meta(ip_file, meta):
+    meta_file = _ip_list_meta_file(ip_file)
+    tmp_file = meta_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, meta_file)
+
+
+def read_ip_prefixes(ip_file):
+    """读取IP列表文件中的地址段（忽略空行和注释）"""
+    with open(ip_file, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def parse_ip_prefixes(text, version):
+    """校验下载到的IP列表，每行必须是指定版本的地址段
+    
+    Raises:
+        ValueError: 内容不是有效的地址段列表（例如被劫持返回的网页）
+    """
+    prefixes = [line.strip() for line in text.splitlines() if line.strip()]
+    if not prefixes:
+        raise ValueError("IP列表为空")
+    for prefix in prefixes:
+        if ipaddress.ip_network(prefix, strict=False).version != version:
+            raise ValueError(f"地址段版本不符: {prefix}")
+    return prefixes
+
+
+def with_builtin_ipv6_subnets(prefixes):
+    """在官方 IPv6 地址段后追加仍被其覆盖的内置详细子网段（采样时命中率更高）"""
+    networks = [ipaddress.ip_network(p, strict=False) for p in prefixes]
+    extra = []
+    for subnet in CLOUDFLARE_IPV6_RANGES:
+        network = ipaddress.ip_network(subnet, strict=False)
+        if subnet not in prefixes and network not in networks and any(network.subnet_of(n) for n in networks):
+            extra.append(subnet)
+    return prefixes + extra
+
+
+def refresh_cloudflare_ips(ip_version="ipv4", ip_file=None, force=False):
+    """使用条件请求（If-None-Match / If-Modified-Since）重新验证 Cloudflare IP 列表
+    
+    验证信息保存在 <ip_file>.meta.json 中；服务器返回 304 或内容未变化时不改写文件，
+    有变化时原子地替换文件并打印新增/移除的地址段。meta 中记录了本程序写入内容的 SHA-256，
+    文件内容与之不符（手动编辑过或由旧版本生成）时视为用户维护的列表，不再自动更新。
+    
+    Args:
+        ip_version: IP版本 ("ipv4" 或 "ipv6")
+        ip_file: IP文件路径，默认为对应版本的内置文件名
+        force: 忽略 IP_LIST_CHECK_INTERVAL 和手动编辑检查，立即重新验证
+    
+    Returns:
+        tuple: (新增地址段列表, 移除地址段列表)，未检查或未变化时均为空
+    
+    Raises:
+        OSError / ValueError: 请求失败或返回内容无效
+    """
+    if ip_version == "ipv6":
+        url, version, ip_file = CLOUDFLARE_IPV6_URL, 6, ip_file or CLOUDFLARE_IPV6_FILE
+    else:
+        url, version, ip_file = CLOUDFLARE_IP_URL, 4, ip_file or CLOUDFLARE_IP_FILE
+    
+    exists = os.path.exists(ip_file)
+    meta = _load_ip_list_meta(ip_file) if exists else {}
+    if not force and exists:
+        if time.time() - meta.get('checked_at', 0) < IP_LIST_CHECK_INTERVAL:
+            return [], []
+        if meta.get('sha256') != _file_sha256(ip_file):
+            return [], []
+    
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    
+    try:
+        status, response_headers, text = get_transport().get(
+            url, headers=headers, timeout=IP_LIST_CHECK_TIMEOUT if exists else 15)
+    except Exception as e:
+        raise OSError(f"请求 {url} 失败: {e}")
+    
+    if status == 304 and exists:
+        meta['checked_at'] = time.time()
+        _save_ip_list_meta(ip_file, meta)
+        return [], []
+    if status != 200:
+        raise OSError(f"请求 {url} 失败: HTTP {status}")
+    
+    prefixes = parse_ip_prefixes(text, version)
+    if version == 6:
+        prefixes = with_builtin_ipv6_subnets(prefixes)
+    old_prefixes = read_ip_prefixes(ip_file) if exists else []
+    old_set, new_set = set(old_prefixes), set(prefixes)
+    added = [p for p in prefixes if p not in old_set]
+    removed = [p for p in old_prefixes if p not in new_set]
+    
+    if not exists or added or removed:
+        tmp_file = ip_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(prefixes) + '\n')
+        os.replace(tmp_file, ip_file)
+    
+    _save_ip_list_meta(ip_file, {
+        'url': url,
+        'etag': response_headers.get('etag'),
+        'last_modified': response_headers.get('last-modified'),
+        'checked_at': time.time(),
+        'sha256': _file_sha256(ip_file),
+    })
+    return (added, removed) if exists else ([], [])
+
+
+def print_prefix_changes(added, removed):
+    for prefix in added:
+        print(f"   + {prefix}")
+    for prefix in removed:
+        print(f"   - {prefix}")
+
+
 def download_cloudflare_ips(ip_version="ipv4", ip_file=CLOUDFLARE_IP_FILE):
-    """下载或生成 Cloudflare IP 列表
+    """下载或重新验证 Cloudflare IP 列表
+    
+    已有文件超过 IP_LIST_CHECK_INTERVAL 未验证时发送条件请求，只有列表变化时才改写；
+    手动编辑过的文件不会被覆盖；网络不可用时在 IP_LIST_CHECK_TIMEOUT 内回退到已有文件。
     
     Args:
         ip_version: IP版本 ("ipv4" 或 "ipv6")
         ip_file: IP文件路径
     """
-    # 检查文件是否已存在
-    if os.path.exists(ip_file):
-        print(f"✅ 使用已有IP文件: {ip_file}")
+    exists = os.path.exists(ip_file)
+    if not exists:
+        print(f"正在下载 Cloudflare {'IPv6' if ip_version == 'ipv6' else 'IPv4'} 列表...")
+    
+    try:
+        added, removed = refresh_cloudflare_ips(ip_version, ip_file)
+    except (OSError, ValueError) as e:
+        if exists:
+            print(f"⚠️  IP列表更新检查失败（{e}），继续使用已有文件: {ip_file}")
+            return True
+        if ip_version == "ipv6":
+            # 下载失败时 IPv6 使用内置地址段生成
+            print(f"下载 Cloudflare IPv6 列表失败（{e}），使用内置地址段")
+            if not generate_ipv6_file():
+                return False
+            # 记录内容摘要但不记录检查时间，网络恢复后下次启动即可更新为官方列表
+            _save_ip_list_meta(CLOUDFLARE_IPV6_FILE, {'sha256': _file_sha256(CLOUDFLARE_IPV6_FILE)})
+            return True
+        print(f"下载 Cloudflare IP 列表失败: {e}")
+        return False
+    
+    if not exists:
+        print(f"Cloudflare IP 列表已保存到: {ip_file}（共 {len(read_ip_prefixes(ip_file))} 个地址段）")
         return True
     
-    if ip_version == "ipv6":
-        # IPv6 使用内置地址段生成
-        print("正在生成 Cloudflare IPv6 地址列表...")
-        return generate_ipv6_file()
+    if added or removed:
+        print(f"🔄 IP列表已更新: {ip_file}（新增 {len(added)} 个，移除 {len(removed)} 个地址段）")
+        print_prefix_changes(added, removed)
     else:
-        # IPv4 从网络下载
-        print("正在下载 Cloudflare IPv4 列表...")
+        print(f"✅ 使用已有IP文件: {ip_file}")
+    return True
+
+
+class _DeferredOutput:
+    """后台线程的输出缓冲：先暂存，主线程取结果时一次性输出，之后直接输出"""
+    
+    def __init__(self, stream):
+        import threading
+        self._stream = stream
+        self._parts = []
+        self._lock = threading.Lock()
+        self._live = False
+    
+    def write(self, text):
+        with self._lock:
+            if self._live:
+                return self._stream.write(text)
+            self._parts.append(text)
+        return len(text)
+    
+    def flush(self):
+        with self._lock:
+            if self._live:
+                self._stream.flush()
+    
+    def release(self):
+        """输出已暂存的内容，并切换为直接输出"""
+        with self._lock:
+            self._stream.write(''.join(self._parts))
+            self._stream.flush()
+            self._parts = []
+            self._live = True
+
+
+class _ThreadOutputRouter:
+    """sys.stdout 代理：登记了缓冲区的线程写入各自的缓冲区，其余线程照常输出
+    
+    后台预取在用户回答提示时运行，它的进度输出不能插进提示文字中间。
+    """
+    
+    def __init__(self, stream):
+        import threading
+        self._stream = stream
+        self._local = threading.local()
+    
+    def _target(self):
+        return getattr(self._local, 'output', None) or self._stream
+    
+    def write(self, text):
+        return self._target().write(text)
+    
+    def flush(self):
+        self._target().flush()
+    
+    def buffer(self):
+        """创建一个输出缓冲区"""
+        return _DeferredOutput(self._stream)
+    
+    def capture(self, output):
+        """让当前线程的输出写入 output"""
+        self._local.output = output
+    
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _output_router():
+    """在 sys.stdout 上安装输出代理（只安装一次）"""
+    if not isinstance(sys.stdout, _ThreadOutputRouter):
+        sys.stdout = _ThreadOutputRouter(sys.stdout)
+    return sys.stdout
+
+
+def _restore_output():
+    """卸下 sys.stdout 上的输出代理（仍在运行的后台任务此后直接输出）"""
+    if isinstance(sys.stdout, _ThreadOutputRouter):
+        sys.stdout = sys.stdout._stream
+
+
+class PrefetchTask:
+    """可在后台线程中提前执行的任务，结果（包括异常）只计算一次
+    
+    未启动时，第一次取结果会在当前线程中直接执行；已在后台启动时则等待其完成。
+    后台线程的输出在主线程取结果时才显示，等待期间的后续输出直接显示。
+    """
+    
+    def __init__(self, func, *args):
+        import threading
+        self._func = func
+        self._args = args
+        self._lock = threading.Lock()
+        self._done = False
+        self._value = None
+        self._error = None
+        self._thread = None
+        self._output = None
+    
+    def start(self):
+        import threading
+        router = _output_router()
+        self._output = router.buffer()
         
-        if not download_file(CLOUDFLARE_IP_URL, CLOUDFLARE_IP_FILE):
-            print("下载 Cloudflare IP 列表失败")
-            return False
+        def run():
+            router.capture(self._output)
+            self._run()
         
-        # 检查文件是否为空
-        if os.path.getsize(CLOUDFLARE_IP_FILE) == 0:
-            print("Cloudflare IP 列表文件为空")
-            return False
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return self
+    
+    def _run(self):
+        with self._lock:
+            if self._done:
+                return
+            try:
+                self._value = self._func(*self._args)
+            except BaseException as e:
+                # 后台线程中不打印回溯，异常交给取结果的线程重新抛出
+                self._error = e
+            self._done = True
+    
+    def done(self):
+        return self._done
+    
+    def result(self):
+        import threading
+        if self._thread is None:
+            self._run()
+        else:
+            if threading.current_thread() is threading.main_thread():
+                self._output.release()
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class RunContext:
+    """一次运行的共享环境：平台、测速程序、IP列表和传输层各只解析一次
+    
+    main() 和无人值守模式各创建一个上下文并传给所有模式，避免各处重复检测系统、
+    重复查找/下载测速程序；同一进程内的多次测试可以共用同一个上下文。
+    """
+    
+    def __init__(self, ip_version="ipv4", ip_file=None):
+        self.ip_version = ip_version
+        self.ip_file = ip_file or (CLOUDFLARE_IPV6_FILE if ip_version == "ipv6" else CLOUDFLARE_IP_FILE)
+        import threading
+        self._platform = None
+        self._tasks = {}
+        self._tasks_lock = threading.Lock()
+        # 本轮地区扫描结果上已补充扫描过的地区，扫描结果重新扫描或刷新之前不再补充
+        self.drilled_colos = set()
+    
+    def _task(self, key, func, *args):
+        """获取（必要时创建）某项资源的解析任务，保证每项资源只解析一次"""
+        with self._tasks_lock:
+            task = self._tasks.get(key)
+            if task is None:
+                task = self._tasks[key] = PrefetchTask(func, *args)
+            return task
+    
+    def prefetch(self):
+        """在后台启动下载测速程序和 IPv4 列表，与用户回答提示的时间重叠
         
-        print(f"Cloudflare IP 列表已保存到: {CLOUDFLARE_IP_FILE}")
-        return True
+        只预取各模式都可能用到、且只占用少量带宽的下载；地区扫描会与测速争用网络，
+        在用户选择常规测速之后才进行。交互步骤需要这些结果时再等待对应的任务。
+        """
+        # 系统检测很快且失败时需要交互，在主线程中完成
+        self.platform
+        self._task("binary", self._resolve_binary).start()
+        self._task(f"ip:{CLOUDFLARE_IP_FILE}", self._resolve_ip_list, "ipv4", CLOUDFLARE_IP_FILE).start()
+    
+    def invalidate_ip_lists(self):
+        """下次使用IP列表时重新检查（无人值守模式每轮调用，列表仍受 IP_LIST_CHECK_INTERVAL 限制）"""
+        with self._tasks_lock:
+            for key in [k for k in self._tasks if k.startswith("ip:")]:
+                del self._tasks[key]
+    
+    @property
+    def platform(self):
+        """(os_type, arch_type)"""
+        if self._platform is None:
+            self._platform = get_system_info()
+        return self._platform
+    
+    @property
+    def exec_name(self):
+        """测速程序路径（首次访问时查找或下载，不可用时为 None）"""
+        return self.prepare_binary()
+    
+    def prepare_binary(self):
+        """查找或下载测速程序，只执行一次"""
+        return self._task("binary", self._resolve_binary).result()
+    
+    def _resolve_binary(self):
+        return download_cloudflare_speedtest(*self.platform)
+    
+    @property
+    def transport(self):
+        return get_transport()
+    
+    def command(self):
+        """测速程序的命令前缀，测速程序不可用时返回 None"""
+        exec_name = self.exec_name
+        if not exec_name:
+            return None
+        return speedtest_command(exec_name)
+    
+    def prepare_ip_list(self, ip_version=None):
+        """确保IP列表文件存在（每个文件只检查/下载一次）
+        
+        Args:
+            ip_version: 默认为本次运行选择的版本；地区扫描等固定使用 IPv4 列表的地方传入 "ipv4"
+        
+        Returns:
+            str: IP文件路径，准备失败时返回 None
+        """
+        if ip_version is None or ip_version == self.ip_version:
+            ip_version, ip_file = self.ip_version, self.ip_file
+        else:
+            ip_file = CLOUDFLARE_IPV6_FILE if ip_version == "ipv6" else CLOUDFLARE_IP_FILE
+        return self._task(f"ip:{ip_file}", self._resolve_ip_list, ip_version, ip_file).result()
+    
+    def _resolve_ip_list(self, ip_version, ip_file):
+        if ip_file in (CLOUDFLARE_IP_FILE, CLOUDFLARE_IPV6_FILE):
+            ready = download_cloudflare_ips(ip_version, ip_file)
+        else:
+            ready = os.path.exists(ip_file)
+            if not ready:
+                print(f"❌ 未找到IP文件: {ip_file}")
+        return ip_file if ready else None
 
 
 def load_local_airport_codes():
@@ -882,11 +1995,11 @@ def display_preset_configs():
     print("=" * 60)
 
 
-def get_user_input(ip_file=CLOUDFLARE_IP_FILE):
+def get_user_input(ctx):
     """获取用户输入参数
     
     Args:
-        ip_file: 要使用的IP文件路径
+        ctx: 本次运行的 RunContext
     """
     # 询问功能选择
     print("\n" + "=" * 60)
@@ -895,6 +2008,7 @@ def get_user_input(ip_file=CLOUDFLARE_IP_FILE):
     print("  1. 小白快速测试 - 简单输入，适合新手")
     print("  2. 常规测速 - 测试指定机场码的IP速度")
     print("  3. 优选反代 - 从CSV文件生成反代IP列表")
+    print("  4. 原生TCPing - 内置引擎测延迟，无需测速程序")
     print("=" * 60)
     
     choice = input("\n请选择功能 [默认: 1]: ").strip()
@@ -903,13 +2017,16 @@ def get_user_input(ip_file=CLOUDFLARE_IP_FILE):
     
     if choice == "1":
         # 小白快速测试模式
-        return handle_beginner_mode(ip_file)
+        return handle_beginner_mode(ctx)
     elif choice == "3":
         # 优选反代模式
-        return handle_proxy_mode()
+        return handle_proxy_mode(ctx)
+    elif choice == "4":
+        # 原生TCPing模式
+        return handle_native_tcping_mode(ctx)
     else:
         # 常规测速模式
-        return handle_normal_mode(ip_file)
+        return handle_normal_mode(ctx)
 
 
 def select_csv_file():
@@ -934,7 +2051,7 @@ def select_csv_file():
 
 
 
-def handle_proxy_mode():
+def handle_proxy_mode(ctx):
     """处理优选反代模式"""
     print("\n" + "=" * 70)
     print(" 优选反代模式")
@@ -1086,10 +2203,15 @@ def handle_proxy_mode():
         print("模式: 反代IP列表测速")
         
         # 运行测速
-        result_code = run_speedtest_with_file("ips_ports.txt", dn_count, speed_limit, time_limit)
+        if confirm_goal_mode():
+            result_code = run_goal_speedtest(iter_probe_targets("ips_ports.txt"), dn_count, speed_limit, time_limit,
+                                             resume=confirm_resume("result.csv", "goal"), source="ips_ports.txt")
+        else:
+            result_code = run_speedtest_with_file(ctx, "ips_ports.txt", dn_count, speed_limit, time_limit)
         
         # 如果测速成功，询问是否上报结果
         if result_code == 0 and os.path.exists("result.csv"):
+            ingest_result_file("result.csv")
             upload_results_to_api("result.csv")
         
         return None, None, None, None
@@ -1098,11 +2220,11 @@ def handle_proxy_mode():
         return None, None, None, None
 
 
-def handle_beginner_mode(ip_file=CLOUDFLARE_IP_FILE):
+def handle_beginner_mode(ctx):
     """处理小白快速测试模式
     
     Args:
-        ip_file: 要使用的IP文件路径
+        ctx: 本次运行的 RunContext
     """
     print("\n" + "=" * 70)
     print(" 小白快速测试模式")
@@ -1191,15 +2313,20 @@ def handle_beginner_mode(ip_file=CLOUDFLARE_IP_FILE):
     # 直接使用 Cloudflare IP 列表进行测速
     print(f"\n正在使用 Cloudflare IP 列表进行测速...")
     
-    # 获取系统信息和可执行文件
-    os_type, arch_type = get_system_info()
-    exec_name = download_cloudflare_speedtest(os_type, arch_type)
+    ip_file = ctx.ip_file
+    
+    # IPv6 地址段过大，由本地按 /64 分层抽样展开，避免 CloudflareST 不可控的稀疏随机取样
+    if ip_file == CLOUDFLARE_IPV6_FILE:
+        count = export_candidates(ip_file, CANDIDATE_FILE)
+        print(f"已从 IPv6 地址段中分层抽取 {count} 个候选IP")
+        ip_file = CANDIDATE_FILE
     
     # 构建测速命令
-    if sys.platform == "win32":
-        cmd = [exec_name]
-    else:
-        cmd = [f"./{exec_name}"]
+    cmd = ctx.command()
+    if cmd is None:
+        print(f"\n{BINARY_UNAVAILABLE_HINT}")
+        return "ALL", dn_count, speed_limit, time_limit
+    ip_file = with_warm_start_ips(ip_file)
     
     cmd.extend([
         "-f", ip_file,
@@ -1213,7 +2340,7 @@ def handle_beginner_mode(ip_file=CLOUDFLARE_IP_FILE):
     print("=" * 50)
     
     # 运行测速
-    result = subprocess.run(cmd, encoding='utf-8', errors='replace')
+    result = run_speedtest_streaming(cmd)
     
     if result.returncode == 0:
         print("\n✅ 测速完成！结果已保存到 result.csv")
@@ -1221,6 +2348,7 @@ def handle_beginner_mode(ip_file=CLOUDFLARE_IP_FILE):
         print("💡 提示：结果文件中的IP按速度从快到慢排序")
         
         # 询问是否上报结果
+        ingest_result_file("result.csv")
         upload_results_to_api("result.csv")
     else:
         print("\n❌ 测速失败")
@@ -1228,17 +2356,17 @@ def handle_beginner_mode(ip_file=CLOUDFLARE_IP_FILE):
     return "ALL", dn_count, speed_limit, time_limit
 
 
-def handle_normal_mode(ip_file=CLOUDFLARE_IP_FILE):
+def handle_normal_mode(ctx):
     """处理常规测速模式
     
     Args:
-        ip_file: 要使用的IP文件路径
+        ctx: 本次运行的 RunContext
     """
     print("\n开始检测可用地区...")
     print("正在使用HTTPing模式检测各地区可用性...")
     
     # 先运行一次HTTPing检测，获取可用地区
-    available_regions = detect_available_regions()
+    available_regions = detect_available_regions(ctx)
     
     if not available_regions:
         print("❌ 未检测到可用地区，请检查网络连接")
@@ -1248,21 +2376,32 @@ def handle_normal_mode(ip_file=CLOUDFLARE_IP_FILE):
     for i, (region_code, region_name, count) in enumerate(available_regions, 1):
         print(f"  {i}. {region_code} - {region_name} (可用{count}个IP)")
     
-    # 让用户选择地区
+    # 让用户选择地区（支持多选）
+    print("\n提示: 可输入多个序号或机场码（逗号分隔），或输入大区名（如 亚太）同时测试多个地区")
     while True:
-        try:
-            choice = int(input(f"\n请选择地区 [1-{len(available_regions)}]: ").strip())
-            if 1 <= choice <= len(available_regions):
-                selected_region = available_regions[choice - 1]
-                cfcolo = selected_region[0]
-                region_name = selected_region[1]
-                count = selected_region[2]
-                print(f"✓ 已选择: {region_name} ({cfcolo}) - 可用{count}个IP")
-                break
-            else:
-                print(f"✗ 请输入 1-{len(available_regions)} 之间的数字")
-        except ValueError:
-            print("✗ 请输入有效的数字")
+        choice = input(f"\n请选择地区 [1-{len(available_regions)}]: ").strip()
+        selected_colos = parse_region_selection(choice, available_regions)
+        if selected_colos:
+            break
+        print(f"✗ 请输入 1-{len(available_regions)} 之间的数字、机场码或大区名")
+    
+    region_info = {code: (name, count) for code, name, count in available_regions}
+    
+    # 地区扫描是抽样的，所选地区IP较少时只针对这些地区补充扫描
+    sparse = [colo for colo in selected_colos if region_info[colo][1] < REGION_DRILL_TARGET]
+    if sparse and os.path.exists(REGION_SCAN_FILE):
+        choice = input(f"{', '.join(sparse)} 的IP少于 {REGION_DRILL_TARGET} 个，是否针对所选地区补充扫描？[Y/n]: ")
+        if choice.strip().lower() not in ('n', 'no'):
+            ip_file = ctx.prepare_ip_list("ipv4") or CLOUDFLARE_IP_FILE
+            for colo in sparse:
+                found = drill_region(colo, ip_file)
+                region_name, count = region_info[colo]
+                region_info[colo] = (region_name, count + found)
+    
+    for colo in selected_colos:
+        region_name, count = region_info[colo]
+        print(f"✓ 已选择: {region_name} ({colo}) - 可用{count}个IP")
+    cfcolo = selected_colos[0]
     
     # 显示预设配置选项
     display_preset_configs()
@@ -1353,42 +2492,48 @@ def handle_normal_mode(ip_file=CLOUDFLARE_IP_FILE):
         else:
             print("✗ 无效选择，请输入 1-4")
     
+    if len(selected_colos) > 1:
+        colos_text = ",".join(selected_colos)
+        print(f"\n测速参数: 地区={colos_text}, 每个地区测试{dn_count}个IP, 速度下限{speed_limit}MB/s, 延迟上限{time_limit}ms")
+        print("模式: 多地区并行测速")
+        use_goal = confirm_goal_mode()
+        ports = select_test_ports() if use_goal else None
+        if run_multi_colo_speedtest(selected_colos, dn_count, speed_limit, time_limit, use_goal,
+                                    ports=ports, ctx=ctx) == 0:
+            ingest_result_file("result.csv")
+            upload_results_to_api("result.csv")
+        return colos_text, dn_count, speed_limit, time_limit
+    
     print(f"\n测速参数: 地区={cfcolo}, 测试{dn_count}个IP, 速度下限{speed_limit}MB/s, 延迟上限{time_limit}ms")
     print("模式: 常规测速（指定地区）")
     
     # 从地区扫描结果中提取该地区的IP进行测速
-    if os.path.exists("region_scan.csv"):
+    if os.path.exists(REGION_SCAN_FILE):
         print(f"\n正在从扫描结果中提取 {cfcolo} 地区的IP...")
         
         # 读取该地区的IP
-        region_ips = []
-        with open("region_scan.csv", 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                colo = (row.get('地区码') or '').strip()
-                if colo == cfcolo:
-                    ip = (row.get('IP 地址') or '').strip()
-                    if ip:
-                        region_ips.append(ip)
+        region_ips = load_region_ips(cfcolo)
         
-        if region_ips:
+        if region_ips and confirm_goal_mode():
+            ports = select_test_ports()
+            print(f"找到 {len(region_ips)} 个 {cfcolo} 地区的IP，开始目标驱动测速...")
+            targets = warm_start_targets(((ip, DEFAULT_TEST_PORT) for ip in region_ips), cfcolo)
+            resume = confirm_resume("result.csv", "goal")
+            if run_goal_speedtest(targets, dn_count, speed_limit, time_limit, ports=ports,
+                                  resume=resume, source=cfcolo) == 0:
+                ingest_result_file("result.csv", colo=cfcolo)
+                upload_results_to_api("result.csv")
+        elif region_ips and ctx.command() is None:
+            print(BINARY_UNAVAILABLE_HINT)
+        elif region_ips:
             # 创建该地区的IP文件
             region_ip_file = f"{cfcolo.lower()}_ips.txt"
-            with open(region_ip_file, 'w', encoding='utf-8') as f:
-                for ip in region_ips:
-                    f.write(f"{ip}\n")
+            region_ips.union(warm_start_ips(cfcolo)).write_text(region_ip_file)
             
             print(f"找到 {len(region_ips)} 个 {cfcolo} 地区的IP，开始测速...")
             
             # 使用该地区的IP文件进行测速
-            os_type, arch_type = get_system_info()
-            exec_name = download_cloudflare_speedtest(os_type, arch_type)
-            
-            # 构建测速命令
-            if sys.platform == "win32":
-                cmd = [exec_name]
-            else:
-                cmd = [f"./{exec_name}"]
+            cmd = ctx.command()
             
             cmd.extend([
                 "-f", region_ip_file,
@@ -1402,7 +2547,7 @@ def handle_normal_mode(ip_file=CLOUDFLARE_IP_FILE):
             print("=" * 50)
             
             # 运行测速
-            result = subprocess.run(cmd, encoding='utf-8', errors='replace')
+            result = run_speedtest_streaming(cmd)
             
             # 清理临时文件
             if os.path.exists(region_ip_file):
@@ -1412,6 +2557,7 @@ def handle_normal_mode(ip_file=CLOUDFLARE_IP_FILE):
                 print("\n✅ 测速完成！结果已保存到 result.csv")
                 
                 # 询问是否上报结果
+                ingest_result_file("result.csv", colo=cfcolo)
                 upload_results_to_api("result.csv")
             else:
                 print("\n❌ 测速失败")
@@ -1430,75 +2576,33 @@ def generate_proxy_list(result_file="result.csv", output_file="ips_ports.txt"):
         return False
     
     try:
-        import csv
-        
         print(f"\n正在生成反代IP列表...")
         
-        # 读取CSV文件
-        with open(result_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            rows = list(reader)
+        # 边读边写，只保留前10个用于显示
+        count = 0
+        preview = []
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for result in iter_result_file(result_file):
+                proxy = f"{result['ip']}:{result['port']}"
+                f.write(proxy + '\n')
+                count += 1
+                if len(preview) < 10:
+                    preview.append(proxy)
         
-        if not rows:
+        if not count:
             print("测速结果文件为空")
             return False
         
-        # 生成反代IP列表
-        proxy_ips = []
-        for row in rows:
-            # 查找IP和端口列
-            ip = None
-            port = None
-            
-            # 查找IP列
-            for key in row.keys():
-                if 'ip' in key.lower() and '地址' in key and row[key] is not None:
-                    ip = str(row[key]).strip()
-                    break
-                elif key.lower() == 'ip' and row[key] is not None:
-                    ip = str(row[key]).strip()
-                    break
-            
-            # 查找端口列
-            for key in row.keys():
-                if '端口' in key and row[key] is not None:
-                    port = str(row[key]).strip()
-                    break
-                elif key.lower() == 'port' and row[key] is not None:
-                    port = str(row[key]).strip()
-                    break
-            
-            # 如果IP地址中包含端口信息（如 1.2.3.4:443），提取端口
-            if ip and ':' in ip:
-                ip_parts = ip.split(':')
-                if len(ip_parts) == 2:
-                    ip = ip_parts[0]  # 提取纯IP地址
-                    if not port:  # 如果还没有找到端口，使用IP中的端口
-                        port = ip_parts[1]
-            
-            # 如果没有找到端口，使用默认值
-            if not port:
-                port = '443'
-            
-            if ip and port:
-                proxy_ips.append(f"{ip}:{port}")
-        
-        # 保存到文件
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for proxy in proxy_ips:
-                f.write(proxy + '\n')
-        
         print(f"反代IP列表已生成: {output_file}")
-        print(f"共生成 {len(proxy_ips)} 个反代IP")
+        print(f"共生成 {count} 个反代IP")
         print(f"📝 格式: IP:端口 (如: 1.2.3.4:443)")
         
         # 显示前10个IP作为示例
-        if proxy_ips:
-            print(f"\n前10个反代IP示例:")
-            for i, proxy in enumerate(proxy_ips[:10], 1):
-                print(f"  {i:2d}. {proxy}")
-            if len(proxy_ips) > 10:
-                print(f"  ... 还有 {len(proxy_ips) - 10} 个IP")
+        print(f"\n前10个反代IP示例:")
+        for i, proxy in enumerate(preview, 1):
+            print(f"  {i:2d}. {proxy}")
+        if count > 10:
+            print(f"  ... 还有 {count - 10} 个IP")
         
         return True
         
@@ -1507,81 +2611,2302 @@ def generate_proxy_list(result_file="result.csv", output_file="ips_ports.txt"):
         return False
 
 
-def run_speedtest_with_file(ip_file, dn_count, speed_limit, time_limit):
-    """使用指定IP文件运行测速（反代模式，不需要机场码）"""
-    try:
-        # 获取系统信息
-        os_type, arch_type = get_system_info()
-        exec_name = download_cloudflare_speedtest(os_type, arch_type)
-        
-        # 构建命令（反代模式使用TCPing，专注于端口信息）
-        cmd = [
-            f"./{exec_name}",
-            "-f", ip_file,
-            "-dn", dn_count,
-            "-sl", speed_limit,
-            "-tl", time_limit,
-            "-p", "20"  # 显示前20个结果
-        ]
-        
-        print(f"\n运行命令: {' '.join(cmd)}")
-        print("=" * 50)
-        
+# CloudflareST 输出中的终端控制字符
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+
+class SpeedtestEvent:
+    """CloudflareST 运行过程中的事件
+    
+    kind 取值:
+        stage    - 进入新阶段，data: {'stage': 'latency' | 'download'}
+        progress - 进度更新，data: {'stage', 'done', 'total', 'available'}
+        result   - 结果表中的一行，data: 与 tcping_ip 相同字段的dict
+        output   - 其他输出行，data: None
+        exit     - 进程结束，data: {'returncode', 'cancelled'}
+    """
+    __slots__ = ('kind', 'data', 'raw')
+    
+    def __init__(self, kind, data=None, raw=''):
+        self.kind = kind
+        self.data = data
+        self.raw = raw
+    
+    def __repr__(self):
+        return f"SpeedtestEvent({self.kind!r}, {self.data!r})"
+
+
+def parse_speedtest_row(line):
+    """解析 CloudflareST 结果表中的一行，无法解析时返回 None
+    
+    格式: IP 地址  已发送  已接收  丢包率  平均延迟  下载速度 (MB/s)  [地区码]
+    """
+    parts = line.split()
+    if len(parts) < 6:
+        return None
+    
+    parsed = parse_ip_line(parts[0])
+    if not parsed or parsed[0].num_addresses != 1:
+        return None
+    
+    try:
+        sent, received = int(parts[1]), int(parts[2])
+        loss, latency, speed = float(parts[3]), float(parts[4]), float(parts[5])
+    except ValueError:
+        return None
+    
+    return {
+        'ip': str(parsed[0].network_address),
+        'port': parsed[1],
+        'sent': sent,
+        'received': received,
+        'loss': loss,
+        'latency': latency,
+        'rtts': [],
+        'speed': speed,
+        'colo': parts[6] if len(parts) > 6 else '',
+    }
+
+
+class SpeedtestRun:
+    """以流式方式运行 CloudflareST，边运行边解析输出
+    
+    迭代对象即可逐个获取 SpeedtestEvent；cancel() 可随时终止进程，
+    已解析到的结果保存在 results 中。
+    注意：CloudflareST 只在测速全部结束后才输出结果表，提前取消时通常只能拿到进度信息。
+    
+    用法:
+        run = SpeedtestRun(cmd)
+        for event in run:
+            if event.kind == 'progress': ...
+    """
+    
+    def __init__(self, cmd, echo=True, stdin=None):
+        self.cmd = cmd
+        self.echo = echo
+        self.stdin = stdin
+        self.process = None
+        self.results = []
+        self.stage = None
+        self.returncode = None
+        self.cancelled = False
+        self._in_table = False
+    
+    def start(self):
+        """启动子进程（stdin 默认继承自当前终端，以便响应 CloudflareST 的按键提示）"""
+        if self.process is None:
+            self.process = subprocess.Popen(self.cmd, stdin=self.stdin, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, bufsize=0)
+        return self
+    
+    def cancel(self):
+        """终止测速进程，已获得的结果仍可通过 results 读取"""
+        self.cancelled = True
+        if self.process and self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+    
+    def _parse_line(self, line):
+        text = _ANSI_ESCAPE.sub('', line).strip()
+        if not text:
+            return None
+        
+        if '开始延迟测速' in text:
+            self.stage = 'latency'
+            self._in_table = False
+            return SpeedtestEvent('stage', {'stage': 'latency'}, line)
+        if '开始下载测速' in text:
+            self.stage = 'download'
+            self._in_table = False
+            return SpeedtestEvent('stage', {'stage': 'download'}, line)
+        if text.startswith('IP 地址'):
+            self._in_table = True
+            return SpeedtestEvent('output', None, line)
+        
+        if self._in_table:
+            row = parse_speedtest_row(text)
+            if row:
+                self.results.append(row)
+                return SpeedtestEvent('result', row, line)
+        
+        match = re.match(r'^(\d+)\s*/\s*(\d+)', text)
+        if match:
+            available = re.search(r'可用[:：]\s*(\d+)', text)
+            return SpeedtestEvent('progress', {
+                'stage': self.stage,
+                'done': int(match.group(1)),
+                'total': int(match.group(2)),
+                'available': int(available.group(1)) if available else None,
+            }, line)
+        
+        return SpeedtestEvent('output', None, line)
+    
+    def __iter__(self):
+        import codecs
+        self.start()
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+        stdout = self.process.stdout
+        
+        while True:
+            chunk = stdout.read(4096)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if self.echo:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            buffer += text
+            
+            # 进度条使用 \r 刷新，按 \r 和 \n 同时切分
+            *lines, buffer = buffer.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            for line in lines:
+                event = self._parse_line(line)
+                if event:
+                    yield event
+        
+        buffer += decoder.decode(b'', final=True)
+        if buffer:
+            event = self._parse_line(buffer)
+            if event:
+                yield event
+        
+        self.returncode = self.process.wait()
+        yield SpeedtestEvent('exit', {'returncode': self.returncode, 'cancelled': self.cancelled})
+
+
+def run_speedtest_streaming(cmd, timeout=None, on_event=None, stdin=None):
+    """运行 CloudflareST 并实时显示输出
+    
+    Args:
+        cmd: 命令列表
+        timeout: 超时（秒），超时后终止进程并保留已获得的结果
+        on_event: 每个事件的回调，返回 False 时提前终止测速
+        stdin: 子进程的标准输入（无人值守时传入 subprocess.DEVNULL）
+    
+    Returns:
+        SpeedtestRun: 包含 returncode、results、cancelled
+    """
+    import threading
+    
+    run = SpeedtestRun(cmd, stdin=stdin)
+    timer = threading.Timer(timeout, run.cancel) if timeout else None
+    try:
+        run.start()
+        if timer:
+            timer.start()
+        for event in run:
+            if on_event and on_event(event) is False:
+                run.cancel()
+    except KeyboardInterrupt:
+        run.cancel()
+        run.returncode = run.process.wait() if run.process else 1
+        print(f"\n测速已取消，已获得 {len(run.results)} 个结果")
+    finally:
+        if timer:
+            timer.cancel()
+    
+    if run.cancelled and not run.returncode:
+        run.returncode = 1
+    return run
+
+
+def run_speedtest_with_file(ctx, ip_file, dn_count, speed_limit, time_limit):
+    """使用指定IP文件运行测速（反代模式，不需要机场码）"""
+    prefix = ctx.command()
+    if prefix is None:
+        print(BINARY_UNAVAILABLE_HINT)
+        return 1
+    try:
+        # 构建命令（反代模式使用TCPing，专注于端口信息）
+        cmd = prefix + [
+            "-f", ip_file,
+            "-dn", dn_count,
+            "-sl", speed_limit,
+            "-tl", time_limit,
+            "-p", "20"  # 显示前20个结果
+        ]
+        
+        print(f"\n运行命令: {' '.join(cmd)}")
+        print("=" * 50)
+        
         # 运行测速 - 实时显示输出
         print("正在运行测速，请稍候...")
-        result = subprocess.run(cmd, text=True, encoding='utf-8', errors='replace')
+        result = run_speedtest_streaming(cmd)
+        
+        if result.returncode == 0:
+            print("\n测速完成！")
+            print("结果已保存到 result.csv")
+        else:
+            print(f"\n测速失败，返回码: {result.returncode}")
+        
+        # 等待用户按键，不自动关闭窗口
+        input("\n按回车键退出...")
+        return 0
+        
+    except Exception as e:
+        print(f"运行测速失败: {e}")
+        return 1
+
+
+def run_speedtest(exec_name, cfcolo, dn_count, speed_limit, time_limit):
+    """运行 CloudflareSpeedTest"""
+    print(f"\n开始运行 CloudflareSpeedTest...")
+    print(f"测试参数:")
+    print(f"  - 机场码: {cfcolo} ({AIRPORT_CODES.get(cfcolo, {}).get('name', '未知')})")
+    print(f"  - 测试 IP 数量: {dn_count}")
+    print(f"  - 下载速度阈值: {speed_limit} MB/s")
+    print(f"  - 延迟阈值: {time_limit} ms")
+    print("-" * 50)
+    
+    # 构建命令
+    cmd = speedtest_command(exec_name)
+    
+    cmd.extend([
+        "-dn", dn_count,
+        "-sl", speed_limit,
+        "-tl", time_limit,
+        "-f", CLOUDFLARE_IP_FILE
+    ])
+    
+    try:
+        result = run_speedtest_streaming(cmd)
+        if result.returncode != 0:
+            print(f"\n运行失败，返回码: {result.returncode}")
+            return result.returncode
+        print("\nCloudflareSpeedTest 任务完成！")
+        return result.returncode
+    except FileNotFoundError:
+        print(f"\n找不到可执行文件: {exec_name}")
+        return 1
+
+
+def parse_ip_line(line, default_port=DEFAULT_TEST_PORT):
+    """解析IP文件中的一行
+    
+    支持格式: 1.2.3.4、1.2.3.0/24、1.2.3.4:443、2606:4700::/48、[2606:4700::1]:443
+    
+    Returns:
+        tuple: (网段对象, 端口)，空行/注释/无法解析时返回 None
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    
+    address = line
+    port = default_port
+    
+    if line.startswith('['):
+        # [IPv6]:端口
+        end = line.find(']')
+        if end == -1:
+            return None
+        address = line[1:end]
+        rest = line[end + 1:]
+        if rest.startswith(':') and rest[1:].isdigit():
+            port = int(rest[1:])
+    elif line.count(':') == 1:
+        # IPv4:端口
+        host, _, port_text = line.partition(':')
+        if not port_text.isdigit():
+            return None
+        address = host
+        port = int(port_text)
+    
+    try:
+        network = ipaddress.ip_network(address.strip(), strict=False)
+    except ValueError:
+        return None
+    
+    if not 0 < port < 65536:
+        return None
+    return network, port
+
+
+def _random_offsets(rng, size):
+    """按随机顺序惰性产出 [0, size) 内不重复的偏移量"""
+    if size <= 4096:
+        for offset in rng.sample(range(size), size):
+            yield offset
+        return
+    
+    # 大块（如IPv6 /64）无法完整打乱，随机抽取并去重
+    seen = set()
+    while len(seen) < size:
+        offset = rng.randrange(size)
+        if offset not in seen:
+            seen.add(offset)
+            yield offset
+
+
+class _PackedAddresses:
+    """把 16 字节网络序地址拼接成的 bytes 当作有序序列访问（供二分查找和归并使用）"""
+    __slots__ = ('data',)
+    
+    def __init__(self, data):
+        self.data = data
+    
+    def __len__(self):
+        return len(self.data) // 16
+    
+    def __getitem__(self, i):
+        return self.data[16 * i:16 * i + 16]
+
+
+def _merge_sorted(a, b):
+    """归并两个有序、去重的序列，产出并集（仍然有序、去重）"""
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+    while i < len_a and j < len_b:
+        x, y = a[i], b[j]
+        if x < y:
+            yield x
+            i += 1
+        elif y < x:
+            yield y
+            j += 1
+        else:
+            yield x
+            i += 1
+            j += 1
+    for k in range(i, len_a):
+        yield a[k]
+    for k in range(j, len_b):
+        yield b[k]
+
+
+class IPSet:
+    """紧凑的IP地址集合
+    
+    IPv4 地址存为有序、去重的 array('I')（每个 4 字节），IPv6 地址存为有序、去重的 16 字节
+    网络序地址拼接成的 bytes（按字节比较即按数值比较）。几十万个候选IP只占几 MB，
+    并集通过有序归并完成，成员和网段查询使用二分查找。
+    """
+    
+    def __init__(self, ips=()):
+        import socket
+        v4 = set()
+        v6 = set()
+        for ip in ips:
+            if not isinstance(ip, str):
+                ip = str(ip)
+            ip = ip.strip()
+            if ':' in ip:
+                v6.add(socket.inet_pton(socket.AF_INET6, ip))
+            else:
+                v4.add(struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0])
+        self._v4 = array('I', sorted(v4))
+        self._v6 = b''.join(sorted(v6))
+    
+    @classmethod
+    def _from_sorted(cls, v4, v6):
+        ipset = cls.__new__(cls)
+        ipset._v4 = v4
+        ipset._v6 = v6
+        return ipset
+    
+    @staticmethod
+    def _v4_from_le_bytes(data):
+        values = array('I')
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+    
+    def __len__(self):
+        return len(self._v4) + len(self._v6) // 16
+    
+    def __bool__(self):
+        return bool(self._v4) or bool(self._v6)
+    
+    def __iter__(self):
+        """按数值顺序产出IP字符串（先 IPv4，后 IPv6）"""
+        import socket
+        for value in self._v4:
+            yield socket.inet_ntoa(struct.pack('!I', value))
+        for i in range(0, len(self._v6), 16):
+            yield socket.inet_ntop(socket.AF_INET6, self._v6[i:i + 16])
+    
+    def __contains__(self, ip):
+        import bisect
+        try:
+            address = ip if isinstance(ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)) else ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        if address.version == 4:
+            values, key = self._v4, int(address)
+        else:
+            values, key = _PackedAddresses(self._v6), address.packed
+        i = bisect.bisect_left(values, key)
+        return i < len(values) and values[i] == key
+    
+    def __eq__(self, other):
+        if not isinstance(other, IPSet):
+            return NotImplemented
+        return self._v4 == other._v4 and self._v6 == other._v6
+    
+    def __repr__(self):
+        return f"IPSet({len(self._v4)} IPv4, {len(self._v6) // 16} IPv6)"
+    
+    def union(self, other):
+        v4 = array('I', _merge_sorted(self._v4, other._v4))
+        v6 = b''.join(_merge_sorted(_PackedAddresses(self._v6), _PackedAddresses(other._v6)))
+        return IPSet._from_sorted(v4, v6)
+    
+    def _bounds(self, network):
+        """网段内成员在存储中的下标范围"""
+        import bisect
+        if isinstance(network, str):
+            network = ipaddress.ip_network(network, strict=False)
+        if network.version == 4:
+            values = self._v4
+            low, high = int(network.network_address), int(network.broadcast_address)
+        else:
+            values = _PackedAddresses(self._v6)
+            low, high = network.network_address.packed, network.broadcast_address.packed
+        return network.version, bisect.bisect_left(values, low), bisect.bisect_right(values, high)
+    
+    def count_within(self, network):
+        """网段内的成员数量"""
+        _, start, end = self._bounds(network)
+        return end - start
+    
+    def overlaps(self, network):
+        """网段内是否有任意成员"""
+        return self.count_within(network) > 0
+    
+    def write_text(self, path):
+        """每行一个IP写入文本文件（CloudflareST -f 使用的格式）"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for ip in self:
+                f.write(f"{ip}\n")
+
+
+def compile_exclusions(exclude):
+    """将排除列表（IP或CIDR字符串、网段对象，或一个 IPSet）编译为判断函数 is_covered(block)
+    
+    分层抽样以块（IPv4 /24、IPv6 /64）为单位：块内只要有一个被排除的地址，就认为该层已有样本，
+    整块跳过。exclude 为 IPSet（例如地区扫描中已有的全部IP）时直接在其上二分查找。
+    """
+    if not exclude:
+        return None
+    if isinstance(exclude, IPSet):
+        return exclude.overlaps
+    
+    addresses = []
+    networks = []
+    for item in exclude:
+        network = ipaddress.ip_network(item, strict=False) if isinstance(item, str) else item
+        if network.num_addresses == 1:
+            addresses.append(network.network_address)
+        else:
+            networks.append(network)
+    ipset = IPSet(addresses)
+    
+    def is_covered(block):
+        return ipset.overlaps(block) or any(block.overlaps(n) for n in networks if n.version == block.version)
+    
+    return is_covered
+
+
+def iter_network_candidates(network, per_block=1, rng=None, is_covered=None, max_blocks=None):
+    """惰性产出网段内的候选地址（分层抽样）
+    
+    网段按 IPv4 /24、IPv6 /64 切分为块，每块随机抽取 per_block 个地址；
+    max_blocks 限制单个网段最多抽取的块数（块数过多时随机选块）；
+    is_covered(块) 为真的块整块跳过。
+    不会展开整个网段，内存占用与网段大小无关。
+    """
+    if network.version == 4:
+        block_prefix, address_cls, network_cls = CANDIDATE_BLOCK_PREFIX_V4, ipaddress.IPv4Address, ipaddress.IPv4Network
+    else:
+        block_prefix, address_cls, network_cls = CANDIDATE_BLOCK_PREFIX_V6, ipaddress.IPv6Address, ipaddress.IPv6Network
+    
+    if network.num_addresses == 1:
+        if not (is_covered and is_covered(network.supernet(new_prefix=block_prefix))):
+            yield str(network.network_address)
+        return
+    
+    rng = rng or random.Random()
+    block_prefix = max(block_prefix, network.prefixlen)
+    block_count = 1 << (block_prefix - network.prefixlen)
+    block_size = network.num_addresses // block_count
+    base = int(network.network_address)
+    
+    if max_blocks and block_count > max_blocks:
+        blocks = sorted(rng.sample(range(block_count), max_blocks))
+    else:
+        blocks = range(block_count)
+    
+    # IPv4 块跳过网络地址和广播地址
+    skip_edges = network.version == 4 and block_size > 2
+    usable = block_size - 2 if skip_edges else block_size
+    
+    for block in blocks:
+        start = base + block * block_size
+        if is_covered and is_covered(network_cls((start, block_prefix))):
+            continue
+        block_base = start + (1 if skip_edges else 0)
+        for taken, offset in enumerate(_random_offsets(rng, usable), 1):
+            yield str(address_cls(block_base + offset))
+            if taken >= per_block:
+                break
+
+
+def iter_candidates(networks, per_block=1, seed=None, exclude=None, max_blocks_v6=CANDIDATE_MAX_BLOCKS_V6,
+                    max_blocks_v4=None):
+    """对多个网段进行惰性分层抽样
+    
+    Args:
+        networks: CIDR字符串或网段对象的可迭代对象
+        per_block: 每个 /24（IPv4）或 /64（IPv6）抽取的地址数
+        seed: 随机种子，相同种子得到相同的候选集合（与网段顺序无关）
+        exclude: 已有样本的IP/CIDR或 IPSet，包含其中地址的块整块跳过（见 compile_exclusions），
+            也可以直接传入已编译的判断函数
+        max_blocks_v6: 每个IPv6网段最多抽取的 /64 数
+        max_blocks_v4: 每个IPv4网段最多抽取的 /24 数（默认全部）
+    """
+    is_covered = exclude if callable(exclude) else compile_exclusions(exclude)
+    
+    for network in networks:
+        if isinstance(network, str):
+            network = ipaddress.ip_network(network, strict=False)
+        # 每个网段使用独立的派生种子，保证结果可复现
+        rng = random.Random(f"{seed}:{network}") if seed is not None else None
+        max_blocks = max_blocks_v4 if network.version == 4 else max_blocks_v6
+        for ip in iter_network_candidates(network, per_block, rng, is_covered, max_blocks):
+            yield ip
+
+
+def iter_probe_targets(ip_file, default_port=DEFAULT_TEST_PORT, per_block=1, seed=None, exclude=None):
+    """逐行读取IP文件并惰性产出待测目标 (ip, port)，网段按 iter_candidates 分层抽样
+    
+    Args:
+        ip_file: Cloudflare.txt（CIDR列表）或 ips_ports.txt（IP:端口列表）
+        default_port: 未指定端口时使用的端口
+        per_block: CIDR 每个 /24（IPv4）或 /64（IPv6）抽取的地址数
+        seed: 随机种子，用于生成可复现的候选集合
+        exclude: 已有样本的IP/CIDR或 IPSet，包含其中地址的块整块跳过
+    """
+    is_covered = compile_exclusions(exclude)
+    
+    with open(ip_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parsed = parse_ip_line(line, default_port)
+            if not parsed:
+                continue
+            network, port = parsed
+            for ip in iter_candidates((network,), per_block, seed, is_covered):
+                yield ip, port
+
+
+def export_candidates(ip_file, output_file, per_block=1, seed=None):
+    """将IP文件中的网段按分层抽样展开为具体IP写入 output_file（供 CloudflareST 使用）
+    
+    Returns:
+        int: 写入的IP数量
+    """
+    count = 0
+    with open(output_file, 'w', encoding='utf-8') as f:
+        for ip, port in iter_probe_targets(ip_file, DEFAULT_TEST_PORT, per_block, seed):
+            f.write(f"{ip}\n")
+            count += 1
+    return count
+
+
+def parse_port_list(text, default=None):
+    """解析端口列表，如 "443,2053,8443"；输入 all 表示全部 Cloudflare HTTPS 端口
+    
+    Returns:
+        list: 去重后的端口列表，输入无效时返回 None
+    """
+    text = text.strip().lower()
+    if not text:
+        return list(default or [DEFAULT_TEST_PORT])
+    if text in ('all', '全部'):
+        return list(CLOUDFLARE_HTTPS_PORTS)
+    
+    ports = []
+    for token in text.replace('，', ',').split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if not token.isdigit() or not 0 < int(token) < 65536:
+            return None
+        if int(token) not in ports:
+            ports.append(int(token))
+    return ports or None
+
+
+def select_test_ports():
+    """让用户选择要测试的端口"""
+    print(f"\nCloudflare HTTPS 端口: {', '.join(str(p) for p in CLOUDFLARE_HTTPS_PORTS)}")
+    while True:
+        ports = parse_port_list(input("请输入要测试的端口（逗号分隔，all 为全部）[默认: 443]: "))
+        if ports:
+            print(f"✓ 测试端口: {', '.join(str(p) for p in ports)}")
+            return ports
+        print("✗ 请输入有效的端口，如 443,2053,8443")
+
+
+def expand_ports(targets, ports=None):
+    """将每个目标IP展开到多个端口
+    
+    同一IP的各端口相邻产出，使它们在相近的时间内、共享同一并发额度进行测试。
+    ports 为空时原样产出。
+    """
+    for ip, port in targets:
+        if not ports:
+            yield ip, port
+            continue
+        for p in ports:
+            yield ip, p
+
+
+def select_best_ports(results):
+    """每个IP只保留表现最好的端口（丢包率最低、延迟最低）"""
+    best = {}
+    for r in results:
+        current = best.get(r['ip'])
+        if current is None or (r['loss'], r['latency'], -r['speed']) < \
+                (current['loss'], current['latency'], -current['speed']):
+            best[r['ip']] = r
+    return sort_results(best.values())
+
+
+def _raise_open_file_limit(wanted):
+    """尽量提高进程可打开的文件数上限，返回实际可用的并发连接数"""
+    try:
+        import resource
+    except ImportError:
+        # Windows 没有 resource 模块，Proactor 事件循环不受 select 限制
+        return wanted
+    
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = wanted + 256
+        if hard != resource.RLIM_INFINITY:
+            target = min(target, hard)
+        if soft != resource.RLIM_INFINITY and soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        if soft == resource.RLIM_INFINITY:
+            return wanted
+        return max(1, min(wanted, soft - 64))
+    except (ValueError, OSError):
+        return wanted
+
+
+def run_async(coro):
+    """运行协程（Windows 下使用 Proactor 事件循环以支持大量并发连接）"""
+    import asyncio
+    if sys.platform == "win32" and hasattr(asyncio, "WindowsProactorEventLoopPolicy"):
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    return asyncio.run(coro)
+
+
+async def _tcp_connect_time(ip, port, timeout):
+    """建立一次TCP连接并返回耗时（毫秒），失败返回 None"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        transport, _ = await asyncio.wait_for(
+            loop.create_connection(asyncio.Protocol, ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    elapsed = (time.perf_counter() - start) * 1000
+    transport.close()
+    return elapsed
+
+
+async def tcping_ip(ip, port, times=NATIVE_TCPING_TIMES, timeout=NATIVE_TCPING_TIMEOUT, gate=None):
+    """对单个IP进行多次TCPing
+    
+    gate 为 asyncio.Event 时，每次连接前等待其被设置（用于暂停测试）。
+    
+    Returns:
+        dict: ip、port、sent、received、loss、latency（平均延迟ms）、rtts（每次延迟）
+    """
+    rtts = []
+    for _ in range(times):
+        # 被唤醒时可能已经再次暂停，需要重新检查
+        while gate is not None and not gate.is_set():
+            await gate.wait()
+        rtt = await _tcp_connect_time(ip, port, timeout)
+        if rtt is not None:
+            rtts.append(rtt)
+    
+    received = len(rtts)
+    return {
+        'ip': ip,
+        'port': port,
+        'sent': times,
+        'received': received,
+        'loss': (times - received) / times if times else 1.0,
+        'latency': sum(rtts) / received if received else None,
+        'rtts': rtts,
+        'speed': 0.0,
+        'colo': '',
+    }
+
+
+async def bounded_map(targets, worker, concurrency):
+    """异步生成器：以有限并发对每个 (ip, port) 执行 worker，按完成顺序产出结果
+    
+    targets 按需读取，同时在途的任务数不超过 concurrency；消费方提前退出时取消剩余任务。
+    """
+    import asyncio
+    targets = iter(targets)
+    pending = set()
+    exhausted = False
+    
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                try:
+                    ip, port = next(targets)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(worker(ip, port)))
+            
+            if not pending:
+                break
+            
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def tcping_stream(targets, concurrency=NATIVE_TCPING_CONCURRENCY, times=NATIVE_TCPING_TIMES,
+                        timeout=NATIVE_TCPING_TIMEOUT, time_limit=None, on_tested=None, gate=None):
+    """异步生成器：并发TCPing并按完成顺序逐个产出结果
+    
+    Args:
+        targets: (ip, port) 可迭代对象，按需读取，不会一次性展开
+        concurrency: 同时在测的IP数量上限
+        times: 每个IP的TCPing次数
+        timeout: 单次连接超时（秒）
+        time_limit: 平均延迟上限（ms），超过的IP不产出（同 -tl）
+        on_tested: 每测完一个IP时的回调，参数为结果dict（无论是否达标）
+        gate: asyncio.Event，未设置时不发起新的连接（已发出的连接照常完成）
+    """
+    async def worker(ip, port):
+        return await tcping_ip(ip, port, times, timeout, gate)
+    
+    stream = bounded_map(targets, worker, concurrency)
+    try:
+        async for result in stream:
+            if on_tested:
+                on_tested(result)
+            if result['received'] == 0:
+                continue
+            if time_limit is not None and result['latency'] > time_limit:
+                continue
+            yield result
+    finally:
+        await stream.aclose()
+
+
+def sort_results(results):
+    """按丢包率、平均延迟、下载速度排序（与 CloudflareST 结果排序方式一致）"""
+    return sorted(results, key=lambda r: (r['loss'], r['latency'] or 0, -r['speed']))
+
+
+def write_result_csv(results, output_file="result.csv"):
+    """将测速结果写入CSV文件"""
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_CSV_HEADERS)
+        for r in results:
+            writer.writerow([
+                r['ip'],
+                r['port'],
+                r['sent'],
+                r['received'],
+                f"{r['loss']:.2f}",
+                f"{r['latency']:.2f}" if r['latency'] is not None else '',
+                f"{r['speed']:.2f}",
+                r.get('colo', ''),
+            ])
+
+
+def scan_journal_file(output_file):
+    """扫描检查点日志路径"""
+    return output_file + ".journal"
+
+
+def file_signature(path):
+    """文件的大小和修改时间，用于判断检查点是否仍适用于该文件"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ScanJournal:
+    """长时间扫描的检查点日志（JSON Lines）
+    
+    第一行是扫描参数（包括生成候选IP所用的随机种子），之后每隔 SCAN_CHECKPOINT_INTERVAL 秒
+    追加一行：这段时间内完成的目标和得到的结果。中断后参数一致时可以继续扫描，
+    跳过已完成的目标并恢复已有结果；扫描完成后删除日志。
+    """
+    
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.done = set()
+        self.results = []
+        self._pending_done = []
+        self._pending_results = []
+        self._file = None
+        self._last_checkpoint = time.monotonic()
+    
+    @classmethod
+    def load(cls, path, params=None):
+        """读取日志，params 中的各项与日志记录不一致时返回 None
+        
+        最后一行可能在崩溃时只写了一半，读到无效行即停止。
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                if any(header.get(key) != value for key, value in (params or {}).items()):
+                    return None
+                journal = cls(path, header)
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    journal.done.update(tuple(key) for key in entry.get('done', []))
+                    journal.results.extend(entry.get('results', []))
+        except (OSError, ValueError, AttributeError):
+            return None
+        return journal
+    
+    def start(self):
+        """重写日志（合并已恢复的进度，去掉可能写了一半的行），之后追加写入"""
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.params) + '\n')
+            if self.done or self.results:
+                f.write(json.dumps({'done': sorted(self.done), 'results': self.results}) + '\n')
+        os.replace(tmp_file, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        return self
+    
+    def record(self, key, result=None):
+        """记录一个已完成的目标 (ip, port)，result 为需要保留的结果"""
+        self.done.add(key)
+        self._pending_done.append(key)
+        if result is not None:
+            self.results.append(result)
+            self._pending_results.append(result)
+        if time.monotonic() - self._last_checkpoint >= SCAN_CHECKPOINT_INTERVAL:
+            self.checkpoint()
+    
+    def checkpoint(self):
+        self._last_checkpoint = time.monotonic()
+        if not self._pending_done or self._file is None:
+            return
+        self._file.write(json.dumps({'done': self._pending_done, 'results': self._pending_results}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending_done = []
+        self._pending_results = []
+    
+    def close(self):
+        """写入剩余进度并保留日志（扫描未完成）"""
+        if self._file is not None:
+            self.checkpoint()
+            self._file.close()
+            self._file = None
+    
+    def discard(self):
+        """扫描已完成，删除日志"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def open_scan_journal(output_file, params, resume=False):
+    """创建扫描检查点；resume 为 True 且已有日志的参数一致时从日志继续
+    
+    新扫描会生成随机种子并记录在日志中，继续扫描时使用同一种子产出相同的候选IP。
+    """
+    path = scan_journal_file(output_file)
+    journal = ScanJournal.load(path, params) if resume else None
+    if journal is not None:
+        print(f"从检查点继续：已完成 {len(journal.done)} 个目标，保留 {len(journal.results)} 个结果")
+    else:
+        if resume and os.path.exists(path):
+            print("检查点与当前参数或IP文件不一致，重新开始")
+        journal = ScanJournal(path, dict(params, seed=random.getrandbits(32)))
+    return journal.start()
+
+
+def confirm_resume(output_file, kind):
+    """存在同类未完成扫描（kind: regions / tcping / goal）的检查点时询问是否继续"""
+    journal = ScanJournal.load(scan_journal_file(output_file), {'kind': kind})
+    if journal is None:
+        return False
+    choice = input(f"发现未完成的扫描（已完成 {len(journal.done)} 个目标），是否从检查点继续？[Y/n]: ").strip().lower()
+    return choice not in ('n', 'no')
+
+
+def run_native_tcping(ip_file, time_limit=9999, output_file="result.csv",
+                      concurrency=NATIVE_TCPING_CONCURRENCY, times=NATIVE_TCPING_TIMES,
+                      timeout=NATIVE_TCPING_TIMEOUT, default_port=DEFAULT_TEST_PORT, ports=None, resume=False):
+    """使用原生 asyncio 引擎进行TCPing测速，结果保存为CSV
+    
+    ports 指定时每个IP会在这些端口上分别测试（共享同一并发额度）。
+    进度定期写入 <output_file>.journal，resume 为 True 时从上次中断处继续。
+    
+    Returns:
+        list: 达标IP的结果列表（已排序），失败时返回 None
+    """
+    if not os.path.exists(ip_file):
+        print(f"❌ 未找到IP文件: {ip_file}")
+        return None
+    
+    concurrency = _raise_open_file_limit(concurrency)
+    journal = open_scan_journal(output_file, {
+        'kind': 'tcping', 'ip_file': os.path.abspath(ip_file), 'source': file_signature(ip_file),
+        'time_limit': float(time_limit), 'times': times, 'default_port': default_port, 'ports': ports or [],
+    }, resume)
+    print(f"\n开始原生TCPing测速（并发: {concurrency}，每IP {times} 次，延迟上限 {time_limit} ms）")
+    
+    stats = {'tested': len(journal.done)}
+    start = time.perf_counter()
+    
+    def on_tested(result):
+        stats['tested'] += 1
+        passed = result['received'] and result['latency'] <= float(time_limit)
+        journal.record((result['ip'], result['port']), result if passed else None)
+        if stats['tested'] % 100 == 0:
+            print(f"\r  已测试 {stats['tested']} 个IP...", end='', flush=True)
+    
+    async def collect():
+        results = list(journal.results)
+        targets = warm_start_targets(iter_probe_targets(ip_file, default_port, seed=journal.params['seed']))
+        targets = expand_ports(targets, ports)
+        targets = (t for t in targets if t not in journal.done)
+        stream = tcping_stream(targets, concurrency, times,
+                               timeout, float(time_limit), on_tested)
+        async for result in stream:
+            results.append(result)
+        return results
+    
+    try:
+        results = run_async(collect())
+    except Exception as e:
+        journal.close()
+        print(f"\n❌ 原生TCPing测速失败: {e}")
+        return None
+    except KeyboardInterrupt:
+        journal.close()
+        print(f"\n测速已中断，进度已保存（{stats['tested']} 个IP），下次可从检查点继续")
+        raise
+    journal.discard()
+    
+    elapsed = time.perf_counter() - start
+    results = sort_results(results)
+    print(f"\r  已测试 {stats['tested']} 个IP，可用 {len(results)} 个，耗时 {elapsed:.1f} 秒")
+    
+    write_result_csv(results, output_file)
+    print(f"✅ 测速结果已保存到 {output_file}")
+    return results
+
+
+def handle_native_tcping_mode(ctx):
+    """处理原生TCPing测速模式（无需下载 CloudflareST）
+    
+    Args:
+        ctx: 本次运行的 RunContext
+    """
+    print("\n" + "=" * 70)
+    print(" 原生TCPing测速模式")
+    print("=" * 70)
+    print(" 使用内置 asyncio 引擎直接测试TCP延迟，不依赖 CloudflareST 可执行文件")
+    print(" 仅测试延迟和丢包，不进行下载测速")
+    print("=" * 70)
+    
+    while True:
+        time_limit = input("请输入延迟上限(ms) [默认: 1000]: ").strip()
+        if not time_limit:
+            time_limit = "1000"
+        try:
+            time_limit_int = int(time_limit)
+            if time_limit_int <= 0:
+                print("✗ 请输入大于0的数字")
+                continue
+            time_limit = str(time_limit_int)
+            break
+        except ValueError:
+            print("✗ 请输入有效的数字")
+    
+    while True:
+        concurrency = input(f"请输入并发连接数 [默认: {NATIVE_TCPING_CONCURRENCY}]: ").strip()
+        if not concurrency:
+            concurrency = str(NATIVE_TCPING_CONCURRENCY)
+        try:
+            concurrency_int = int(concurrency)
+            if concurrency_int <= 0:
+                print("✗ 请输入大于0的数字")
+                continue
+            break
+        except ValueError:
+            print("✗ 请输入有效的数字")
+    
+    ports = select_test_ports()
+    resume = confirm_resume("result.csv", "tcping")
+    results = run_native_tcping(ctx.ip_file, time_limit, "result.csv", concurrency_int, ports=ports, resume=resume)
+    
+    if results:
+        best = select_best_ports(results) if len(ports) > 1 else results
+        print("\n延迟最低的前10个IP:")
+        for i, r in enumerate(best[:10], 1):
+            print(f"  {i:2d}. {r['ip']}:{r['port']} - {r['latency']:.2f} ms - 丢包 {r['loss']:.0%}")
+        if len(ports) > 1:
+            with open("ips_ports.txt", 'w', encoding='utf-8') as f:
+                for r in best:
+                    f.write(f"{r['ip']}:{r['port']}\n")
+            print(f"✅ 每个IP的最佳端口已保存到 ips_ports.txt（共 {len(best)} 个）")
+        ingest_result_file("result.csv")
+        upload_results_to_api("result.csv")
+    elif results is not None:
+        print("❌ 没有符合延迟条件的IP")
+    
+    return "ALL", "0", "0", time_limit
+
+
+def _colo_from_header(header):
+    """从响应头的 cf-ray 中读取地区码，没有时返回空字符串"""
+    for line in header.decode('latin-1').split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'cf-ray':
+            # 格式: 8a1b2c3d4e5f6789-HKG
+            return value.strip().rsplit('-', 1)[-1].upper()
+    return ''
+
+
+async def httping_ip(ip, port, url=REGION_SCAN_URL, timeout=NATIVE_HTTPING_TIMEOUT, ssl_context=None):
+    """对单个IP发送一次HTTP HEAD请求，读取 cf-ray 头中的地区码
+    
+    Returns:
+        dict: 与 tcping_ip 相同的字段，colo 为地区码（获取失败时为空字符串）
+    """
+    import asyncio
+    from urllib.parse import urlparse
+    
+    parsed = urlparse(url)
+    host = parsed.hostname
+    path = parsed.path or '/'
+    use_ssl = parsed.scheme == 'https'
+    result = {
+        'ip': ip,
+        'port': port,
+        'sent': 1,
+        'received': 0,
+        'loss': 1.0,
+        'latency': None,
+        'rtts': [],
+        'speed': 0.0,
+        'colo': '',
+    }
+    
+    writer = None
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            ip, port,
+            ssl=ssl_context if use_ssl else None,
+            server_hostname=host if use_ssl else None,
+        ), timeout)
+        request = (f"HEAD {path} HTTP/1.1\r\nHost: {host}\r\n"
+                   f"User-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n")
+        writer.write(request.encode('ascii'))
+        header = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return result
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    elapsed = (time.perf_counter() - start) * 1000
+    result.update(received=1, loss=0.0, latency=elapsed, rtts=[elapsed], colo=_colo_from_header(header))
+    return result
+
+
+async def httping_stream(targets, url=REGION_SCAN_URL, concurrency=NATIVE_HTTPING_CONCURRENCY,
+                         timeout=NATIVE_HTTPING_TIMEOUT, on_tested=None):
+    """异步生成器：并发HTTPing并按完成顺序产出带地区码的结果（失败的IP不产出）
+    
+    on_tested 为每测完一个IP时的回调，参数为结果dict（无论是否成功）。
+    """
+    ssl_context = _ssl_context()
+    
+    async def worker(ip, port):
+        return await httping_ip(ip, port, url, timeout, ssl_context)
+    
+    stream = bounded_map(targets, worker, concurrency)
+    try:
+        async for result in stream:
+            if on_tested:
+                on_tested(result)
+            if result['received'] and result['colo']:
+                yield result
+    finally:
+        await stream.aclose()
+
+
+def wilson_interval(successes, total, z=REGION_SAMPLE_Z):
+    """比例的 Wilson 置信区间（样本较少或比例接近 0/1 时也可靠）
+    
+    Returns:
+        tuple: (下限, 上限)
+    """
+    if total <= 0:
+        return 0.0, 1.0
+    p = successes / total
+    denominator = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denominator
+    half = z * (p * (1 - p) / total + z * z / (4 * total * total)) ** 0.5 / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def colo_ranking_converged(region_counts, new_colos, margin=REGION_SAMPLE_MARGIN, z=REGION_SAMPLE_Z):
+    """判断各地区占比的排序在统计意义上是否已稳定
+    
+    条件：最近一轮没有发现新地区，并且按占比排序后每对相邻地区要么置信区间不重叠（先后确定），
+    要么两者占比之差在置信区间内的最大可能值（较高者上界 - 较低者下界）不超过 margin
+    （确认占比接近，先后无关紧要）。只看各自的区间半宽不够：样本足够多后半宽总会小于 margin，
+    相差明显但区间仍重叠的两个地区也会被当成并列。
+    """
+    total = sum(region_counts.values())
+    if new_colos or not total:
+        return False
+    ranked = sorted(region_counts.values(), reverse=True)
+    intervals = [wilson_interval(count, total, z) for count in ranked]
+    for (high_low, high_up), (low_low, low_up) in zip(intervals, intervals[1:]):
+        if low_up < high_low:
+            continue
+        if high_up - low_low > margin:
+            return False
+    return True
+
+
+def print_colo_estimates(region_counts, limit=10, z=REGION_SAMPLE_Z):
+    """打印各地区占比估计及置信区间"""
+    total = sum(region_counts.values())
+    for colo, count in sorted(region_counts.items(), key=lambda x: x[1], reverse=True)[:limit]:
+        low, high = wilson_interval(count, total, z)
+        print(f"    {colo:<4} {count / total:6.1%}（95% 区间 {low:.1%} - {high:.1%}）")
+    if len(region_counts) > limit:
+        print(f"    ... 其余 {len(region_counts) - limit} 个地区")
+
+
+def detect_regions_native(ip_file=CLOUDFLARE_IP_FILE, scan_file=REGION_SCAN_FILE, url=REGION_SCAN_URL,
+                          concurrency=NATIVE_HTTPING_CONCURRENCY, stop_when_stable=True, resume=False):
+    """使用原生HTTPing引擎扫描各IP的地区码，边扫描边写入 scan_file
+    
+    地址块（每个 /24 或 /64 一个IP）按随机顺序分轮探测，每轮 REGION_SAMPLE_ROUND 个；
+    stop_when_stable 时各地区占比的排序收敛（见 colo_ranking_converged）即停止，通常只需
+    几百次探测。需要某个地区更多的IP时再用 drill_region 补充。中途超时或 Ctrl+C 时已获得的
+    结果依然保留。
+    未完成的扫描进度保存在 <scan_file>.journal 中，resume 为 True 时从上次中断处继续。
+    
+    Returns:
+        dict: 地区码 -> IP数量，失败时返回空字典
+    """
+    if not os.path.exists(ip_file):
+        print(f"❌ 未找到IP文件: {ip_file}")
+        return {}
+    
+    concurrency = _raise_open_file_limit(concurrency)
+    journal = open_scan_journal(scan_file, {
+        'kind': 'regions', 'ip_file': os.path.abspath(ip_file), 'source': file_signature(ip_file), 'url': url,
+    }, resume)
+    region_counts = {}
+    for result in journal.results:
+        region_counts[result['colo']] = region_counts.get(result['colo'], 0) + 1
+    state = {'found': len(journal.results), 'tested': len(journal.done), 'round_colos': set(region_counts),
+             'converged': False, 'complete': False}
+    
+    # 同一种子产生同样的候选和顺序，继续扫描时可以跳过已完成的目标
+    candidates = list(iter_probe_targets(ip_file, seed=journal.params['seed']))
+    random.Random(journal.params['seed']).shuffle(candidates)
+    
+    def on_tested(result):
+        if result['received'] and result['colo']:
+            result['checked_at'] = time.time()
+            journal.record((result['ip'], result['port']), result)
+        else:
+            journal.record((result['ip'], result['port']))
+        state['tested'] += 1
+        if state['tested'] % REGION_SAMPLE_ROUND:
+            return
+        new_colos = set(region_counts) - state['round_colos']
+        state['round_colos'] = set(region_counts)
+        print(f"\r  第 {state['tested'] // REGION_SAMPLE_ROUND} 轮：已探测 {state['tested']} 个地址块，"
+              f"获得 {state['found']} 个IP的地区码，共 {len(region_counts)} 个地区...", end='', flush=True)
+        if stop_when_stable and colo_ranking_converged(region_counts, new_colos):
+            state['converged'] = True
+    
+    def targets():
+        for target in candidates:
+            # 收敛后不再发起新的探测，已在途的探测完成后结束
+            if state['converged']:
+                return
+            if target not in journal.done:
+                yield target
+    
+    async def scan(writer):
+        stream = httping_stream(targets(), url, concurrency, on_tested=on_tested)
+        try:
+            async for result in stream:
+                colo = result['colo']
+                region_counts[colo] = region_counts.get(colo, 0) + 1
+                state['found'] += 1
+                writer.writerow(region_scan_row(result, result['checked_at']))
+            state['complete'] = True
+        finally:
+            await stream.aclose()
+    
+    print(f"正在使用原生HTTPing扫描地区码（并发: {concurrency}）...")
+    start = time.perf_counter()
+    with open(scan_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REGION_SCAN_HEADERS)
+        for result in journal.results:
+            writer.writerow(region_scan_row(result, result['checked_at']))
+        try:
+            run_async(scan(writer))
+        except KeyboardInterrupt:
+            print("\n  扫描已中断，保留已获得的结果（下次可从检查点继续）")
+        except Exception as e:
+            print(f"\n  原生HTTPing扫描出错: {e}")
+    if state['complete']:
+        journal.discard()
+    else:
+        journal.close()
+    
+    if state['converged']:
+        print(f"\n  各地区占比排序已稳定（已探测 {state['tested']} 个地址块），提前结束扫描")
+    print(f"\r  共探测 {state['tested']} 个地址块，获得 {state['found']} 个IP的地区码，{len(region_counts)} 个地区，"
+          f"耗时 {time.perf_counter() - start:.1f} 秒")
+    if region_counts:
+        print_colo_estimates(region_counts)
+    return region_counts
+
+
+async def download_speed(ip, port, url=DEFAULT_DOWNLOAD_URL, duration=NATIVE_DOWNLOAD_SECONDS,
+                         timeout=NATIVE_HTTPING_TIMEOUT, ssl_context=None):
+    """对单个IP进行下载测速
+    
+    Returns:
+        tuple: (下载速度 MB/s, 响应头 cf-ray 中的地区码)，连接失败或响应异常时速度为 0.0、地区码为空
+    """
+    import asyncio
+    from urllib.parse import urlparse
+    
+    parsed = urlparse(url)
+    host = parsed.hostname
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    use_ssl = parsed.scheme == 'https'
+    
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            ip, port,
+            ssl=ssl_context if use_ssl else None,
+            server_hostname=host if use_ssl else None,
+        ), timeout)
+        request = (f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+                   f"User-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n")
+        writer.write(request.encode('ascii'))
+        header = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        if b" 200 " not in header.split(b"\r\n", 1)[0] + b" ":
+            return 0.0, ''
+        colo = _colo_from_header(header)
+        
+        received = 0
+        start = time.perf_counter()
+        deadline = start + duration
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(reader.read(DOWNLOAD_READ_SIZE), min(remaining, timeout))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - start
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        return 0.0, ''
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    if elapsed <= 0:
+        return 0.0, colo
+    return received / elapsed / 1024 / 1024, colo
+
+
+async def goal_speedtest(targets, dn_count, speed_limit, time_limit, concurrency=NATIVE_TCPING_CONCURRENCY,
+                         download_url=DEFAULT_DOWNLOAD_URL, download_seconds=NATIVE_DOWNLOAD_SECONDS,
+                         warmup=GOAL_WARMUP_CANDIDATES, label='', previous=(), on_downloaded=None):
+    """目标驱动测速：延迟筛选与下载测速交替进行，找到 dn_count 个达标IP后立即停止
+    
+    延迟测试在后台持续进行，达标的候选按延迟放入堆中；下载测速每次取当前延迟最低的候选。
+    下载测速期间暂停发起新的TCP连接：上千个并发连接会与下载争用带宽，同时拉低下载速度、
+    抬高测得的延迟。下载开始时已发出的连接最多再持续一个连接超时（1 秒），相对于
+    download_seconds 的下载时长影响很小。多个地区并行测试时各地区之间仍会相互争用。
+    previous 为之前（中断前）已下载测速的结果，计入本次统计；on_downloaded 在每次下载测速后调用。
+    
+    Returns:
+        tuple: (达标IP列表, 所有进行过下载测速的IP列表)
+    """
+    import asyncio
+    import heapq
+    
+    ssl_context = _ssl_context()
+    candidates = []
+    counter = [0]
+    arrived = asyncio.Event()
+    screening_done = asyncio.Event()
+    screening_allowed = asyncio.Event()
+    screening_allowed.set()
+    
+    async def screen():
+        try:
+            async for result in tcping_stream(targets, concurrency, time_limit=time_limit, gate=screening_allowed):
+                counter[0] += 1
+                heapq.heappush(candidates, (result['latency'], counter[0], result))
+                arrived.set()
+        finally:
+            screening_done.set()
+            arrived.set()
+    
+    screener = asyncio.ensure_future(screen())
+    downloaded = list(previous)
+    qualified = [r for r in downloaded if r['speed'] >= speed_limit]
+    qualified_ips = {r['ip'] for r in qualified}
+    
+    try:
+        while len(qualified) < dn_count:
+            # 首次下载前先积累少量候选，以便从中择优
+            need = warmup if len(downloaded) == len(previous) else 1
+            while len(candidates) < need and not screening_done.is_set():
+                arrived.clear()
+                await arrived.wait()
+            if not candidates:
+                break
+            
+            _, _, result = heapq.heappop(candidates)
+            if result['ip'] in qualified_ips:
+                # 该IP已在其他端口达标，只保留最佳端口
+                continue
+            screening_allowed.clear()
+            try:
+                result['speed'], colo = await download_speed(result['ip'], result['port'], download_url,
+                                                             download_seconds, ssl_context=ssl_context)
+                result['colo'] = result['colo'] or colo
+            finally:
+                screening_allowed.set()
+            downloaded.append(result)
+            if on_downloaded:
+                on_downloaded(result)
+            passed = result['speed'] >= speed_limit
+            if passed:
+                qualified.append(result)
+                qualified_ips.add(result['ip'])
+            prefix = f"{label} " if label else ''
+            print(f"  {prefix}[{len(qualified)}/{dn_count}] {result['ip']}:{result['port']} - "
+                  f"{result['latency']:.2f} ms - {result['speed']:.2f} MB/s {'✓' if passed else '✗'}")
+    finally:
+        screener.cancel()
+        await asyncio.gather(screener, return_exceptions=True)
+    
+    return qualified, downloaded
+
+
+def run_goal_speedtest(targets, dn_count, speed_limit, time_limit, output_file="result.csv",
+                       concurrency=NATIVE_TCPING_CONCURRENCY, ports=None, resume=False, source=''):
+    """运行目标驱动测速并保存结果
+    
+    每个下载测速结果都会写入 <output_file>.journal；resume 为 True 时保留上次中断前的
+    下载测速结果，并跳过这些IP（下载测速是最耗时的部分，延迟筛选会重新进行）。
+    
+    Args:
+        targets: (ip, port) 可迭代对象
+        dn_count: 需要找到的达标IP数量
+        speed_limit: 下载速度下限（MB/s）
+        time_limit: 平均延迟上限（ms）
+        ports: 每个IP要测试的端口列表，默认使用目标自带的端口
+        resume: 是否从检查点继续
+        source: 候选来源（如地区码或IP文件），来源不同的检查点不会被继续
+    
+    Returns:
+        int: 0 表示找到了至少一个达标IP，1 表示失败
+    """
+    dn_count = int(dn_count)
+    speed_limit = float(speed_limit)
+    time_limit = float(time_limit)
+    concurrency = _raise_open_file_limit(concurrency)
+    
+    journal = open_scan_journal(output_file, {
+        'kind': 'goal', 'source': source, 'dn_count': dn_count, 'speed_limit': speed_limit,
+        'time_limit': time_limit, 'ports': ports or [],
+    }, resume)
+    
+    def on_downloaded(result):
+        journal.record((result['ip'], result['port']), result)
+        journal.checkpoint()
+    
+    print(f"\n开始目标驱动测速：找到 {dn_count} 个 ≥{speed_limit}MB/s 且 ≤{time_limit:.0f}ms 的IP后立即停止")
+    print("=" * 50)
+    start = time.perf_counter()
+    
+    targets = (t for t in expand_ports(targets, ports) if t not in journal.done)
+    try:
+        qualified, downloaded = run_async(goal_speedtest(targets, dn_count, speed_limit, time_limit, concurrency,
+                                                         previous=list(journal.results), on_downloaded=on_downloaded))
+    except Exception as e:
+        journal.close()
+        print(f"❌ 目标驱动测速失败: {e}")
+        return 1
+    except KeyboardInterrupt:
+        journal.close()
+        print(f"\n测速已中断，已保存 {len(journal.results)} 个下载测速结果，下次可从检查点继续")
+        raise
+    journal.discard()
+    
+    elapsed = time.perf_counter() - start
+    print("=" * 50)
+    print(f"已下载测速 {len(downloaded)} 个IP，达标 {len(qualified)} 个，耗时 {elapsed:.1f} 秒")
+    
+    # 与 CloudflareST 一致：达标IP不足时输出全部已测速IP
+    results = qualified if qualified else downloaded
+    if not results:
+        print("❌ 没有符合延迟条件的IP")
+        return 1
+    if len(qualified) < dn_count:
+        print(f"⚠️  候选IP已全部测试，仅找到 {len(qualified)} 个达标IP")
+    
+    results = sorted(results, key=lambda r: -r['speed'])
+    write_result_csv(results, output_file)
+    print(f"✅ 测速结果已保存到 {output_file}")
+    return 0 if qualified else 1
+
+
+def confirm_goal_mode():
+    """询问是否启用目标驱动模式"""
+    print("\n目标驱动模式：边测延迟边测下载速度，找到足够的达标IP后立即停止（使用内置引擎）")
+    choice = input("是否启用目标驱动模式？[y/N]: ").strip().lower()
+    return choice in ['y', 'yes']
+
+
+def parse_region_selection(text, available_regions):
+    """解析地区选择
+    
+    支持序号（1）、机场码（HKG）、大区名（亚太），多个用逗号分隔，如 "1,3" 或 "HKG,SIN,NRT"
+    
+    Returns:
+        list: 去重后的机场码列表，输入无效时返回 None
+    """
+    codes = [code for code, _, _ in available_regions]
+    selected = []
+    
+    for token in text.replace('，', ',').split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if token.isdigit():
+            index = int(token)
+            if not 1 <= index <= len(codes):
+                return None
+            matched = [codes[index - 1]]
+        elif token.upper() in codes:
+            matched = [token.upper()]
+        else:
+            # 大区名，选中该大区下所有可用地区
+            matched = [code for code in codes if AIRPORT_CODES.get(code, {}).get('region') == token]
+            if not matched:
+                return None
+        for code in matched:
+            if code not in selected:
+                selected.append(code)
+    
+    return selected or None
+
+
+def merge_colo_results(result_files, output_file="result.csv", top_n=10):
+    """合并多个地区的测速结果，每个地区保留前 top_n 个
+    
+    Args:
+        result_files: 机场码 -> 该地区结果CSV路径
+    
+    Returns:
+        int: 合并后的结果数量
+    """
+    fieldnames = []
+    merged_rows = []
+    
+    print("\n各地区测速结果:")
+    print("-" * 70)
+    for colo, path in result_files.items():
+        with open(path, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for name in reader.fieldnames or []:
+                if name not in fieldnames:
+                    fieldnames.append(name)
+            rows = []
+            for row in reader:
+                if len(rows) >= top_n:
+                    break
+                rows.append(row)
+        
+        for row in rows:
+            if not (row.get('地区码') or '').strip():
+                row['地区码'] = colo
+        merged_rows.extend(rows)
+        
+        region_name = AIRPORT_CODES.get(colo, {}).get('name', colo)
+        print(f"  {colo} ({region_name}): {len(rows)} 个IP")
+        for row in rows[:3]:
+            speed = row.get('下载速度 (MB/s)') or row.get('下载速度(MB/s)') or '0'
+            latency = row.get('平均延迟') or ''
+            print(f"      {row.get('IP 地址', '')} - {speed} MB/s - {latency} ms")
+    print("-" * 70)
+    
+    if '地区码' not in fieldnames:
+        fieldnames.append('地区码')
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval='', extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(merged_rows)
+    
+    return len(merged_rows)
+
+
+def _run_colos_with_binary(ctx, colo_ips, result_files, dn_count, speed_limit, time_limit, max_workers):
+    """使用 CloudflareST 并行测试多个地区（每个地区一个子进程，输出写入日志文件）"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    def test_colo(colo):
+        region_ip_file = f"{colo.lower()}_ips.txt"
+        colo_ips[colo].union(warm_start_ips(colo)).write_text(region_ip_file)
+        
+        cmd = ctx.command()
+        cmd.extend([
+            "-f", region_ip_file,
+            "-dn", dn_count,
+            "-sl", speed_limit,
+            "-tl", time_limit,
+            "-p", "0",  # 不在终端打印结果，避免多个进程输出混杂
+            "-o", result_files[colo]
+        ])
+        
+        try:
+            with open(f"{colo.lower()}_speedtest.log", 'w', encoding='utf-8') as log:
+                result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+            return result.returncode
+        finally:
+            if os.path.exists(region_ip_file):
+                os.remove(region_ip_file)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(test_colo, colo): colo for colo in colo_ips}
+        for future in as_completed(futures):
+            colo = futures[future]
+            try:
+                returncode = future.result()
+            except Exception as e:
+                print(f"  ❌ {colo} 测速出错: {e}")
+                continue
+            if returncode == 0:
+                print(f"  ✅ {colo} 测速完成")
+            else:
+                print(f"  ❌ {colo} 测速失败，详见 {colo.lower()}_speedtest.log")
+
+
+def _run_colos_with_goal(colo_ips, result_files, dn_count, speed_limit, time_limit, max_workers, ports=None):
+    """使用内置目标驱动引擎并行测试多个地区（共享一个事件循环）"""
+    import asyncio
+    concurrency = _raise_open_file_limit(NATIVE_TCPING_CONCURRENCY)
+    per_colo = max(1, concurrency // min(max_workers, len(colo_ips)))
+    
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_workers)
         
-        if result.returncode == 0:
-            print("\n测速完成！")
-            print("结果已保存到 result.csv")
+        async def test_colo(colo):
+            async with semaphore:
+                targets = warm_start_targets(((ip, DEFAULT_TEST_PORT) for ip in colo_ips[colo]), colo)
+                targets = expand_ports(targets, ports)
+                qualified, downloaded = await goal_speedtest(targets, int(dn_count), float(speed_limit),
+                                                             float(time_limit), per_colo, label=colo)
+                return colo, qualified or downloaded
+        
+        return await asyncio.gather(*(test_colo(colo) for colo in colo_ips))
+    
+    for colo, results in run_async(run_all()):
+        for result in results:
+            result['colo'] = result['colo'] or colo
+        if results:
+            write_result_csv(sorted(results, key=lambda r: -r['speed']), result_files[colo])
+            print(f"  ✅ {colo} 测速完成")
         else:
-            print(f"\n测速失败，返回码: {result.returncode}")
+            print(f"  ❌ {colo} 没有符合条件的IP")
+
+
+def run_multi_colo_speedtest(colos, dn_count, speed_limit, time_limit, use_goal=False,
+                             max_workers=MULTI_COLO_WORKERS, ports=None, ctx=None):
+    """并行测试多个地区，合并结果到 result.csv（每个地区保留前 dn_count 个）
+    
+    同时进行的地区数由 max_workers 限制；多个地区同时下载测速会共享本地带宽，
+    因此默认只并行少量地区。
+    
+    Returns:
+        int: 0 表示至少一个地区有结果，1 表示全部失败
+    """
+    colo_ips = {}
+    for colo in colos:
+        region_ips = load_region_ips(colo)
+        if region_ips:
+            colo_ips[colo] = region_ips
+        else:
+            print(f"⚠️  未找到 {colo} 地区的IP，已跳过")
+    
+    if not colo_ips:
+        print("❌ 所选地区均没有可用IP")
+        return 1
+    
+    if not use_goal:
+        ctx = ctx or RunContext()
+        if ctx.command() is None:
+            print(BINARY_UNAVAILABLE_HINT)
+            return 1
+    
+    result_files = {colo: f"result_{colo.lower()}.csv" for colo in colo_ips}
+    for path in result_files.values():
+        if os.path.exists(path):
+            os.remove(path)
+    
+    print(f"\n开始并行测试 {len(colo_ips)} 个地区（同时进行 {min(max_workers, len(colo_ips))} 个）...")
+    print("=" * 50)
+    if use_goal:
+        _run_colos_with_goal(colo_ips, result_files, dn_count, speed_limit, time_limit, max_workers, ports)
+    else:
+        _run_colos_with_binary(ctx, colo_ips, result_files, dn_count, speed_limit, time_limit,
+                               max_workers)
+    
+    finished = {colo: path for colo, path in result_files.items() if os.path.exists(path)}
+    if not finished:
+        print("\n❌ 所有地区测速均失败")
+        return 1
+    
+    total = merge_colo_results(finished, "result.csv", int(dn_count))
+    print(f"✅ 已合并 {len(finished)} 个地区共 {total} 个结果到 result.csv")
+    return 0
+
+
+def measurement_quality(latency, loss, speed):
+    """计算单次测量的质量分（越高越好）：可达率 ×（1 + 下载速度）/（1 + 延迟/100ms）"""
+    if latency is None:
+        return 0.0
+    return (1 - min(max(loss or 0.0, 0.0), 1.0)) * (1 + (speed or 0.0)) / (1 + latency / 100)
+
+
+def open_history_db(db_path=HISTORY_DB_FILE):
+    """打开测速历史数据库（不存在时自动创建），sqlite3 不可用时返回 None"""
+    try:
+        import sqlite3
+    except ImportError:
+        return None
+    
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS measurements (
+            id INTEGER PRIMARY KEY,
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            colo TEXT NOT NULL DEFAULT '',
+            ts REAL NOT NULL,
+            latency REAL,
+            loss REAL,
+            speed REAL,
+            source TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_measurements_ip ON measurements (ip, port);
+        CREATE INDEX IF NOT EXISTS idx_measurements_colo ON measurements (colo, ts);
+        CREATE INDEX IF NOT EXISTS idx_measurements_ts ON measurements (ts);
         
-        # 等待用户按键，不自动关闭窗口
-        input("\n按回车键退出...")
+        CREATE TABLE IF NOT EXISTS ip_scores (
+            ip TEXT NOT NULL,
+            port INTEGER NOT NULL,
+            colo TEXT NOT NULL DEFAULT '',
+            score REAL NOT NULL,
+            samples INTEGER NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (ip, port)
+        );
+        CREATE INDEX IF NOT EXISTS idx_scores_colo ON ip_scores (colo, port);
+        CREATE INDEX IF NOT EXISTS idx_scores_updated ON ip_scores (updated);
+    """)
+    return conn
+
+
+def _decay(score, updated, now, half_life=HISTORY_HALF_LIFE):
+    """按半衰期衰减历史分数"""
+    return score * 0.5 ** (max(now - updated, 0) / half_life)
+
+
+def record_measurements(results, source='', ts=None, db_path=HISTORY_DB_FILE, colo=''):
+    """将测速结果写入历史库，并更新每个 ip:port 的衰减质量分
+    
+    质量分先一次性读出本批涉及的已有记录，在内存中衰减累加后用 executemany 批量写回；
+    同时删除超过 HISTORY_RETENTION 的原始记录和质量分。
+    
+    Args:
+        results: 与 tcping_ip 相同字段的dict列表
+        source: 结果来源（如文件名）
+        colo: 结果中没有地区码时使用的地区码（如指定地区测速时的地区）
+    
+    Returns:
+        int: 写入的记录数
+    """
+    conn = open_history_db(db_path)
+    if conn is None:
         return 0
+    
+    now = ts or time.time()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT INTO measurements (ip, port, colo, ts, latency, loss, speed, source) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(r['ip'], r['port'], r.get('colo') or colo, now, r['latency'], r['loss'], r['speed'], source)
+                 for r in results])
+            
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS batch_keys (ip TEXT NOT NULL, port INTEGER NOT NULL)")
+            conn.execute("DELETE FROM batch_keys")
+            conn.executemany("INSERT INTO batch_keys (ip, port) VALUES (?, ?)",
+                             {(r['ip'], r['port']) for r in results})
+            scores = {(ip, port): (row_colo, score, samples, updated) for ip, port, row_colo, score, samples, updated
+                      in conn.execute("SELECT s.ip, s.port, s.colo, s.score, s.samples, s.updated "
+                                      "FROM ip_scores s JOIN batch_keys b ON s.ip = b.ip AND s.port = b.port")}
+            for r in results:
+                key = (r['ip'], r['port'])
+                quality = measurement_quality(r['latency'], r['loss'], r['speed'])
+                row = scores.get(key)
+                if row:
+                    scores[key] = (r.get('colo') or colo or row[0], _decay(row[1], row[3], now) + quality,
+                                   row[2] + 1, now)
+                else:
+                    scores[key] = (r.get('colo') or colo, quality, 1, now)
+            conn.executemany("INSERT OR REPLACE INTO ip_scores (ip, port, colo, score, samples, updated) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [key + value for key, value in scores.items()])
+            
+            cutoff = now - HISTORY_RETENTION
+            conn.execute("DELETE FROM measurements WHERE ts < ?", (cutoff,))
+            conn.execute("DELETE FROM ip_scores WHERE updated < ?", (cutoff,))
+    finally:
+        conn.close()
+    return len(results)
+
+
+# 结果CSV各列的识别规则（角色, 判断函数），每个文件只按表头解析一次
+_RESULT_COLUMN_RULES = [
+    ('ip', lambda name: ('ip' in name.lower() and '地址' in name) or name.lower() == 'ip'),
+    ('port', lambda name: '端口' in name or name.lower() == 'port'),
+    ('sent', lambda name: '已发送' in name or name.lower() == 'sent'),
+    ('received', lambda name: '已接收' in name or name.lower() == 'received'),
+    ('loss', lambda name: '丢包' in name or name.lower() == 'loss'),
+    ('latency', lambda name: '延迟' in name or name.lower() == 'latency'),
+    ('speed', lambda name: '下载速度' in name or name.lower() == 'speed'),
+    ('colo', lambda name: '地区码' in name or name.lower() == 'colo'),
+    ('checked_at', lambda name: '检测时间' in name),
+]
+
+
+def resolve_result_columns(fieldnames):
+    """根据表头确定各列的位置
+    
+    Returns:
+        dict: 角色 -> 列序号（每个角色取第一个匹配的列）
+    """
+    columns = {}
+    for index, name in enumerate(fieldnames):
+        name = (name or '').strip()
+        for role, matches in _RESULT_COLUMN_RULES:
+            if role not in columns and matches(name):
+                columns[role] = index
+                break
+    return columns
+
+
+def _to_float(text):
+    try:
+        return float(text) if text else None
+    except ValueError:
+        return None
+
+
+def _split_ip_port(text):
+    """拆分 1.2.3.4:443 或 [2606:4700::1]:443 形式的地址，没有端口时端口为空字符串"""
+    if text.startswith('['):
+        host, _, port = text[1:].partition(']')
+        return host, port.lstrip(':')
+    if text.count(':') == 1:
+        host, _, port = text.partition(':')
+        return host, port
+    return text, ''
+
+
+class BinaryResultFile:
+    """紧凑二进制结果文件，通过 mmap 读取，打开时无需解析
+    
+    文件格式（小端）:
+        头部   : 魔数 CFRB、版本、记录长度、地区数、记录数
+        地区表 : 每项 机场码(8字节)，记录中以序号引用
+        记录区 : 定长记录 IP(16字节，IPv4 占前4字节) + 端口 + 地区序号 + 地址族
+                 + 已发送/已接收 + 延迟/丢包率/速度(float32，延迟缺失为 NaN) + 检测时间(uint32，0 表示无)
+    """
+    HEADER = struct.Struct('<4sHHII')
+    COLO = struct.Struct('<8s')
+    RECORD = struct.Struct('<16sHHBxHHfffI')
+    MAGIC = b'CFRB'
+    VERSION = 1
+    NO_COLO = 0xFFFF
+    
+    def __init__(self, result_file):
+        import mmap
+        self._file = open(result_file, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            self._file.close()
+            raise
         
-    except Exception as e:
-        print(f"运行测速失败: {e}")
-        return 1
+        magic, version, record_size, colo_count, self._count = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION or record_size != self.RECORD.size:
+            self.close()
+            raise ValueError("二进制结果文件格式不匹配")
+        
+        offset = self.HEADER.size
+        self.colos = [self.COLO.unpack_from(self._mmap, offset + i * self.COLO.size)[0].rstrip(b'\0').decode('ascii')
+                      for i in range(colo_count)]
+        self._records_start = offset + colo_count * self.COLO.size
+    
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def __len__(self):
+        return self._count
+    
+    def _decode(self, fields):
+        import socket
+        raw_ip, port, colo_id, family, sent, received, latency, loss, speed, checked_at = fields
+        ip = socket.inet_ntoa(raw_ip[:4]) if family == 4 else socket.inet_ntop(socket.AF_INET6, raw_ip)
+        result = {
+            'ip': ip,
+            'port': port,
+            'sent': sent,
+            'received': received,
+            # float32 存储，取整到与CSV相近的精度
+            'loss': round(loss, 4),
+            'latency': None if latency != latency else round(latency, 3),
+            'rtts': [],
+            'speed': round(speed, 3),
+            'colo': self.colos[colo_id] if colo_id != self.NO_COLO else '',
+        }
+        if checked_at:
+            result['checked_at'] = float(checked_at)
+        return result
+    
+    def __getitem__(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._decode(self.RECORD.unpack_from(self._mmap, self._records_start + index * self.RECORD.size))
+    
+    def __iter__(self):
+        end = self._records_start + self._count * self.RECORD.size
+        view = memoryview(self._mmap)[self._records_start:end]
+        try:
+            for fields in self.RECORD.iter_unpack(view):
+                yield self._decode(fields)
+        finally:
+            view.release()
+    
+    @classmethod
+    def write(cls, results, result_file=RESULT_BINARY_FILE):
+        """原子地写入二进制结果文件
+        
+        Returns:
+            int: 写入的记录数
+        """
+        import socket
+        colo_ids = {}
+        records = []
+        for r in results:
+            ip = r['ip']
+            try:
+                if ':' in ip:
+                    raw_ip, family = socket.inet_pton(socket.AF_INET6, ip), 6
+                else:
+                    raw_ip, family = socket.inet_aton(ip), 4
+            except OSError:
+                continue
+            colo = r.get('colo') or ''
+            colo_id = colo_ids.setdefault(colo, len(colo_ids)) if colo else cls.NO_COLO
+            latency = r['latency'] if r['latency'] is not None else float('nan')
+            records.append(cls.RECORD.pack(raw_ip, r['port'], colo_id, family, min(r.get('sent') or 0, 0xFFFF),
+                                           min(r.get('received') or 0, 0xFFFF), latency, r['loss'], r['speed'],
+                                           int(r.get('checked_at') or 0)))
+        
+        temp_file = result_file + ".tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, cls.RECORD.size, len(colo_ids), len(records)))
+            for colo in colo_ids:
+                f.write(cls.COLO.pack(colo.encode('ascii', 'replace')[:8]))
+            f.write(b''.join(records))
+        os.replace(temp_file, result_file)
+        return len(records)
 
 
-def run_speedtest(exec_name, cfcolo, dn_count, speed_limit, time_limit):
-    """运行 CloudflareSpeedTest"""
-    print(f"\n开始运行 CloudflareSpeedTest...")
-    print(f"测试参数:")
-    print(f"  - 机场码: {cfcolo} ({AIRPORT_CODES.get(cfcolo, {}).get('name', '未知')})")
-    print(f"  - 测试 IP 数量: {dn_count}")
-    print(f"  - 下载速度阈值: {speed_limit} MB/s")
-    print(f"  - 延迟阈值: {time_limit} ms")
-    print("-" * 50)
+def is_binary_result_file(result_file):
+    """文件是否为二进制结果格式"""
+    try:
+        with open(result_file, 'rb') as f:
+            return f.read(4) == BinaryResultFile.MAGIC
+    except OSError:
+        return False
+
+
+def convert_result_file(source, target):
+    """在CSV和二进制结果格式之间转换（根据源文件内容判断方向）
     
-    # 构建命令
-    if sys.platform == "win32":
-        cmd = [exec_name]
+    含检测时间的二进制结果转换为地区扫描CSV格式，其余转换为测速结果CSV格式。
+    
+    Returns:
+        int: 转换的记录数
+    """
+    if not is_binary_result_file(source):
+        return BinaryResultFile.write(iter_result_file(source), target)
+    
+    with BinaryResultFile(source) as results:
+        rows = list(results)
+    if rows and all('checked_at' in r for r in rows):
+        for r in rows:
+            if r['latency'] is None:
+                r['latency'] = 0.0
+        write_region_scan(rows, target)
     else:
-        cmd = [f"./{exec_name}"]
+        write_result_csv(rows, target)
+    return len(rows)
+
+
+def iter_result_file(result_file="result.csv", dedupe=True):
+    """流式读取结果CSV，逐行产出结果dict（不会一次性载入整个文件）
     
-    cmd.extend([
-        "-dn", dn_count,
-        "-sl", speed_limit,
-        "-tl", time_limit,
-        "-f", CLOUDFLARE_IP_FILE
-    ])
+    IP列不是有效IP的行会被跳过；数值列为空或无法解析时：延迟为 None，丢包率和速度为 0。
+    表头包含检测时间列时额外提供 checked_at 字段。也可以直接读取二进制结果文件。
+    
+    Args:
+        dedupe: 同一 ip:端口 只保留第一次出现的行
+    """
+    if is_binary_result_file(result_file):
+        with BinaryResultFile(result_file) as results:
+            # 先关闭内部迭代器（释放对 mmap 的引用），再关闭文件
+            records = iter(results)
+            try:
+                seen = set()
+                for result in records:
+                    if dedupe:
+                        key = (result['ip'], result['port'])
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    yield result
+            finally:
+                records.close()
+        return
+    
+    with open(result_file, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        columns = resolve_result_columns(next(reader, []))
+        if 'ip' not in columns:
+            return
+        
+        # 不存在的列指向每行末尾追加的空字符串
+        ip_col, port_col, sent_col, received_col, loss_col, latency_col, speed_col, colo_col, checked_col = (
+            columns.get(role, -1) for role, _ in _RESULT_COLUMN_RULES)
+        has_checked_at = checked_col >= 0
+        width = max(columns.values()) + 1
+        seen = set()
+        
+        for row in reader:
+            if len(row) < width:
+                row = row + [''] * (width - len(row))
+            row.append('')
+            ip, port = _split_ip_port(row[ip_col].strip())
+            try:
+                ipaddress.ip_address(ip)
+            except ValueError:
+                # 空行、重复表头或其他非IP内容
+                continue
+            port = row[port_col].strip() or port
+            port = int(port) if port.isdigit() else DEFAULT_TEST_PORT
+            
+            if dedupe:
+                key = (ip, port)
+                if key in seen:
+                    continue
+                seen.add(key)
+            
+            sent = row[sent_col].strip()
+            received = row[received_col].strip()
+            result = {
+                'ip': ip,
+                'port': port,
+                'sent': int(sent) if sent.isdigit() else 0,
+                'received': int(received) if received.isdigit() else 0,
+                'loss': _to_float(row[loss_col].strip()) or 0.0,
+                'latency': _to_float(row[latency_col].strip()),
+                'rtts': [],
+                'speed': _to_float(row[speed_col].strip()) or 0.0,
+                'colo': row[colo_col].strip(),
+            }
+            if has_checked_at:
+                result['checked_at'] = _to_float(row[checked_col].strip())
+            yield result
+
+
+def result_rank_key(result):
+    """默认排序：下载速度从高到低，其次延迟、丢包率从低到高"""
+    latency = result['latency']
+    return (-result['speed'], latency if latency is not None else float('inf'), result['loss'])
+
+
+def top_results(results, k, key=result_rank_key):
+    """用堆从结果流中选出前 k 个（内存占用只与 k 有关，排序稳定）"""
+    import heapq
+    return heapq.nsmallest(k, results, key=key)
+
+
+def _dominates(a, b):
+    """a 是否支配 b（各目标都不差于 b 且至少一项更好，目标值越小越好）"""
+    return a != b and a[0] <= b[0] and a[1] <= b[1] and a[2] <= b[2]
+
+
+def pareto_fronts(results):
+    """非支配排序：延迟、丢包率越低越好，下载速度越高越好
+    
+    按目标值字典序排序后逐个二分查找所属前沿（ENS-BS），排在后面的结果不可能支配前面的，
+    因此每个结果只需与候选前沿中的成员比较。没有延迟的结果视为延迟无穷大。
+    
+    Returns:
+        list: 前沿列表，第 0 层为 Pareto 前沿；层内保持输入顺序
+    """
+    inf = float('inf')
+    points = sorted(
+        ((r['latency'] if r['latency'] is not None else inf, r['loss'], -r['speed']), index)
+        for index, r in enumerate(results)
+    )
+    fronts = []
+    for objectives, index in points:
+        lo, hi = 0, len(fronts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            # 最近加入的成员更接近当前点，从后往前比较能更快找到支配者
+            if any(_dominates(other, objectives) for other, _ in reversed(fronts[mid])):
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(fronts):
+            fronts.append([])
+        fronts[lo].append((objectives, index))
+    return [[results[index] for index in sorted(i for _, i in front)] for front in fronts]
+
+
+def rank_results(results, weights=None, ranking=None):
+    """对结果排序
+    
+    pareto：按前沿分层，层内按归一化后的加权分（延迟、丢包率、速度）排序；
+    speed：按下载速度、延迟、丢包率排序。两种方式都是稳定排序。
+    
+    Returns:
+        list: 排序后的结果
+    """
+    results = list(results)
+    if (ranking or RESULT_RANKING) != 'pareto':
+        return sorted(results, key=result_rank_key)
+    if not results:
+        return []
+    
+    weights = weights or RANK_WEIGHTS
+    
+    def span(values):
+        values = [v for v in values if v is not None]
+        if not values:
+            return 0.0, 1.0
+        low, high = min(values), max(values)
+        return low, (high - low) or 1.0
+    
+    latency_min, latency_span = span(r['latency'] for r in results)
+    loss_min, loss_span = span(r['loss'] for r in results)
+    speed_min, speed_span = span(r['speed'] for r in results)
+    
+    def score(r):
+        latency = (r['latency'] - latency_min) / latency_span if r['latency'] is not None else 1.0
+        return (weights.get('latency', 0) * latency
+                + weights.get('loss', 0) * (r['loss'] - loss_min) / loss_span
+                + weights.get('speed', 0) * (1 - (r['speed'] - speed_min) / speed_span))
+    
+    ranked = []
+    for front in pareto_fronts(results):
+        ranked.extend(sorted(front, key=score))
+    return ranked
+
+
+def rank_by_group(results, keys=('colo', 'port'), weights=None, ranking=None):
+    """按地区、端口等分组后分别排序
+    
+    Returns:
+        dict: 分组键元组 -> 排序后的结果列表
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault(tuple(result.get(key) for key in keys), []).append(result)
+    return {group: rank_results(items, weights, ranking) for group, items in groups.items()}
+
+
+def load_result_file(result_file="result.csv"):
+    """读取测速结果文件，返回带延迟的结果dict列表"""
+    return [result for result in iter_result_file(result_file) if result['latency'] is not None]
+
+
+def ingest_result_file(result_file="result.csv", db_path=HISTORY_DB_FILE, colo=''):
+    """将测速结果文件导入历史库
+    
+    Args:
+        colo: 文件中没有地区码时使用的地区码（如指定地区测速时的地区）
+    
+    Returns:
+        int: 导入的记录数，失败时返回 0
+    """
+    if not os.path.exists(result_file):
+        return 0
     
     try:
-        result = subprocess.run(cmd, check=True)
-        print("\nCloudflareSpeedTest 任务完成！")
-        return result.returncode
-    except subprocess.CalledProcessError as e:
-        print(f"\n运行失败: {e}")
-        return e.returncode
-    except FileNotFoundError:
-        print(f"\n找不到可执行文件: {exec_name}")
-        return 1
+        results = load_result_file(result_file)
+        count = record_measurements(results, os.path.basename(result_file), db_path=db_path, colo=colo)
+        if count:
+            print(f"📚 已记录 {count} 条测速历史到 {db_path}")
+        return count
+    except Exception as e:
+        print(f"⚠️  记录测速历史失败: {e}")
+        return 0
 
 
-def main():
+def get_warm_start_targets(limit=HISTORY_WARM_START, colo=None, port=None, db_path=HISTORY_DB_FILE):
+    """按衰减后的历史质量分取出最好的 ip:port
+    
+    Returns:
+        list: (ip, port) 列表，按历史质量从高到低排列
+    """
+    if not os.path.exists(db_path):
+        return []
+    conn = open_history_db(db_path)
+    if conn is None:
+        return []
+    
+    query = "SELECT ip, port, score, updated FROM ip_scores"
+    conditions, params = [], []
+    if colo:
+        conditions.append("colo = ?")
+        params.append(colo)
+    if port:
+        conditions.append("port = ?")
+        params.append(port)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    
+    now = time.time()
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    rows.sort(key=lambda r: _decay(r[2], r[3], now), reverse=True)
+    return [(ip, p) for ip, p, _, _ in rows[:limit]]
+
+
+def warm_start_targets(targets, colo=None, limit=HISTORY_WARM_START, db_path=HISTORY_DB_FILE):
+    """先产出历史上表现最好的IP，再产出其余目标（已产出的跳过）"""
+    warm = get_warm_start_targets(limit, colo, db_path=db_path)
+    if warm:
+        print(f"📚 优先测试历史表现最好的 {len(warm)} 个IP")
+    seen = set()
+    for target in warm:
+        seen.add(target)
+        yield target
+    for target in targets:
+        if target not in seen:
+            yield target
+
+
+def warm_start_ips(colo=None, version=None, limit=HISTORY_WARM_START, db_path=HISTORY_DB_FILE):
+    """历史上在默认端口表现最好的IP（IPSet），用于补充 CloudflareST 的候选IP文件
+    
+    Args:
+        version: 只保留指定版本（4 / 6）的IP，默认不限
+    """
+    return IPSet(ip for ip, _ in get_warm_start_targets(limit, colo, DEFAULT_TEST_PORT, db_path)
+                 if version is None or (':' in ip) == (version == 6))
+
+
+def with_warm_start_ips(ip_file):
+    """生成在IP列表前加入历史最佳IP的候选文件（CloudflareST 使用），没有历史记录时返回原文件"""
+    import shutil
+    with open(ip_file, 'r', encoding='utf-8') as f:
+        first = next((line for line in f if line.strip() and not line.lstrip().startswith('#')), '')
+    warm = warm_start_ips(version=6 if ':' in first else 4)
+    if not warm:
+        return ip_file
+    
+    print(f"📚 候选IP中加入历史表现最好的 {len(warm)} 个IP")
+    with open(WARM_START_IP_FILE, 'w', encoding='utf-8') as f:
+        f.writelines(ip + '\n' for ip in warm)
+        with open(ip_file, 'r', encoding='utf-8') as src:
+            shutil.copyfileobj(src, f)
+    return WARM_START_IP_FILE
+
+
+def main(argv=None):
     """主函数"""
     # 设置控制台编码（Windows 兼容）
     if sys.platform == "win32":
@@ -1592,6 +4917,37 @@ def main():
         except:
             pass
     
+    args = parse_args(argv)
+    if args.convert:
+        try:
+            count = convert_result_file(*args.convert)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"❌ 转换失败: {e}")
+            return 1
+        print(f"✅ 已转换 {count} 条记录: {args.convert[0]} -> {args.convert[1]}")
+        return 0
+    if args.refresh_ips:
+        returncode = 0
+        for ip_version, ip_file in (("ipv4", CLOUDFLARE_IP_FILE), ("ipv6", CLOUDFLARE_IPV6_FILE)):
+            try:
+                added, removed = refresh_cloudflare_ips(ip_version, ip_file, force=True)
+            except (OSError, ValueError) as e:
+                print(f"❌ {ip_file} 更新失败: {e}")
+                returncode = 1
+                continue
+            print(f"{ip_file}: 新增 {len(added)} 个，移除 {len(removed)} 个地址段")
+            print_prefix_changes(added, removed)
+        return returncode
+    if args.headless or args.config:
+        try:
+            config = load_headless_config(args)
+        except (OSError, ValueError) as e:
+            print(f"❌ 无人值守模式配置错误: {e}")
+            return 2
+        return run_headless(config)
+    if args.serve:
+        return serve_result_file(args.serve, ranking=args.ranking)
+    
     print("=" * 80)
     print(" Cloudflare SpeedTest 跨平台自动化脚本")
     print("=" * 80)
@@ -1601,26 +4957,40 @@ def main():
     print(" 支持优选反代IP列表生成")
     print("=" * 80)
     
+    ctx = RunContext()
+    # 测速程序和IP列表在后台准备，与下面的交互步骤同时进行
+    ctx.prefetch()
+    try:
+        return run_interactive(ctx)
+    finally:
+        _restore_output()
+
+
+def run_interactive(ctx):
+    """交互模式：选择IP版本和功能后执行测速
+    
+    Args:
+        ctx: 已开始预取的 RunContext
+    
+    Returns:
+        int: 退出码
+    """
     # 获取系统信息
-    os_type, arch_type = get_system_info()
+    os_type, arch_type = ctx.platform
     print(f"\n[系统信息]")
-    print(f"  操作系统: {os_type}")
-    print(f"  架构类型: {arch_type}")
+    print(f"  操作系统: {os_type or platform.system()}")
+    print(f"  架构类型: {arch_type or platform.machine()}")
     print(f"  Python版本: {sys.version.split()[0]}")
     
     # 加载本地机场码配置（如果存在）
     print(f"\n[配置加载]")
     load_local_airport_codes()
     
-    # 下载 CloudflareSpeedTest
-    print(f"\n[程序准备]")
-    exec_name = download_cloudflare_speedtest(os_type, arch_type)
-    
     # 选择 IP 版本
-    ip_version, ip_file = select_ip_version()
+    ctx.ip_version, ctx.ip_file = select_ip_version()
     
     # 下载或生成 Cloudflare IP 列表
-    if not download_cloudflare_ips(ip_version, ip_file):
+    if not ctx.prepare_ip_list():
         print("❌ 准备IP列表失败")
         return 1
     
@@ -1632,7 +5002,7 @@ def main():
     print(" 博客 https://joeyblog.net")
     print(" Telegram交流群: https://t.me/+ft-zI76oovgwNmRh")
     print("=" * 60)
-    result = get_user_input(ip_file)
+    result = get_user_input(ctx)
     
     # 检查是否是优选反代模式
     if result == (None, None, None, None):
@@ -1685,16 +5055,115 @@ def save_config(worker_domain, uuid):
         return False
 
 
-def clear_config():
-    """清除保存的配置"""
-    try:
-        if os.path.exists(CONFIG_FILE):
-            os.remove(CONFIG_FILE)
-            print("✅ 已清除保存的配置")
-            return True
-    except Exception as e:
-        print(f"⚠️  清除配置失败: {e}")
-        return False
+def clear_config():
+    """清除保存的配置"""
+    try:
+        if os.path.exists(CONFIG_FILE):
+            os.remove(CONFIG_FILE)
+            print("✅ 已清除保存的配置")
+            return True
+    except Exception as e:
+        print(f"⚠️  清除配置失败: {e}")
+        return False
+
+
+def parse_management_url(management_url):
+    """从 Worker 管理页面 URL 中解析域名和 UUID（路径最后一段）
+    
+    Returns:
+        tuple: (worker_domain, uuid)，无法解析的部分为空字符串
+    """
+    from urllib.parse import urlparse
+    
+    # 移除可能的协议前缀和尾部斜杠
+    management_url = management_url.strip().rstrip('/')
+    
+    # 如果没有协议前缀，添加 https://
+    if not management_url.startswith(('http://', 'https://')):
+        management_url = 'https://' + management_url
+    
+    parsed = urlparse(management_url)
+    path_parts = [p for p in parsed.path.strip('/').split('/') if p]
+    return parsed.netloc, path_parts[-1] if path_parts else ''
+
+
+def build_api_url(worker_domain, uuid):
+    """构建优选IP管理 API 地址"""
+    return f"https://{worker_domain}/{uuid}/api/preferred-ips"
+
+
+def api_request(method, url, data=None, timeout=10):
+    """通过全局传输层发送 API 请求（连接在多次请求之间复用）"""
+    headers = {"Content-Type": "application/json"} if data is not None else None
+    return get_transport().request(method, url, data, headers, timeout)
+
+
+def read_upload_candidates(result_file="result.csv", limit=None, ranking=None):
+    """读取测速结果文件，返回排序后的待上报IP信息列表
+    
+    Args:
+        limit: 只返回前 limit 个
+        ranking: 排序方式（pareto / speed），默认使用 RESULT_RANKING
+    """
+    results = iter_result_file(result_file)
+    if (ranking or RESULT_RANKING) == 'pareto':
+        results = rank_results(results, ranking='pareto')[:limit]
+    elif limit is not None:
+        results = top_results(results, limit)
+    else:
+        results = rank_results(results, ranking='speed')
+    
+    best_ips = []
+    for result in results:
+        region_code = result['colo']
+        # 获取地区中文名称
+        region_name = '未知地区'
+        if region_code and region_code in AIRPORT_CODES:
+            region_name = AIRPORT_CODES[region_code].get('name', region_code)
+        elif region_code:
+            region_name = region_code
+        
+        best_ips.append({
+            'ip': result['ip'],
+            'port': result['port'],
+            'speed': result['speed'],
+            'latency': f"{result['latency']:.2f}" if result['latency'] is not None else 'N/A',
+            'region_code': region_code,
+            'region_name': region_name
+        })
+    return best_ips
+
+
+def build_upload_batch(best_ips):
+    """构建批量上报数据，节点名称为：地区名-速度MB/s"""
+    batch_data = []
+    for ip_info in best_ips:
+        region_name = ip_info.get('region_name', '未知地区')
+        speed = ip_info['speed']
+        batch_data.append({
+            "ip": ip_info['ip'],
+            "port": ip_info['port'],
+            "name": f"{region_name}-{speed:.2f}MB/s"
+        })
+    return batch_data
+
+
+def select_upload_ranking():
+    """选择上报结果的排序方式"""
+    print("\n排序方式:")
+    print("  1. 速度优先 - 只按下载速度从高到低排序（默认）")
+    print("  2. 综合排序 - 按延迟、丢包率、下载速度的 Pareto 前沿排序")
+    
+    while True:
+        choice = input("请选择 [1/2，默认：1]: ").strip()
+        if not choice or choice == "1":
+            print("✓ 已选择: 速度优先")
+            return "speed"
+        elif choice == "2":
+            print("✓ 已选择: 综合排序")
+            return "pareto"
+        else:
+            print("✗ 请输入 1 或 2")
 
 
 def upload_results_to_api(result_file="result.csv"):
@@ -1772,34 +5241,18 @@ def upload_results_to_api(result_file="result.csv"):
     
         # 解析 URL，提取域名和 UUID
         try:
-            from urllib.parse import urlparse
-            
-            # 移除可能的协议前缀和尾部斜杠
-            management_url = management_url.strip().rstrip('/')
+            worker_domain, uuid = parse_management_url(management_url)
             
-            # 如果没有协议前缀，添加 https://
-            if not management_url.startswith(('http://', 'https://')):
-                management_url = 'https://' + management_url
-            
-            # 解析 URL
-            parsed = urlparse(management_url)
-            worker_domain = parsed.netloc
-            
-            # 从路径中提取 UUID（不再验证格式）
             if not worker_domain:
                 print("❌ 无法解析域名，请检查 URL 格式")
                 return
             
-            # 从路径中提取最后一个非空部分作为UUID
-            path_parts = [p for p in parsed.path.strip('/').split('/') if p]
-            if not path_parts:
+            if not uuid:
                 print("❌ 无法从 URL 中提取 UUID或者路径")
                 print("   请确保 URL 包含 UUID或者路径")
                 print("   格式示例: https://域名/UUID或者路径")
                 return
             
-            uuid = path_parts[-1]
-            
             # 显示解析结果
             print(f"\n✅ 成功解析配置:")
             print(f"   Worker 域名: {worker_domain}")
@@ -1819,19 +5272,12 @@ def upload_results_to_api(result_file="result.csv"):
             return
     
     # 构建 API URL
-    api_url = f"https://{worker_domain}/{uuid}/api/preferred-ips"
+    api_url = build_api_url(worker_domain, uuid)
     
     # 检查是否已有数据
     print("\n🔍 正在检查现有优选IP...")
     try:
-        try:
-            response = requests.get(api_url, timeout=10)
-        except ImportError as e:
-            # SSL模块不可用，静默切换到curl
-            if "SSL module is not available" in str(e):
-                response = curl_request(api_url, method='GET', timeout=10)
-            else:
-                raise
+        response = api_request('GET', api_url, timeout=10)
         
         if response.status_code == 200:
             result = response.json()
@@ -1865,92 +5311,35 @@ def upload_results_to_api(result_file="result.csv"):
         print(f"⚠️  检查现有数据失败: {e}")
         print("将继续尝试添加...")
     
-    # 读取测速结果
+    ranking = select_upload_ranking()
+    
+    # 询问要上报多少个结果
+    while True:
+        count_input = input("\n请输入要上报的IP数量 [默认: 10]: ").strip()
+        if not count_input:
+            upload_count = 10
+            break
+        try:
+            upload_count = int(count_input)
+            if upload_count <= 0:
+                print("✗ 请输入大于0的数字")
+                continue
+            break
+        except ValueError:
+            print("✗ 请输入有效的数字")
+    
+    # 读取测速结果（只保留前 upload_count 个）
     print("\n📊 正在读取测速结果...")
     try:
-        best_ips = []
-        with open(result_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # 安全获取数据，避免NoneType错误
-                ip = (row.get('IP 地址') or '').strip()
-                port = (row.get('端口') or '').strip()
-                
-                # 尝试多种可能的列名来获取速度
-                speed = ''
-                for speed_key in ['下载速度(MB/s)', '下载速度 (MB/s)', '下载速度']:
-                    if speed_key in row and row[speed_key] is not None:
-                        speed = str(row[speed_key]).strip()
-                        break
-                
-                # 尝试多种可能的列名来获取延迟
-                latency = ''
-                for latency_key in ['平均延迟', '延迟', 'latency']:
-                    if latency_key in row and row[latency_key] is not None:
-                        latency = str(row[latency_key]).strip()
-                        break
-                
-                # 获取地区码
-                region_code = (row.get('地区码') or '').strip()
-                
-                # 如果IP地址中包含端口信息
-                if ip and ':' in ip:
-                    ip_parts = ip.split(':')
-                    if len(ip_parts) == 2:
-                        ip = ip_parts[0]
-                        if not port:
-                            port = ip_parts[1]
-                
-                # 设置默认端口
-                if not port:
-                    port = '443'
-                
-                if ip:
-                    try:
-                        speed_val = float(speed) if speed else 0
-                        latency_val = latency if latency else 'N/A'
-                        
-                        # 获取地区中文名称
-                        region_name = '未知地区'
-                        if region_code and region_code in AIRPORT_CODES:
-                            region_name = AIRPORT_CODES[region_code].get('name', region_code)
-                        elif region_code:
-                            region_name = region_code
-                        
-                        best_ips.append({
-                            'ip': ip,
-                            'port': int(port),
-                            'speed': speed_val,
-                            'latency': latency_val,
-                            'region_code': region_code,
-                            'region_name': region_name
-                        })
-                    except ValueError:
-                        continue
+        best_ips = read_upload_candidates(result_file, upload_count, ranking)
         
         if not best_ips:
             print("❌ 未找到有效的测速结果")
             return
         
-        print(f"✅ 找到 {len(best_ips)} 个测速结果")
-        
-        # 询问要上报多少个结果
-        while True:
-            count_input = input(f"\n请输入要上报的IP数量 [默认: 10, 最多: {len(best_ips)}]: ").strip()
-            if not count_input:
-                upload_count = min(10, len(best_ips))
-                break
-            try:
-                upload_count = int(count_input)
-                if upload_count <= 0:
-                    print("✗ 请输入大于0的数字")
-                    continue
-                if upload_count > len(best_ips):
-                    print(f"⚠️  最多只能上报 {len(best_ips)} 个结果")
-                    upload_count = len(best_ips)
-                break
-            except ValueError:
-                print("✗ 请输入有效的数字")
+        if len(best_ips) < upload_count:
+            print(f"⚠️  只找到 {len(best_ips)} 个测速结果，将全部上报")
+            upload_count = len(best_ips)
         
         # 显示将要上报的IP
         print(f"\n将上报以下 {upload_count} 个优选IP:")
@@ -1970,25 +5359,7 @@ def upload_results_to_api(result_file="result.csv"):
         if should_clear:
             print("\n🗑️  正在清空现有数据...")
             try:
-                try:
-                    delete_response = requests.delete(
-                        api_url,
-                        json={"all": True},
-                        headers={"Content-Type": "application/json"},
-                        timeout=10
-                    )
-                except ImportError as e:
-                    # SSL模块不可用，静默切换到curl
-                    if "SSL module is not available" in str(e):
-                        delete_response = curl_request(
-                            api_url,
-                            method='DELETE',
-                            data={"all": True},
-                            headers={"Content-Type": "application/json"},
-                            timeout=10
-                        )
-                    else:
-                        raise
+                delete_response = api_request('DELETE', api_url, {"all": True}, timeout=10)
                 
                 if delete_response.status_code == 200:
                     print("✅ 现有数据已清空")
@@ -1999,47 +5370,17 @@ def upload_results_to_api(result_file="result.csv"):
         
         # 构建批量上报数据
         print("\n🚀 开始批量上报优选IP...")
-        batch_data = []
-        for ip_info in best_ips[:upload_count]:
-            # 构建节点名称：地区名-速度MB/s
-            region_name = ip_info.get('region_name', '未知地区')
-            speed = ip_info['speed']
-            name = f"{region_name}-{speed:.2f}MB/s"
-            
-            batch_data.append({
-                "ip": ip_info['ip'],
-                "port": ip_info['port'],
-                "name": name
-            })
+        batch_data = build_upload_batch(best_ips[:upload_count])
         
         # 发送批量POST请求
-        use_curl_fallback = False
+        transport = get_transport()
         response = None
         success_count = 0
         fail_count = 0
         skipped_count = 0
         
         try:
-            try:
-                response = requests.post(
-                    api_url,
-                    json=batch_data,
-                    headers={"Content-Type": "application/json"},
-                    timeout=30
-                )
-            except ImportError as e:
-                # SSL模块不可用，静默切换到curl备用方案
-                if "SSL module is not available" in str(e):
-                    use_curl_fallback = True
-                    response = curl_request(
-                        api_url,
-                        method='POST',
-                        data=batch_data,
-                        headers={"Content-Type": "application/json"},
-                        timeout=30
-                    )
-                else:
-                    raise
+            response = api_request('POST', api_url, batch_data, timeout=30)
             
             # 处理响应
             if response and response.status_code == 200:
@@ -2072,11 +5413,11 @@ def upload_results_to_api(result_file="result.csv"):
                     pass
                 fail_count = upload_count
                 
-        except requests.exceptions.Timeout:
+        except transport.timeout_errors:
             print(f"❌ 请求超时，请检查网络连接")
             print(f"   建议：检查网络连接或稍后重试")
             fail_count = upload_count
-        except requests.exceptions.RequestException as e:
+        except transport.network_errors as e:
             print(f"❌ 网络错误: {e}")
             print(f"   建议：检查网络连接或API地址是否正确")
             fail_count = upload_count
@@ -2109,55 +5450,822 @@ def upload_results_to_api(result_file="result.csv"):
         traceback.print_exc()
 
 
-def detect_available_regions():
-    """检测可用地区"""
-    # 检查是否已有检测结果文件
-    if os.path.exists("region_scan.csv"):
-        print("发现已有的地区扫描结果文件")
-        choice = input("是否需要重新扫描？[y/N]: ").strip().lower()
-        if choice != 'y':
-            print("使用已有检测结果...")
-            # 直接读取已有文件
-            available_regions = []
-            region_counts = {}
+def upload_results_headless(result_file="result.csv", worker_url=None, upload_count=10,
+                            clear_existing=False, ranking=None):
+    """无交互地上报优选结果（未指定 worker_url 时使用已保存的配置）
+    
+    Returns:
+        bool: 是否上报成功
+    """
+    if worker_url:
+        worker_domain, uuid = parse_management_url(worker_url)
+    else:
+        saved_config = load_config() or {}
+        worker_domain, uuid = saved_config.get('worker_domain'), saved_config.get('uuid')
+    if not worker_domain or not uuid:
+        print("❌ 未配置 Worker 管理页面 URL，跳过上报")
+        return False
+    
+    best_ips = read_upload_candidates(result_file, upload_count, ranking)
+    if not best_ips:
+        print("❌ 未找到有效的测速结果，跳过上报")
+        return False
+    
+    api_url = build_api_url(worker_domain, uuid)
+    if clear_existing:
+        response = api_request('DELETE', api_url, {"all": True}, timeout=10)
+        if response.status_code != 200:
+            print(f"⚠️  清空失败 (HTTP {response.status_code})，继续尝试添加...")
+    
+    response = api_request('POST', api_url, build_upload_batch(best_ips), timeout=30)
+    if response.status_code != 200:
+        print(f"❌ 批量上报失败 (HTTP {response.status_code})")
+        return False
+    result = response.json()
+    if not result.get('success'):
+        print(f"❌ 批量上报失败: {result.get('error', '未知错误')}")
+        return False
+    print(f"✅ 已上报: 成功 {result.get('added', 0)} 个，跳过 {result.get('skipped', 0)} 个，"
+          f"失败 {result.get('failed', 0)} 个")
+    return True
+
+
+def parse_args(argv=None):
+    """解析命令行参数（不带参数时进入交互模式）"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Cloudflare SpeedTest 跨平台自动化脚本")
+    parser.add_argument("--headless", action="store_true", help="无人值守模式，不进行任何交互")
+    parser.add_argument("--config", help="无人值守模式的 JSON 配置文件（命令行参数优先）")
+    parser.add_argument("--interval", type=int, help="循环运行间隔（秒），0 表示只运行一次")
+    parser.add_argument("--ip-version", choices=["ipv4", "ipv6"])
+    parser.add_argument("--ip-file", help="自定义IP文件")
+    parser.add_argument("--mode", choices=["all", "colo"])
+    parser.add_argument("--colo", help="地区码，多个用逗号分隔（--mode colo 时使用）")
+    parser.add_argument("--engine", choices=["binary", "goal", "tcping"])
+    parser.add_argument("--ports", help="测试端口，多个用逗号分隔（内置引擎）")
+    parser.add_argument("--dn-count")
+    parser.add_argument("--speed-limit")
+    parser.add_argument("--time-limit")
+    parser.add_argument("--upload", action="store_true", default=None, help="每轮结束后上报结果")
+    parser.add_argument("--worker-url", help="Worker 管理页面 URL（默认使用已保存的配置）")
+    parser.add_argument("--upload-count", type=int)
+    parser.add_argument("--clear-upload", action="store_true", default=None, help="上报前清空现有优选IP")
+    parser.add_argument("--ranking", choices=["pareto", "speed"], help="结果排序方式（默认 speed）")
+    parser.add_argument("--binary-output", action="store_true", default=None,
+                        help=f"每轮结束后额外保存二进制结果文件 {RESULT_BINARY_FILE}")
+    parser.add_argument("--convert", nargs=2, metavar=("SRC", "DST"),
+                        help="在CSV和二进制结果格式之间转换后退出")
+    parser.add_argument("--refresh-ips", action="store_true",
+                        help="立即重新验证 IPv4/IPv6 列表（条件请求），打印变化的地址段后退出")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="启动本地查询服务（单独使用时提供 result.csv 中的结果，文件更新后自动重新加载）")
+    return parser.parse_args(argv)
+
+
+def load_headless_config(args):
+    """合并默认参数、配置文件和命令行参数"""
+    config = dict(HEADLESS_DEFAULTS)
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    
+    overrides = {
+        "interval": args.interval,
+        "ip_version": args.ip_version,
+        "ip_file": args.ip_file,
+        "mode": args.mode,
+        "colos": [c.strip().upper() for c in args.colo.split(',') if c.strip()] if args.colo else None,
+        "engine": args.engine,
+        "ports": parse_port_list(args.ports) if args.ports else None,
+        "dn_count": args.dn_count,
+        "speed_limit": args.speed_limit,
+        "time_limit": args.time_limit,
+        "upload": args.upload,
+        "worker_url": args.worker_url,
+        "upload_count": args.upload_count,
+        "clear_upload": args.clear_upload,
+        "serve_port": args.serve,
+        "ranking": args.ranking,
+        "binary_output": args.binary_output,
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    if config["worker_url"]:
+        config["upload"] = True
+    for key in ("dn_count", "speed_limit", "time_limit"):
+        config[key] = str(config[key])
+    if not config["ip_file"]:
+        config["ip_file"] = CLOUDFLARE_IPV6_FILE if config["ip_version"] == "ipv6" else CLOUDFLARE_IP_FILE
+    if config["mode"] == "colo" and not config["colos"]:
+        raise ValueError("--mode colo 需要通过 --colo 或配置文件指定地区码")
+    if config["mode"] == "colo" and config["engine"] == "tcping":
+        # 分地区测速需要下载测速（CloudflareST 或目标驱动引擎），TCPing 只测延迟
+        raise ValueError("--mode colo 不支持 --engine tcping，请使用 binary 或 goal")
+    return config
+
+
+def run_headless_cycle(config, ctx):
+    """执行一轮：地区扫描 → 测速 → 生成反代列表 → 记录历史 → 上报
+    
+    Returns:
+        int: 0 表示成功
+    """
+    ip_file = ctx.prepare_ip_list()
+    if not ip_file:
+        print("❌ 准备IP列表失败")
+        return 1
+    
+    # 删除上一轮的结果，避免本轮失败时上报旧数据
+    if os.path.exists("result.csv"):
+        os.remove("result.csv")
+    
+    engine, ports = config["engine"], config["ports"] or None
+    dn_count, speed_limit, time_limit = config["dn_count"], config["speed_limit"], config["time_limit"]
+    
+    if config["mode"] == "colo":
+        # 地区扫描结果过期时增量刷新，不存在时完整扫描
+        total, stale, _ = region_scan_status()
+        if not total:
+            detect_regions_native(ip_file, resume=True)
+            ctx.drilled_colos.clear()
+        elif stale:
+            refresh_region_scan(ip_file)
+            ctx.drilled_colos.clear()
+        # 很少命中的地区补充扫描后仍可能达不到目标，不必每轮都重新探测上千个地址块
+        for colo in config["colos"]:
+            if colo not in ctx.drilled_colos:
+                drill_region(colo, ip_file)
+                ctx.drilled_colos.add(colo)
+        returncode = run_multi_colo_speedtest(config["colos"], dn_count, speed_limit, time_limit,
+                                              use_goal=engine != "binary", ports=ports, ctx=ctx)
+    elif engine == "goal":
+        targets = warm_start_targets(iter_probe_targets(ip_file))
+        returncode = run_goal_speedtest(targets, dn_count, speed_limit, time_limit, ports=ports,
+                                        resume=True, source=ip_file)
+    elif engine == "tcping":
+        results = run_native_tcping(ip_file, float(time_limit), ports=ports, resume=True)
+        returncode = 0 if results else 1
+    else:
+        cmd = ctx.command()
+        cmd.extend(["-f", with_warm_start_ips(ip_file), "-dn", dn_count, "-sl", speed_limit, "-tl", time_limit,
+                    "-p", "0"])
+        returncode = run_speedtest_streaming(cmd, stdin=subprocess.DEVNULL).returncode
+    
+    if returncode != 0 or not os.path.exists("result.csv"):
+        print("❌ 本轮测速没有结果")
+        return 1
+    
+    generate_proxy_list("result.csv", "ips_ports.txt")
+    ingest_result_file("result.csv")
+    if config["binary_output"]:
+        count = convert_result_file("result.csv", RESULT_BINARY_FILE)
+        print(f"已保存 {count} 个结果到 {RESULT_BINARY_FILE}")
+    if config["upload"]:
+        try:
+            upload_results_headless("result.csv", config["worker_url"], config["upload_count"],
+                                    config["clear_upload"], config["ranking"])
+        except Exception as e:
+            print(f"❌ 上报失败: {e}")
+            return 1
+    return 0
+
+
+def run_headless(config):
+    """无人值守模式：按间隔循环运行，程序、IP列表和HTTP连接在各轮之间复用"""
+    print(f"\n[无人值守模式] 模式: {config['mode']}  引擎: {config['engine']}  "
+          f"间隔: {config['interval'] or '仅运行一次'}")
+    load_local_airport_codes()
+    
+    ctx = RunContext(config["ip_version"], config["ip_file"])
+    if config["engine"] == "binary" and not ctx.prepare_binary():
+        print("❌ 测速程序不可用，请改用 --engine goal 或 --engine tcping")
+        return 1
+    print(f"HTTP 传输方式: {ctx.transport.describe()}")
+    
+    store = server = None
+    if config["serve_port"]:
+        store = ResultStore(config["ranking"])
+        if os.path.exists("result.csv"):
+            store.load("result.csv")
+        server = start_result_server(store, config["serve_port"])
+    
+    interval = max(0, int(config["interval"]))
+    returncode = 0
+    try:
+        while True:
+            started = time.monotonic()
+            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 开始新一轮测速")
+            try:
+                ctx.invalidate_ip_lists()
+                returncode = run_headless_cycle(config, ctx)
+                if store and returncode == 0:
+                    store.load("result.csv")
+            except Exception as e:
+                print(f"❌ 本轮运行出错: {e}")
+                returncode = 1
+            if not interval and not server:
+                return returncode
+            if not interval:
+                # 只运行一次但开启了查询服务：保持服务直到 Ctrl+C
+                while True:
+                    time.sleep(3600)
             
-            with open("region_scan.csv", 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    colo = (row.get('地区码') or '').strip()
-                    if colo and colo != 'N/A':
-                        region_counts[colo] = region_counts.get(colo, 0) + 1
+            # 以开始时间为基准计算下一轮，避免运行耗时累积造成漂移
+            delay = interval - (time.monotonic() - started)
+            if delay > 0:
+                print(f"下一轮将在 {delay:.0f} 秒后开始")
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        print("\n无人值守模式已停止")
+        return returncode
+    finally:
+        if server:
+            server.shutdown()
+
+
+class ResultStore:
+    """在内存中保存最新的测速结果，供查询服务使用
+    
+    每次 update() 都会构建新的快照（整体排序并按地区分别排序）后整体替换，
+    查询时只读取一次快照引用，因此无需加锁也不会读到更新到一半的数据。
+    """
+    
+    def __init__(self, ranking=None):
+        self.ranking = ranking
+        self._snapshot = {'version': 0, 'updated_at': None, 'source': None, 'by_colo': {None: ()}}
+    
+    def update(self, results, source=None):
+        results = list(results)
+        ranked = tuple(rank_results(results, ranking=self.ranking))
+        by_colo = {None: ranked}
+        for (colo,), items in rank_by_group(results, ('colo',), ranking=self.ranking).items():
+            by_colo[colo or ''] = tuple(items)
+        self._snapshot = {
+            'version': self._snapshot['version'] + 1,
+            'updated_at': time.time(),
+            'source': source,
+            'by_colo': by_colo,
+        }
+        return len(ranked)
+    
+    def load(self, result_file="result.csv"):
+        """从结果文件加载，返回结果数"""
+        return self.update(load_result_file(result_file), result_file)
+    
+    def query(self, top=10, colos=None, port=None, max_latency=None, min_speed=None):
+        """查询最优结果（单个地区使用该地区内的排序，多个地区使用整体排序）
+        
+        Raises:
+            ValueError: top 小于 1
+        """
+        if top < 1:
+            raise ValueError("n 必须大于 0")
+        by_colo = self._snapshot['by_colo']
+        if colos and len(colos) == 1:
+            candidates = by_colo.get(colos[0], ())
+        elif colos:
+            wanted = set(colos)
+            candidates = (r for r in by_colo[None] if r['colo'] in wanted)
+        else:
+            candidates = by_colo[None]
+        
+        matched = []
+        for result in candidates:
+            if port is not None and result['port'] != port:
+                continue
+            if max_latency is not None and (result['latency'] is None or result['latency'] > max_latency):
+                continue
+            if min_speed is not None and result['speed'] < min_speed:
+                continue
+            matched.append(result)
+            if len(matched) >= top:
+                break
+        return matched
+    
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            'version': snapshot['version'],
+            'updated_at': snapshot['updated_at'],
+            'source': snapshot['source'],
+            'total': len(snapshot['by_colo'][None]),
+            'colos': {colo: len(items) for colo, items in snapshot['by_colo'].items() if colo},
+        }
+
+
+def start_result_server(store, port, host=SERVE_HOST):
+    """在后台线程启动本地查询服务
+    
+    接口:
+        GET /best?n=10&colo=HKG,SIN&port=443&max_latency=150&min_speed=5  返回 JSON
+        GET /best.txt?...  每行一个 IP:端口
+        GET /status  返回当前数据版本、更新时间和各地区数量
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+    
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+        
+        def _send(self, status, body, content_type='application/json; charset=utf-8'):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if url.path == '/status':
+                self._send(200, json.dumps(store.status(), ensure_ascii=False))
+                return
+            if url.path not in ('/best', '/best.txt'):
+                self._send(404, json.dumps({'error': 'not found'}))
+                return
             
-            # 构建地区列表（按IP数量排序）
-            for colo, count in sorted(region_counts.items(), key=lambda x: x[1], reverse=True):
-                region_name = "未知地区"
-                for code, info in AIRPORT_CODES.items():
-                    if code == colo:
-                        region_name = f"{info.get('name', '')} ({info.get('country', '')})"
-                        break
-                available_regions.append((colo, region_name, count))
+            try:
+                colos = [c.strip().upper() for c in params.get('colo', '').split(',') if c.strip()]
+                results = store.query(
+                    top=int(params.get('n', 10)),
+                    colos=colos or None,
+                    port=int(params['port']) if 'port' in params else None,
+                    max_latency=float(params['max_latency']) if 'max_latency' in params else None,
+                    min_speed=float(params['min_speed']) if 'min_speed' in params else None,
+                )
+            except ValueError as e:
+                self._send(400, json.dumps({'error': str(e)}))
+                return
             
-            return available_regions
+            if url.path == '/best.txt':
+                lines = [f"[{r['ip']}]:{r['port']}" if ':' in r['ip'] else f"{r['ip']}:{r['port']}" for r in results]
+                self._send(200, '\n'.join(lines) + ('\n' if lines else ''), 'text/plain; charset=utf-8')
+            else:
+                keys = ('ip', 'port', 'latency', 'loss', 'speed', 'colo')
+                self._send(200, json.dumps([{key: r[key] for key in keys} for r in results], ensure_ascii=False))
+    
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🌐 本地查询服务已启动: http://{host}:{port}/best?n=10")
+    return server
+
+
+def serve_result_file(port, result_file="result.csv", host=SERVE_HOST, ranking=None):
+    """单独运行查询服务：提供 result_file 中的结果，文件更新后自动重新加载"""
+    store = ResultStore(ranking)
+    server = start_result_server(store, port, host)
+    mtime = None
+    try:
+        while True:
+            try:
+                current = os.path.getmtime(result_file)
+            except OSError:
+                current = None
+            if current is not None and current != mtime:
+                try:
+                    count = store.load(result_file)
+                    mtime = current
+                    print(f"📥 已加载 {count} 个结果（{result_file}）")
+                except (OSError, ValueError) as e:
+                    print(f"⚠️  加载 {result_file} 失败: {e}")
+            time.sleep(SERVE_RELOAD_INTERVAL)
+    except KeyboardInterrupt:
+        print("\n查询服务已停止")
+        return 0
+    finally:
+        server.shutdown()
+
+
+def region_scan_row(result, checked_at):
+    """构建地区扫描结果的一行"""
+    return [result['ip'], result['port'], 1, 1, '0.00', f"{result['latency']:.2f}", '0.00',
+            result['colo'], f"{checked_at:.0f}"]
+
+
+def load_region_scan(scan_file=REGION_SCAN_FILE):
+    """读取地区扫描结果（缺少检测时间的行使用文件修改时间）
+    
+    Returns:
+        list: 结果dict列表（含 checked_at 字段），文件不存在时为空列表
+    """
+    if not os.path.exists(scan_file):
+        return []
+    default_ts = os.path.getmtime(scan_file)
+    rows = []
+    for result in iter_result_file(scan_file):
+        if not result['colo'] or result['colo'] == 'N/A':
+            continue
+        result['checked_at'] = result.get('checked_at') or default_ts
+        if result['latency'] is None:
+            result['latency'] = 0.0
+        rows.append(result)
+    return rows
+
+
+def write_region_scan(rows, scan_file=REGION_SCAN_FILE):
+    """原子地写入地区扫描结果"""
+    temp_file = scan_file + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(REGION_SCAN_HEADERS)
+        for row in rows:
+            writer.writerow(region_scan_row(row, row['checked_at']))
+    os.replace(temp_file, scan_file)
+
+
+def region_scan_status(scan_file=REGION_SCAN_FILE, ttl=REGION_SCAN_TTL):
+    """统计地区扫描缓存状态（读取地区索引中的检测时间，无需重新解析CSV）
+    
+    Returns:
+        tuple: (总行数, 过期行数, 最近一次检测时间)，文件不存在时为 (0, 0, 0)
+    """
+    if not os.path.exists(scan_file):
+        return 0, 0, 0
+    return get_region_index(scan_file).scan_status(ttl)
+
+
+def httping_targets(targets, url=REGION_SCAN_URL, concurrency=NATIVE_HTTPING_CONCURRENCY):
+    """对一组目标进行HTTPing，返回 {(ip, port): 结果}（仅包含获取到地区码的IP）"""
+    concurrency = _raise_open_file_limit(concurrency)
+    
+    async def collect():
+        results = {}
+        async for result in httping_stream(targets, url, concurrency):
+            results[(result['ip'], result['port'])] = result
+        return results
+    
+    return run_async(collect())
+
+
+def refresh_region_scan(ip_file=CLOUDFLARE_IP_FILE, scan_file=REGION_SCAN_FILE, ttl=REGION_SCAN_TTL,
+                        drift_samples=REGION_DRIFT_SAMPLES, url=REGION_SCAN_URL):
+    """增量刷新地区扫描结果
+    
+    只重新检测过期的行、IP列表中尚未覆盖的地址块，以及每个地区抽样的若干行；
+    抽样发现地区码变化（地区漂移）时，该地区的所有行都会重新检测。
+    
+    Returns:
+        dict: 地区码 -> IP数量
+    """
+    rows = load_region_scan(scan_file)
+    now = time.time()
+    rng = random.Random()
+    
+    stale = [r for r in rows if now - r['checked_at'] > ttl]
+    fresh = [r for r in rows if now - r['checked_at'] <= ttl]
+    
+    # 每个地区抽样检测是否发生漂移
+    by_colo = {}
+    for r in fresh:
+        by_colo.setdefault(r['colo'], []).append(r)
+    samples = []
+    for colo_rows in by_colo.values():
+        samples.extend(rng.sample(colo_rows, min(drift_samples, len(colo_rows))))
+    
+    # IP列表中新增或尚未覆盖的地址块；地区扫描本身是抽样的，未覆盖的块每次只抽样一轮
+    missing = list(iter_probe_targets(ip_file, exclude=IPSet(r['ip'] for r in rows)))
+    if len(missing) > REGION_SAMPLE_ROUND:
+        missing = rng.sample(missing, REGION_SAMPLE_ROUND)
+    
+    print(f"增量刷新: 过期 {len(stale)} 条，抽样 {len(samples)} 条，新地址块 {len(missing)} 个")
+    targets = [(r['ip'], r['port']) for r in stale + samples] + missing
+    probed = httping_targets(targets, url)
+    
+    # 抽样中地区码发生变化的地区，整体重新检测
+    drifted = {r['colo'] for r in samples
+               if (r['ip'], r['port']) in probed and probed[(r['ip'], r['port'])]['colo'] != r['colo']}
+    if drifted:
+        print(f"检测到地区变化: {', '.join(sorted(drifted))}，重新检测这些地区的全部IP")
+        sampled = {(r['ip'], r['port']) for r in samples}
+        recheck = [(r['ip'], r['port']) for r in fresh
+                   if r['colo'] in drifted and (r['ip'], r['port']) not in sampled]
+        probed.update(httping_targets(recheck, url))
+    
+    checked_at = time.time()
+    merged = {}
+    for r in rows:
+        key = (r['ip'], r['port'])
+        if key in probed:
+            r.update(colo=probed[key]['colo'], latency=probed[key]['latency'], checked_at=checked_at)
+        elif now - r['checked_at'] > ttl or r['colo'] in drifted:
+            # 过期或所属地区漂移且本次无响应的IP不再保留
+            continue
+        merged[key] = r
+    for key in missing:
+        if key in probed:
+            merged[key] = dict(probed[key], checked_at=checked_at)
+    
+    write_region_scan(list(merged.values()), scan_file)
+    record_measurements(list(probed.values()), os.path.basename(scan_file))
+    region_counts = {}
+    for r in merged.values():
+        region_counts[r['colo']] = region_counts.get(r['colo'], 0) + 1
+    print(f"增量刷新完成: 更新 {len(probed)} 条，共 {len(merged)} 条")
+    return region_counts
+
+
+def _cluster_key(ip):
+    """补充扫描时用于聚类的较大地址块（IPv4 /16、IPv6 /48）"""
+    address = ipaddress.ip_address(ip)
+    prefix = REGION_CLUSTER_PREFIX_V4 if address.version == 4 else REGION_CLUSTER_PREFIX_V6
+    return ipaddress.ip_network(f"{ip}/{prefix}", strict=False)
+
+
+def drill_region(colo, ip_file=CLOUDFLARE_IP_FILE, scan_file=REGION_SCAN_FILE, want=REGION_DRILL_TARGET,
+                 max_probes=REGION_DRILL_MAX_PROBES, url=REGION_SCAN_URL):
+    """抽样扫描之后，只为选中的地区补充IP
+    
+    同一地区的IP往往集中在相邻的地址段，因此优先探测与该地区已知IP位于同一 /16（IPv6 /48）
+    的未覆盖地址块，每轮结束后根据新命中的IP重新排序。新结果（包括其他地区的）追加到 scan_file。
+    
+    Returns:
+        int: 该地区新增的IP数量
+    """
+    rows = load_region_scan(scan_file) if os.path.exists(scan_file) else []
+    have = sum(1 for r in rows if r['colo'] == colo)
+    if have >= want or not os.path.exists(ip_file):
+        return 0
+    
+    hot = {_cluster_key(r['ip']) for r in rows if r['colo'] == colo}
+    remaining = list(iter_probe_targets(ip_file, exclude=IPSet(r['ip'] for r in rows)))
+    random.shuffle(remaining)
+    
+    print(f"正在为 {colo} 补充扫描（已有 {have} 个IP，目标 {want} 个）...")
+    found = probed = 0
+    with open(scan_file, 'a', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        while remaining and have + found < want and probed < max_probes:
+            # 稳定排序：命中过该地区的 /16 中的地址块排在前面
+            remaining.sort(key=lambda t: _cluster_key(t[0]) not in hot)
+            batch, remaining = remaining[:REGION_SAMPLE_ROUND], remaining[REGION_SAMPLE_ROUND:]
+            results = httping_targets(batch, url)
+            probed += len(batch)
+            checked_at = time.time()
+            for result in results.values():
+                writer.writerow(region_scan_row(result, checked_at))
+                if result['colo'] == colo:
+                    found += 1
+                    hot.add(_cluster_key(result['ip']))
+            f.flush()
+            print(f"\r  已探测 {probed} 个地址块，新增 {colo} IP {found} 个...", end='', flush=True)
+    print(f"\r  补充扫描完成：探测 {probed} 个地址块，新增 {colo} IP {found} 个，共 {have + found} 个")
+    return found
+
+
+class RegionIndex:
+    """地区扫描结果的二进制索引（机场码 -> 紧凑IP数组），通过 mmap 按需读取
+    
+    文件格式（小端）:
+        头部   : 魔数 CFRI、版本、源文件 mtime_ns、源文件大小、地区数、检测时间数
+        地区表 : 每项 机场码(8字节) + IPv4偏移/数量 + IPv6偏移/数量
+        IPv4区 : uint32 数组（主机字节序值按小端存储）
+        IPv6区 : 16 字节网络序地址数组
+        时间区 : 各行检测时间（uint32 秒，升序），缺少检测时间的行使用源文件修改时间
+    查询某个地区只需一次字典查找和一次切片，统计过期行数只需一次二分查找，无需重新解析CSV。
+    """
+    HEADER = struct.Struct('<4sHHqqII')
+    ENTRY = struct.Struct('<8sIIII')
+    MAGIC = b'CFRI'
+    VERSION = 2
+    
+    def __init__(self, index_file):
+        import mmap
+        self._file = open(index_file, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空文件无法映射
+            self._file.close()
+            raise
+        
+        (magic, version, _, self.source_mtime, self.source_size, colo_count,
+         self._time_count) = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise ValueError("地区索引格式不匹配")
+        
+        self._entries = {}
+        offset = self.HEADER.size
+        for _ in range(colo_count):
+            colo, v4_offset, v4_count, v6_offset, v6_count = self.ENTRY.unpack_from(self._mmap, offset)
+            self._entries[colo.rstrip(b'\0').decode('ascii')] = (v4_offset, v4_count, v6_offset, v6_count)
+            offset += self.ENTRY.size
+        self._v4_start = offset
+        self._v6_start = offset + 4 * sum(e[1] for e in self._entries.values())
+        self._times_start = self._v6_start + 16 * sum(e[3] for e in self._entries.values())
+    
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+    
+    def counts(self):
+        """返回 {机场码: IP数量}"""
+        return {colo: e[1] + e[3] for colo, e in self._entries.items()}
+    
+    def ips(self, colo):
+        """返回指定地区的IP集合（IPSet，两个区都已排序，直接切片即可）"""
+        entry = self._entries.get(colo)
+        if not entry:
+            return IPSet()
+        v4_offset, v4_count, v6_offset, v6_count = entry
+        
+        start = self._v4_start + 4 * v4_offset
+        v4 = IPSet._v4_from_le_bytes(self._mmap[start:start + 4 * v4_count])
+        start = self._v6_start + 16 * v6_offset
+        return IPSet._from_sorted(v4, self._mmap[start:start + 16 * v6_count])
+    
+    def _checked_at(self, i):
+        return struct.unpack_from('<I', self._mmap, self._times_start + 4 * i)[0]
+    
+    def scan_status(self, ttl=REGION_SCAN_TTL, now=None):
+        """返回 (总行数, 过期行数, 最近一次检测时间)，在升序的检测时间上二分查找"""
+        total = self._time_count
+        if not total:
+            return 0, 0, 0
+        cutoff = (time.time() if now is None else now) - ttl
+        low, high = 0, total
+        while low < high:
+            mid = (low + high) // 2
+            if self._checked_at(mid) < cutoff:
+                low = mid + 1
+            else:
+                high = mid
+        return total, low, self._checked_at(total - 1)
+    
+    @classmethod
+    def build(cls, scan_file=REGION_SCAN_FILE, index_file=REGION_INDEX_FILE):
+        """读取一遍地区扫描CSV，生成二进制索引文件"""
+        import socket
+        v4_by_colo = {}
+        v6_by_colo = {}
+        times = array('I')
+        stat = os.stat(scan_file)
+        default_ts = int(stat.st_mtime)
+        with open(scan_file, 'r', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            ip_col = header.index('IP 地址') if 'IP 地址' in header else 0
+            colo_col = header.index('地区码') if '地区码' in header else -1
+            time_col = header.index('检测时间') if '检测时间' in header else -1
+            for row in reader:
+                if colo_col < 0 or len(row) <= max(ip_col, colo_col):
+                    continue
+                colo = row[colo_col].strip()
+                if not colo or colo == 'N/A':
+                    continue
+                ip = row[ip_col].strip()
+                try:
+                    if ':' in ip:
+                        v6_by_colo.setdefault(colo, set()).add(socket.inet_pton(socket.AF_INET6, ip))
+                    else:
+                        v4_by_colo.setdefault(colo, set()).add(struct.unpack('!I', socket.inet_aton(ip))[0])
+                except OSError:
+                    continue
+                checked_at = _to_float(row[time_col].strip()) if 0 <= time_col < len(row) else None
+                times.append(min(max(int(checked_at or default_ts), 0), 0xFFFFFFFF))
+        
+        colos = sorted(set(v4_by_colo) | set(v6_by_colo))
+        times = array('I', sorted(times))
+        if sys.byteorder != 'little':
+            times.byteswap()
+        temp_file = index_file + ".tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, stat.st_mtime_ns, stat.st_size, len(colos),
+                                    len(times)))
+            v4_offset = v6_offset = 0
+            for colo in colos:
+                v4_count = len(v4_by_colo.get(colo, ()))
+                v6_count = len(v6_by_colo.get(colo, ()))
+                f.write(cls.ENTRY.pack(colo.encode('ascii', 'replace')[:8], v4_offset, v4_count, v6_offset, v6_count))
+                v4_offset += v4_count
+                v6_offset += v6_count
+            for colo in colos:
+                values = sorted(v4_by_colo.get(colo, ()))
+                f.write(struct.pack(f'<{len(values)}I', *values))
+            for colo in colos:
+                f.write(b''.join(sorted(v6_by_colo.get(colo, ()))))
+            f.write(times.tobytes())
+        os.replace(temp_file, index_file)
+
+
+_region_indexes = {}
+
+
+def get_region_index(scan_file=REGION_SCAN_FILE, index_file=REGION_INDEX_FILE):
+    """获取地区索引，扫描结果有变化时自动重建（同一进程内复用已打开的索引）"""
+    stat = os.stat(scan_file)
+    index = _region_indexes.get(index_file)
+    if index and (index.source_mtime, index.source_size) == (stat.st_mtime_ns, stat.st_size):
+        return index
+    if index:
+        index.close()
+        del _region_indexes[index_file]
+    
+    index = None
+    if os.path.exists(index_file):
+        try:
+            index = RegionIndex(index_file)
+            if (index.source_mtime, index.source_size) != (stat.st_mtime_ns, stat.st_size):
+                index.close()
+                index = None
+        except (ValueError, OSError, struct.error):
+            index = None
+    if index is None:
+        RegionIndex.build(scan_file, index_file)
+        index = RegionIndex(index_file)
+    
+    _region_indexes[index_file] = index
+    return index
+
+
+def read_region_counts(scan_file=REGION_SCAN_FILE):
+    """统计每个地区的IP数量（通过地区索引，无需重新解析CSV）"""
+    return get_region_index(scan_file).counts()
+
+
+def load_region_ips(cfcolo, scan_file=REGION_SCAN_FILE):
+    """从地区扫描结果中读取指定地区的IP
+    
+    Returns:
+        IPSet: 该地区的IP集合
+    """
+    if not os.path.exists(scan_file):
+        return IPSet()
+    return get_region_index(scan_file).ips(cfcolo)
+
+
+def build_region_list(region_counts):
+    """构建地区列表（按IP数量排序）"""
+    available_regions = []
+    for colo, count in sorted(region_counts.items(), key=lambda x: x[1], reverse=True):
+        # 查找地区名称
+        info = AIRPORT_CODES.get(colo)
+        region_name = f"{info.get('name', '')} ({info.get('country', '')})" if info else "未知地区"
+        available_regions.append((colo, region_name, count))
+    return available_regions
+
+
+def detect_available_regions(ctx):
+    """检测可用地区（地区扫描固定使用 IPv4 列表）"""
+    # 上次扫描中断时从检查点继续
+    if confirm_resume(REGION_SCAN_FILE, "regions"):
+        region_counts = detect_regions_native(ctx.prepare_ip_list("ipv4") or CLOUDFLARE_IP_FILE, resume=True)
+        if region_counts:
+            print(f"地区扫描结果已保存到 {REGION_SCAN_FILE}")
+            ingest_result_file(REGION_SCAN_FILE)
+            return build_region_list(region_counts)
+    
+    # 检查是否已有检测结果文件
+    if os.path.exists(REGION_SCAN_FILE):
+        total, stale, newest = region_scan_status()
+        age_hours = (time.time() - newest) / 3600 if newest else 0
+        print(f"发现已有的地区扫描结果文件（共 {total} 条，最近检测于 {age_hours:.1f} 小时前，过期 {stale} 条）")
+        print("  1. 使用已有结果")
+        print("  2. 增量刷新 - 只重测过期/缺失的IP，并抽样检测地区变化")
+        print("  3. 全部重新扫描")
+        default_choice = "2" if stale else "1"
+        choice = input(f"请选择 [默认: {default_choice}]: ").strip() or default_choice
+        if choice == "1" and total:
+            print("使用已有检测结果...")
+            return build_region_list(read_region_counts())
+        if choice == "2" and total:
+            try:
+                region_counts = refresh_region_scan(ctx.prepare_ip_list("ipv4") or CLOUDFLARE_IP_FILE)
+                if region_counts:
+                    return build_region_list(region_counts)
+            except Exception as e:
+                print(f"增量刷新失败: {e}")
+            print("增量刷新未获得结果，改为全部重新扫描")
     
     print("正在检测各地区可用性...")
     
-    # 获取系统信息
-    os_type, arch_type = get_system_info()
-    exec_name = download_cloudflare_speedtest(os_type, arch_type)
+    # 优先使用原生HTTPing引擎，边扫描边统计，中断时保留已有结果
+    ctx.prepare_ip_list("ipv4")
+    region_counts = detect_regions_native(CLOUDFLARE_IP_FILE)
+    if region_counts:
+        print(f"地区扫描结果已保存到 {REGION_SCAN_FILE}")
+        ingest_result_file(REGION_SCAN_FILE)
+        return build_region_list(region_counts)
+    
+    print("原生HTTPing未获得结果，改用 CloudflareST 检测...")
     
     # 构建检测命令 - 使用HTTPing模式快速检测
-    if sys.platform == "win32":
-        cmd = [exec_name]
-    else:
-        cmd = [f"./{exec_name}"]
+    cmd = ctx.command()
+    if cmd is None:
+        print("测速程序不可用，使用默认地区列表")
+        return list(DEFAULT_REGIONS)
     
     cmd.extend([
         "-dd",  # 禁用下载测速，只做延迟测试
         "-tl", "9999",  # 高延迟阈值
         "-f", CLOUDFLARE_IP_FILE,
         "-httping",  # 使用HTTPing模式获取地区码
-        "-url", "https://jhb.ovh",
-        "-o", "region_scan.csv"  # 输出到地区扫描文件
+        "-url", REGION_SCAN_URL,
+        "-o", REGION_SCAN_FILE  # 输出到地区扫描文件
     ])
     
     try:
@@ -2166,64 +6274,19 @@ def detect_available_regions():
         print("=" * 50)
         
         # 直接运行命令，显示完整输出
-        result = subprocess.run(cmd, timeout=120, encoding='utf-8', errors='replace')
+        result = run_speedtest_streaming(cmd, timeout=120)
         
-        if result.returncode == 0 and os.path.exists("region_scan.csv"):
-            # 读取检测结果
-            available_regions = []
-            region_counts = {}  # 统计每个地区的IP数量
-            
-            with open("region_scan.csv", 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    colo = (row.get('地区码') or '').strip()
-                    if colo and colo != 'N/A':
-                        # 统计IP数量
-                        if colo not in region_counts:
-                            region_counts[colo] = 0
-                        region_counts[colo] += 1
-            
-            # 构建地区列表（按IP数量排序）
-            for colo, count in sorted(region_counts.items(), key=lambda x: x[1], reverse=True):
-                # 查找地区名称
-                region_name = "未知地区"
-                for code, info in AIRPORT_CODES.items():
-                    if code == colo:
-                        region_name = f"{info.get('name', '')} ({info.get('country', '')})"
-                        break
-                available_regions.append((colo, region_name, count))
-            
+        if result.returncode == 0 and not result.cancelled and os.path.exists(REGION_SCAN_FILE):
             # 保留地区扫描结果文件，不删除
-            print("地区扫描结果已保存到 region_scan.csv")
-            
-            return available_regions
+            print(f"地区扫描结果已保存到 {REGION_SCAN_FILE}")
+            return build_region_list(read_region_counts())
         else:
             print("地区检测失败，使用默认地区列表")
-            # 返回默认的主要地区
-            default_regions = [
-                ('HKG', '香港 (中国)', 0),
-                ('SIN', '新加坡 (新加坡)', 0),
-                ('NRT', '东京 (日本)', 0),
-                ('ICN', '首尔 (韩国)', 0),
-                ('LAX', '洛杉矶 (美国)', 0),
-                ('FRA', '法兰克福 (德国)', 0),
-                ('LHR', '伦敦 (英国)', 0)
-            ]
-            return default_regions
+            return list(DEFAULT_REGIONS)
             
     except Exception as e:
         print(f"地区检测出错: {e}")
-        # 返回默认地区
-        default_regions = [
-            ('HKG', '香港 (中国)', 0),
-            ('SIN', '新加坡 (新加坡)', 0),
-            ('NRT', '东京 (日本)', 0),
-            ('ICN', '首尔 (韩国)', 0),
-            ('LAX', '洛杉矶 (美国)', 0),
-            ('FRA', '法兰克福 (德国)', 0),
-            ('LHR', '伦敦 (英国)', 0)
-        ]
-        return default_regions
+        return list(DEFAULT_REGIONS)
 
 if __name__ == "__main__":
     try: